@@ -0,0 +1,43 @@
+# ==========================================
+# AI CORE: HẠ TẦNG GỌI GEMINI DÙNG CHUNG CHO CÁC TRANG
+# ==========================================
+# Module này KHÔNG import streamlit: mọi thứ ở đây sống ở cấp tiến trình
+# (dùng chung giữa các session, các trang và các lần rerun).
+
+from ai_core.clients import ClientPool, get_client_pool, mask_key
+from ai_core.fake_backend import FAKE_API_KEYS, FakeClientPool, FakeGeminiBackend
+from ai_core.discovery import ModelCatalog, get_model_catalog
+from ai_core.health import HealthRegistry, get_health_registry, is_quota_error
+from ai_core.cache import ResponseCache, get_response_cache, is_complete_json, response_cache_dir
+from ai_core.salvage import SalvagedJSON, merge_json, missing_fields, missing_fields_prompt, salvage_json
+from ai_core.prompts import PrefixStats, PromptLayout, get_prefix_stats
+from ai_core.context_cache import ContextCacheManager, get_context_cache_manager
+from ai_core.ratelimit import RateLimiter, estimate_tokens, get_rate_limiter
+from ai_core.retry import RetryPolicy, classify_error, retry_after
+from ai_core.cascade import Cascade
+from ai_core.router import MODEL_TIERS, LatencyRouter, get_latency_router, model_ladder
+from ai_core.scheduler import FairScheduler
+from ai_core.metrics import MetricsStore, get_metrics_store, metrics_path
+from ai_core.gateway import DeadlineExceeded, GenerationRequest, GenerationResult, LLMGateway, get_gateway
+from ai_core.jobs import BatchJob, Job, JobManager, get_job_manager
+from ai_core.offline import OfflineBatchManager, batches_path, get_offline_batches
+
+__all__ = [
+    "ClientPool", "get_client_pool", "mask_key",
+    "FAKE_API_KEYS", "FakeClientPool", "FakeGeminiBackend",
+    "ModelCatalog", "get_model_catalog",
+    "HealthRegistry", "get_health_registry", "is_quota_error",
+    "ResponseCache", "get_response_cache", "is_complete_json", "response_cache_dir",
+    "SalvagedJSON", "merge_json", "missing_fields", "missing_fields_prompt", "salvage_json",
+    "PrefixStats", "PromptLayout", "get_prefix_stats",
+    "ContextCacheManager", "get_context_cache_manager",
+    "RateLimiter", "estimate_tokens", "get_rate_limiter",
+    "RetryPolicy", "classify_error", "retry_after",
+    "Cascade",
+    "MODEL_TIERS", "LatencyRouter", "get_latency_router", "model_ladder",
+    "FairScheduler",
+    "MetricsStore", "get_metrics_store", "metrics_path",
+    "DeadlineExceeded", "GenerationRequest", "GenerationResult", "LLMGateway", "get_gateway",
+    "BatchJob", "Job", "JobManager", "get_job_manager",
+    "OfflineBatchManager", "batches_path", "get_offline_batches",
+]
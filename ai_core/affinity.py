@@ -0,0 +1,53 @@
+import bisect
+import hashlib
+
+# ==========================================
+# GẮN KEY THEO LOẠI PROMPT (CONSISTENT HASHING) ĐỂ CACHE PHÍA SERVER KỊP "ẤM"
+# ==========================================
+# Cache của Gemini (implicit prefix cache, context cache tường minh) nằm riêng
+# theo từng key/project. Xếp key theo sức khỏe + nhiễu ngẫu nhiên thì cùng một
+# loại prompt bị rải khắp các key và cache gần như không bao giờ trúng.
+# Thay vào đó mỗi loại prompt ("trang/bước", thêm đề bài nếu có) được băm lên
+# 1 vòng băm (hash ring) chứa các key: key gặp đầu tiên theo chiều kim đồng hồ
+# là key ưu tiên, các key kế tiếp trên vòng là phương án dự phòng theo thứ tự.
+#   - Cùng loại prompt -> luôn cùng key (khi key đó còn khỏe).
+#   - Thêm / bớt 1 key chỉ làm đổi chủ các loại prompt nằm trên cung của key đó.
+#   - Mỗi key có VNODES điểm ảo trên vòng để các loại prompt chia đều giữa các key.
+
+VNODES = 64
+
+
+def _point(text):
+    # Băm ổn định giữa các tiến trình (hash() của Python đổi theo PYTHONHASHSEED)
+    return int.from_bytes(hashlib.blake2b(text.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+def affinity_label(page, step, affinity=None):
+    """Nhãn loại prompt dùng để chọn key: "trang/bước", thêm băm của đề bài (nếu có)."""
+    label = f"{page}/{step}"
+    if affinity:
+        label += "#" + hashlib.blake2b(str(affinity).encode("utf-8"), digest_size=6).hexdigest()
+    return label
+
+
+class HashRing:
+    def __init__(self, keys, vnodes=VNODES):
+        self.keys = list(keys)
+        self._ring = sorted((_point(f"{key}#{i}"), key) for key in dict.fromkeys(self.keys) for i in range(vnodes))
+        self._points = [point for point, _ in self._ring]
+
+    def walk(self, label):
+        """Mọi key theo thứ tự trên vòng bắt đầu từ vị trí của label (key đầu = key ưu tiên)."""
+        if not self._ring:
+            return []
+        start = bisect.bisect(self._points, _point(label))
+        order = {}
+        for offset in range(len(self._ring)):
+            order.setdefault(self._ring[(start + offset) % len(self._ring)][1], None)
+            if len(order) == len(set(self.keys)):
+                break
+        return list(order)
+
+    def owner(self, label):
+        walked = self.walk(label)
+        return walked[0] if walked else None
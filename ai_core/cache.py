@@ -0,0 +1,219 @@
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+# ==========================================
+# CACHE KẾT QUẢ AI THEO NỘI DUNG (RAM LRU + Ổ ĐĨA)
+# ==========================================
+# Khóa cache = SHA-256 của (prompt, byte ảnh, danh sách model, cấu hình sinh).
+# Cả lớp cùng 1 đề + 1 biểu đồ -> chỉ tốn quota cho lần gọi đầu tiên,
+# những lần "Analyze & Guide" sau trả về ngay lập tức.
+#   - Tầng 1: OrderedDict trong RAM (LRU, giới hạn số mục).
+#   - Tầng 2: file JSON trên ổ đĩa (giới hạn dung lượng, xóa file cũ nhất trước).
+# Cả 2 tầng đều có TTL.
+
+DEFAULT_CACHE_DIR = os.path.join(".cache", "llm_responses")
+DEFAULT_MEMORY_ENTRIES = 256
+DEFAULT_DISK_BYTES = 200 * 1024 * 1024
+DEFAULT_TTL_SECONDS = 7 * 24 * 3600
+
+
+def response_cache_dir(backend="gemini"):
+    # Kết quả của backend giả lập không được lẫn vào cache của Gemini thật
+    return DEFAULT_CACHE_DIR if backend == "gemini" else f"{DEFAULT_CACHE_DIR}_{backend}"
+
+
+def _hash_part(digest, part):
+    if isinstance(part, str):
+        digest.update(b"text:")
+        digest.update(part.encode("utf-8"))
+    elif isinstance(part, (bytes, bytearray)):
+        digest.update(b"bytes:")
+        digest.update(part)
+    elif hasattr(part, "tobytes") and hasattr(part, "size"):
+        # Ảnh PIL: băm điểm ảnh đã giải mã (không phụ thuộc tên file / metadata)
+        digest.update(f"image:{part.mode}:{part.size}:".encode())
+        digest.update(part.tobytes())
+    else:
+        digest.update(repr(part).encode("utf-8"))
+
+
+def _config_fingerprint(config):
+    if config is None:
+        return "null"
+    if hasattr(config, "model_dump"):
+        return json.dumps(config.model_dump(mode="json", exclude_none=True), sort_keys=True)
+    return repr(config)
+
+
+def make_cache_key(contents, model_priority, config):
+    digest = hashlib.sha256()
+    for part in contents:
+        _hash_part(digest, part)
+        digest.update(b"\x00")
+    digest.update(("models:" + ",".join(model_priority)).encode())
+    digest.update(("config:" + _config_fingerprint(config)).encode())
+    return digest.hexdigest()
+
+
+def is_complete_json(text):
+    """Chỉ cache kết quả có khối JSON parse được (tránh cache mãi 1 bản bị đứt gãy)."""
+    match = re.search(r"(\{[\s\S]*\})", text or "")
+    if not match:
+        return False
+    try:
+        json.loads(match.group(1), strict=False)
+        return True
+    except json.JSONDecodeError:
+        return False
+
+
+class ResponseCache:
+    def __init__(self, directory=DEFAULT_CACHE_DIR, memory_entries=DEFAULT_MEMORY_ENTRIES,
+                 disk_bytes=DEFAULT_DISK_BYTES, ttl=DEFAULT_TTL_SECONDS):
+        self.directory = directory
+        self.memory_entries = memory_entries
+        self.disk_bytes = disk_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._disk_usage = None
+
+    # ---------- ĐỌC ----------
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                if now - entry["created"] < self.ttl:
+                    self._memory.move_to_end(key)
+                    self.hits += 1
+                    return entry
+                del self._memory[key]
+        entry = self._read_disk(key, now)
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._remember(key, entry)
+        return entry
+
+    def _read_disk(self, key, now):
+        path = self._path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if now - entry.get("created", 0) >= self.ttl:
+            self._remove_file(path)
+            return None
+        try:
+            os.utime(path)  # Đánh dấu "mới dùng" để LRU trên ổ đĩa không xóa nhầm
+        except OSError:
+            pass
+        return entry
+
+    # ---------- GHI ----------
+    def put(self, key, text, model):
+        entry = {"text": text, "model": model, "created": time.time()}
+        with self._lock:
+            self._remember(key, entry)
+        self._write_disk(key, entry)
+
+    def _remember(self, key, entry):
+        self._memory[key] = entry
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    def _write_disk(self, key, entry):
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            path = self._path(key)
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(entry, f, ensure_ascii=False)
+            os.replace(tmp_path, path)
+            with self._lock:
+                if self._disk_usage is None:
+                    self._disk_usage = self._scan_usage()
+                else:
+                    self._disk_usage += os.path.getsize(path)
+                over_cap = self._disk_usage > self.disk_bytes
+            if over_cap:
+                self._evict_disk()
+        except OSError:
+            pass  # Ổ đĩa lỗi/hết chỗ: vẫn còn tầng RAM
+
+    def _evict_disk(self):
+        # Xóa file ít được dùng gần đây nhất cho tới khi còn dưới 90% giới hạn
+        files = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".json"):
+                path = os.path.join(self.directory, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+        files.sort()
+        usage = sum(size for _, size, _ in files)
+        target = self.disk_bytes * 0.9
+        for _, size, path in files:
+            if usage <= target:
+                break
+            self._remove_file(path)
+            usage -= size
+        with self._lock:
+            self._disk_usage = usage
+
+    def _scan_usage(self):
+        total = 0
+        for name in os.listdir(self.directory):
+            try:
+                total += os.path.getsize(os.path.join(self.directory, name))
+            except OSError:
+                pass
+        return total
+
+    def invalidate(self, key):
+        with self._lock:
+            self._memory.pop(key, None)
+        self._remove_file(self._path(key))
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits, "misses": self.misses,
+                "memory_entries": len(self._memory), "disk_bytes": self._disk_usage,
+            }
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.json")
+
+    @staticmethod
+    def _remove_file(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+_CACHE = None
+_CACHE_LOCK = threading.Lock()
+
+
+def get_response_cache(**settings):
+    global _CACHE
+    with _CACHE_LOCK:
+        if _CACHE is None:
+            _CACHE = ResponseCache(**settings)
+    return _CACHE
@@ -0,0 +1,38 @@
+from dataclasses import dataclass, replace
+
+# ==========================================
+# CASCADE: MODEL NHẸ CHẤM TRƯỚC, CHỈ LÊN MODEL MẠNH KHI CẦN
+# ==========================================
+# Phần lớn bài luyện tập không cần model mạnh với ngân sách 32k token đầu ra.
+# Request có cascade thì gateway chạy 1 lượt nhẹ trước (model rẻ/nhanh, ít token
+# đầu ra, không stream, không hedging, không viết tiếp) rồi hỏi cascade.check:
+#   - None  -> chấp nhận kết quả lượt nhẹ (được cache như kết quả của request gốc);
+#   - chuỗi -> lý do leo thang (kết quả hỏng, sát ngưỡng band, model không chắc...),
+#              request gốc chạy bình thường trên model_priority với phần ngân sách
+#              thời gian còn lại.
+# Lượt nhẹ được ghi số liệu dưới bước "<step>_lite" để tách chi phí 2 tầng.
+
+LITE_SUFFIX = "_lite"
+FAILED = "failed"  # Lượt nhẹ không có kết quả (mọi key lỗi / hết thời gian)
+
+
+@dataclass
+class Cascade:
+    models: list  # Model nhẹ cho lượt đầu (theo thứ tự ưu tiên)
+    check: object  # callable(text) -> None (chấp nhận) | str (lý do chuyển sang model mạnh)
+    max_output_tokens: int = 8192
+    suffix: str = None  # Thêm vào cuối contents của lượt nhẹ (VD: xin thêm trường "confidence")
+    deadline_share: float = 0.4  # Phần ngân sách thời gian của bước dành cho lượt nhẹ
+
+    def lite_request(self, request, budget=None):
+        """Request của lượt nhẹ: cùng nội dung, model nhẹ, ít token, không cache / gộp / hedging."""
+        build_config = request.build_config
+        return replace(
+            request,
+            contents=[*request.contents, self.suffix] if self.suffix else list(request.contents),
+            model_priority=list(self.models),
+            build_config=lambda model: build_config(model).model_copy(update={"max_output_tokens": self.max_output_tokens}),
+            hedge_delay=None, cache=False, cache_key=None, coalesce=False, max_continuations=0,
+            step=f"{request.step}{LITE_SUFFIX}", deadline=budget * self.deadline_share if budget else None,
+            cascade=None,
+        )
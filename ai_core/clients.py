@@ -0,0 +1,91 @@
+import threading
+
+from google import genai
+from google.genai import types
+
+# ==========================================
+# POOL CLIENT THEO TỪNG API KEY (DÙNG CHUNG TOÀN TIẾN TRÌNH)
+# ==========================================
+# Mỗi key chỉ tạo 1 genai.Client duy nhất và giữ "ấm" kết nối (keep-alive),
+# thay vì tạo Client mới + bắt tay TLS lại ở mỗi lần gọi AI.
+
+KEEPALIVE_EXPIRY_SECONDS = 300
+MAX_CONNECTIONS_PER_KEY = 50
+MAX_KEEPALIVE_PER_KEY = 20
+HTTP_TIMEOUT_SECONDS = 180  # Trần mặc định cho mọi request HTTP của Client (gateway đặt timeout riêng theo ngân sách)
+
+
+def mask_key(api_key):
+    return f"****{api_key[-4:]}"
+
+
+def _build_http_options():
+    # Giới hạn kết nối của httpx (thư viện HTTP mà SDK dùng bên dưới)
+    import httpx
+    limits = httpx.Limits(
+        max_connections=MAX_CONNECTIONS_PER_KEY,
+        max_keepalive_connections=MAX_KEEPALIVE_PER_KEY,
+        keepalive_expiry=KEEPALIVE_EXPIRY_SECONDS,
+    )
+    return types.HttpOptions(
+        timeout=HTTP_TIMEOUT_SECONDS * 1000,  # SDK tính bằng mili giây
+        client_args={"limits": limits},
+        async_client_args={"limits": limits},
+    )
+
+
+class ClientPool:
+    """Giữ 1 genai.Client cho mỗi API key, an toàn khi nhiều luồng cùng truy cập."""
+
+    def __init__(self):
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    def get(self, api_key):
+        client = self._clients.get(api_key)
+        if client is not None:
+            return client
+        with self._lock:
+            client = self._clients.get(api_key)
+            if client is None:
+                client = self._create(api_key)
+                self._clients[api_key] = client
+            return client
+
+    def warm_up(self, api_keys):
+        for api_key in api_keys:
+            self.get(api_key)
+
+    def evict(self, api_key):
+        # Bỏ client hỏng (VD: kết nối bị đóng) để lần sau tạo lại
+        with self._lock:
+            self._clients.pop(api_key, None)
+
+    def __len__(self):
+        return len(self._clients)
+
+    @staticmethod
+    def _create(api_key):
+        try:
+            return genai.Client(api_key=api_key, http_options=_build_http_options())
+        except Exception:
+            # SDK cũ chưa hỗ trợ client_args -> vẫn dùng keep-alive mặc định của httpx
+            return genai.Client(api_key=api_key)
+
+
+_POOL = None
+_POOL_LOCK = threading.Lock()
+
+
+def get_client_pool(backend="gemini", **settings):
+    """Pool dùng chung; backend="fake" -> client giả lập cục bộ (settings: xem ai_core.fake_backend)."""
+    global _POOL
+    if _POOL is None:
+        with _POOL_LOCK:
+            if _POOL is None:
+                if backend == "fake":
+                    from ai_core.fake_backend import FakeClientPool, FakeGeminiBackend
+                    _POOL = FakeClientPool(FakeGeminiBackend(**settings))
+                else:
+                    _POOL = ClientPool()
+    return _POOL
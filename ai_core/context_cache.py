@@ -0,0 +1,142 @@
+import asyncio
+import hashlib
+import threading
+import time
+
+from google.genai import types
+
+from ai_core.clients import get_client_pool, mask_key
+
+# ==========================================
+# CONTEXT CACHING TƯỜNG MINH CHO PHẦN PROMPT TĨNH
+# ==========================================
+# Phần hướng dẫn tĩnh (hàng nghìn token) của prompt chấm điểm / hướng dẫn được
+# đăng ký 1 lần làm "cached content" cho từng cặp (key, model). Mỗi lần gọi chỉ
+# gửi phần động (đề bài, bài làm, ảnh) kèm tên cache.
+# Vòng đời của mỗi cache:
+#   - Chưa có / đã hết hạn  -> tạo mới (caches.create).
+#   - Sắp hết hạn (< margin) -> gia hạn TTL (caches.update); lỗi thì tạo lại.
+#   - Server báo không tìm thấy khi dùng -> invalidate(), lần sau tạo lại.
+# Key/model không hỗ trợ (free tier, prompt quá ngắn...) -> tạm bỏ qua, gửi prompt đầy đủ.
+# Client được lấy qua client_pool nên có thể thay bằng bản giả lập cục bộ để kiểm thử.
+
+DEFAULT_TTL_SECONDS = 3600
+REFRESH_MARGIN_SECONDS = 300
+UNSUPPORTED_BACKOFF_SECONDS = 6 * 3600
+
+
+def prefix_hash(prefix):
+    return hashlib.sha256(prefix.encode("utf-8")).hexdigest()
+
+
+class _CacheEntry:
+    __slots__ = ("name", "expires_at")
+
+    def __init__(self, name, expires_at):
+        self.name = name
+        self.expires_at = expires_at
+
+
+def _expire_timestamp(cached, fallback):
+    expire_time = getattr(cached, "expire_time", None)
+    if expire_time is None:
+        return fallback
+    try:
+        return expire_time.timestamp()
+    except AttributeError:
+        return fallback
+
+
+class ContextCacheManager:
+    def __init__(self, client_pool=None, ttl_seconds=DEFAULT_TTL_SECONDS,
+                 refresh_margin=REFRESH_MARGIN_SECONDS, unsupported_backoff=UNSUPPORTED_BACKOFF_SECONDS,
+                 clock=time.time):
+        self._pool = client_pool if client_pool is not None else get_client_pool()
+        self.ttl_seconds = ttl_seconds
+        self.refresh_margin = refresh_margin
+        self.unsupported_backoff = unsupported_backoff
+        self._clock = clock
+        self._entries = {}  # (key, model, prefix_hash) -> _CacheEntry
+        self._unsupported = {}  # (key, model) -> thời điểm được thử lại
+        self._locks = {}
+        self.created = 0
+        self.refreshed = 0
+        self.failures = 0
+
+    async def acquire(self, api_key, model, prefix):
+        """Trả về tên cached content dùng được cho (key, model), hoặc None nếu không cache được."""
+        now = self._clock()
+        if self._unsupported.get((api_key, model), 0) > now:
+            return None
+        cache_id = (api_key, model, prefix_hash(prefix))
+        lock = self._locks.setdefault(cache_id, asyncio.Lock())
+        async with lock:
+            client = self._pool.get(api_key)
+            now = self._clock()
+            entry = self._entries.get(cache_id)
+            if entry is not None and entry.expires_at - now > self.refresh_margin:
+                return entry.name
+            if entry is not None and entry.expires_at > now:
+                try:
+                    await self._refresh(client, entry)
+                    return entry.name
+                except Exception:
+                    self._entries.pop(cache_id, None)  # Gia hạn lỗi -> tạo lại bên dưới
+            try:
+                entry = await self._create(client, model, prefix, cache_id[2])
+            except Exception:
+                self.failures += 1
+                self._unsupported[(api_key, model)] = self._clock() + self.unsupported_backoff
+                return None
+            self._entries[cache_id] = entry
+            return entry.name
+
+    def invalidate(self, api_key, model, prefix):
+        self._entries.pop((api_key, model, prefix_hash(prefix)), None)
+
+    async def _create(self, client, model, prefix, digest):
+        cached = await client.aio.caches.create(
+            model=model,
+            config=types.CreateCachedContentConfig(
+                contents=[prefix],
+                ttl=f"{self.ttl_seconds}s",
+                display_name=f"auviet-{digest[:16]}",
+            ),
+        )
+        self.created += 1
+        return _CacheEntry(cached.name, _expire_timestamp(cached, self._clock() + self.ttl_seconds))
+
+    async def _refresh(self, client, entry):
+        updated = await client.aio.caches.update(
+            name=entry.name,
+            config=types.UpdateCachedContentConfig(ttl=f"{self.ttl_seconds}s"),
+        )
+        self.refreshed += 1
+        entry.expires_at = _expire_timestamp(updated, self._clock() + self.ttl_seconds)
+
+    def snapshot(self):
+        now = self._clock()
+        return [
+            {
+                "key": mask_key(api_key), "model": model, "prefix": digest[:12],
+                "name": entry.name, "expires_in_s": int(entry.expires_at - now),
+            }
+            for (api_key, model, digest), entry in list(self._entries.items())
+        ]
+
+
+def is_cache_not_found(error):
+    text = str(error).lower()
+    return "cachedcontent" in text.replace(" ", "") and ("not found" in text or "404" in text or "expired" in text)
+
+
+_MANAGER = None
+_MANAGER_LOCK = threading.Lock()
+
+
+def get_context_cache_manager(**settings):
+    global _MANAGER
+    with _MANAGER_LOCK:
+        if _MANAGER is None:
+            _MANAGER = ContextCacheManager(**settings)
+    return _MANAGER
@@ -0,0 +1,65 @@
+from types import SimpleNamespace
+
+from google.genai import types
+
+# ==========================================
+# VIẾT TIẾP KHI BỊ CẮT Ở MAX_TOKENS (THAY VÌ GỌI LẠI TỪ ĐẦU)
+# ==========================================
+# Model chạm max_output_tokens thì trả về finish_reason = MAX_TOKENS và JSON bị
+# đứt giữa chừng. Gọi lại từ đầu là trả tiền lần nữa cho cả nghìn token đã có.
+# Thay vào đó gửi lệnh "viết tiếp": nội dung gốc + phần đã viết (lượt của model)
+# + yêu cầu viết tiếp đúng chỗ dừng, rồi nối các phần lại. Lặp tới khi kết quả
+# hoàn chỉnh (request.complete_if) hoặc hết số vòng cho phép.
+
+MAX_CONTINUATIONS = 2
+MIN_OVERLAP_CHARS = 12
+MAX_OVERLAP_CHARS = 400
+
+CONTINUE_PROMPT = (
+    "Your previous answer was cut off because it reached the output limit. "
+    "Continue EXACTLY from the last character you wrote. Do not repeat anything, "
+    "do not restart, do not add explanations or code fences - output only the remaining text."
+)
+
+_USAGE_FIELDS = (
+    "prompt_token_count", "candidates_token_count", "thoughts_token_count",
+    "cached_content_token_count", "total_token_count",
+)
+
+
+def is_truncated(finish_reason):
+    """finish_reason (enum của SDK hoặc chuỗi) là MAX_TOKENS."""
+    return finish_reason is not None and (getattr(finish_reason, "name", None) or str(finish_reason)).endswith("MAX_TOKENS")
+
+
+def continuation_contents(contents, partial):
+    """Nội dung của lệnh viết tiếp: lượt gốc (user) + phần đã viết (model) + yêu cầu viết tiếp (user)."""
+    return [*contents, types.Content(role="model", parts=[types.Part(text=partial)]), CONTINUE_PROMPT]
+
+
+def _strip_fence(text):
+    if not text.lstrip().startswith("```"):
+        return text
+    # Model hay mở lại khối ```json dù đã dặn: bỏ dòng mở và dấu đóng ở cuối
+    body = text.lstrip().split("\n", 1)[1] if "\n" in text.lstrip() else ""
+    return body.rstrip()[:-3] if body.rstrip().endswith("```") else body
+
+
+def stitch(text, more):
+    """Nối phần viết tiếp vào sau text, bỏ đoạn model lặp lại ở chỗ nối (nếu có)."""
+    more = _strip_fence(more)
+    for size in range(min(len(more), len(text), MAX_OVERLAP_CHARS), MIN_OVERLAP_CHARS - 1, -1):
+        if text.endswith(more[:size]):
+            return text + more[size:]
+    return text + more
+
+
+def merge_usage(first, second):
+    """Cộng usage_metadata của các vòng (để số liệu token phản ánh đúng chi phí)."""
+    if first is None or second is None:
+        return first or second
+    merged = {}
+    for field in _USAGE_FIELDS:
+        values = [getattr(usage, field, None) for usage in (first, second)]
+        merged[field] = None if all(v is None for v in values) else sum(v or 0 for v in values)
+    return SimpleNamespace(**merged)
@@ -0,0 +1,106 @@
+import threading
+import time
+
+from ai_core.clients import get_client_pool
+
+# ==========================================
+# DANH MỤC MODEL THEO KEY (CACHE CÓ TTL + LÀM MỚI NGẦM)
+# ==========================================
+# client.models.list() chỉ được gọi 1 lần cho mỗi key, sau đó kết quả được
+# giữ trong RAM. Khi hết TTL, dữ liệu cũ vẫn được dùng ngay trong lúc một
+# luồng nền lấy danh sách mới (stale-while-revalidate).
+# list() là lệnh gọi đồng bộ và resolve() chạy trên event loop của gateway, nên
+# KHÔNG BAO GIỜ gọi list() trực tiếp ở đây: key chưa có danh sách (lần đầu, hoặc
+# sau invalidate khi gặp 404) -> trả None (thử model_priority nguyên trạng) và
+# lấy danh sách ở luồng nền.
+
+MODEL_LIST_TTL_SECONDS = 30 * 60
+FAILED_LIST_TTL_SECONDS = 60
+
+
+class _Entry:
+    __slots__ = ("models", "expires_at", "refreshing")
+
+    def __init__(self, models, ttl):
+        self.models = models
+        self.expires_at = time.monotonic() + ttl
+        self.refreshing = False
+
+
+class ModelCatalog:
+    def __init__(self, client_pool=None, ttl=MODEL_LIST_TTL_SECONDS):
+        self._pool = client_pool if client_pool is not None else get_client_pool()
+        self._ttl = ttl
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def available_models(self, api_key):
+        """Trả về set tên model của key (None nếu key chưa liệt kê được)."""
+        entry = self._entries.get(api_key)
+        if entry is None:
+            # Lần đầu gặp key này: hỏi API ở luồng nền, lần này cứ thử theo thứ tự ưu tiên
+            with self._lock:
+                entry = self._entries.get(api_key)
+                if entry is None:
+                    entry = self._entries[api_key] = _Entry(None, FAILED_LIST_TTL_SECONDS)
+                    entry.refreshing = True
+                    threading.Thread(target=self._refresh, args=(api_key,), daemon=True).start()
+        elif entry.expires_at <= time.monotonic():
+            self._refresh_in_background(api_key, entry)
+        return entry.models
+
+    def resolve(self, api_key, model_priority, fallback=None):
+        """Lọc model_priority theo các model có sẵn của key, giữ nguyên thứ tự."""
+        models = self.available_models(api_key)
+        if models is None:
+            # Không liệt kê được -> cứ thử theo thứ tự ưu tiên, để lỗi thật quyết định
+            return list(model_priority)
+        resolved = [m for m in model_priority if m in models]
+        if not resolved and fallback:
+            resolved = [fallback]
+        return resolved
+
+    def prefetch(self, api_keys):
+        # Khởi động nền: liệt kê model cho mọi key mà không chặn trang
+        for api_key in api_keys:
+            self.available_models(api_key)
+
+    def invalidate(self, api_key=None):
+        with self._lock:
+            if api_key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(api_key, None)
+
+    def _refresh_in_background(self, api_key, entry):
+        with self._lock:
+            if entry.refreshing:
+                return
+            entry.refreshing = True
+        threading.Thread(target=self._refresh, args=(api_key,), daemon=True).start()
+
+    def _refresh(self, api_key):
+        try:
+            client = self._pool.get(api_key)
+            models = {m.name.replace("models/", "") for m in client.models.list()}
+            entry = _Entry(frozenset(models), self._ttl)
+        except Exception:
+            old = self._entries.get(api_key)
+            # Giữ danh sách cũ nếu có, chỉ hẹn thử lại sớm hơn
+            entry = _Entry(old.models if old else None, FAILED_LIST_TTL_SECONDS)
+        with self._lock:
+            self._entries[api_key] = entry
+        return entry
+
+
+_CATALOG = None
+_CATALOG_LOCK = threading.Lock()
+
+
+def get_model_catalog():
+    global _CATALOG
+    if _CATALOG is None:
+        with _CATALOG_LOCK:
+            if _CATALOG is None:
+                _CATALOG = ModelCatalog()
+    return _CATALOG
@@ -0,0 +1,462 @@
+import asyncio
+import json
+import math
+import random
+import threading
+import time
+from collections.abc import Mapping
+from types import SimpleNamespace
+
+from ai_core.ratelimit import CHARS_PER_TOKEN, estimate_tokens
+
+# ==========================================
+# BACKEND GEMINI GIẢ LẬP (CHẠY CỤC BỘ, KHÔNG CẦN API KEY)
+# ==========================================
+# Thay cho genai.Client ở tầng client_pool nên gateway, cache, rate limit...
+# chạy y hệt như thật. Dùng để đo phần "của app" (parse, render, xuất file,
+# session) và thử tải với độ trễ / lỗi có kiểm soát:
+#   - Trả lời mẫu cho hướng dẫn (guide), chấm Task 1 (grading), phân tích + chấm tóm tắt (summary).
+#   - Độ trễ token đầu tiên và giữa các chunk theo phân phối cấu hình được.
+#   - Bơm lỗi 429 / 503, cắt cụt JSON (finish_reason = MAX_TOKENS), chia chunk khi stream.
+#   - Lệnh viết tiếp (có lượt "model" chứa phần đã viết) nhận đúng phần còn lại của bài mẫu.
+#   - client.batches (Batch API): batch "chạy" trong batch_delay giây rồi trả kết quả inline.
+# Bật trong secrets.toml:
+# LLM_BACKEND = "fake"
+# [FAKE_BACKEND]
+# first_token = { kind = "lognormal", median = 2.0, sigma = 0.6 }
+# chunk_delay = 0.05
+# quota_error_rate = 0.1
+# truncate_rate = 0.05
+# batch_delay = 30  # Batch API giả lập: batch xong sau 30 giây
+# seed = 42
+
+FAKE_API_KEYS = ("fake-key-0001", "fake-key-0002", "fake-key-0003")
+FAKE_MODELS = (
+    "gemini-2.5-pro", "gemini-2.5-flash", "gemini-2.5-flash-lite",
+    "gemini-2.0-flash", "gemini-1.5-pro", "gemini-1.5-flash",
+)
+
+
+# ---------- PHÂN PHỐI ĐỘ TRỄ ----------
+def make_latency(spec):
+    """Số / dict {kind: fixed|uniform|lognormal|exponential, ...} / hàm rng -> giây."""
+    if spec is None:
+        return lambda rng: 0.0
+    if callable(spec):
+        return spec
+    if isinstance(spec, (int, float)):
+        return lambda rng: float(spec)
+    if not isinstance(spec, Mapping):
+        raise ValueError(f"Không hiểu cấu hình độ trễ: {spec!r}")
+    kind = spec.get("kind", "fixed")
+    if kind == "fixed":
+        value = float(spec.get("value", 0.0))
+        return lambda rng: value
+    if kind == "uniform":
+        low, high = float(spec.get("low", 0.0)), float(spec.get("high", 1.0))
+        return lambda rng: rng.uniform(low, high)
+    if kind == "lognormal":
+        mu, sigma = math.log(float(spec.get("median", 1.0))), float(spec.get("sigma", 0.5))
+        return lambda rng: rng.lognormvariate(mu, sigma)
+    if kind == "exponential":
+        rate = 1.0 / float(spec.get("mean", 1.0))
+        return lambda rng: rng.expovariate(rate)
+    raise ValueError(f"Phân phối độ trễ không hỗ trợ: {kind}")
+
+
+# ---------- TRẢ LỜI MẪU ----------
+_GUIDE = {
+    "task_type": "Line Graph (Fake backend)",
+    "intro_guide": "<ul><li>Paraphrase đề bài: <code style='color:#d63384'>shows</code> -> <b>illustrates</b>.</li></ul>",
+    "overview_guide": "<ul><li>Nêu <b>2 xu hướng chính</b> và hạng mục cao nhất.</li></ul>",
+    "body1_guide": "<ul><li>Mô tả nhóm tăng, kèm số liệu đầu và cuối kỳ.</li></ul>",
+    "body2_guide": "<ul><li>Mô tả nhóm giảm / dao động, so sánh với nhóm 1.</li></ul>",
+}
+
+_GRADING_JSON = {
+    "original_score": {
+        "task_achievement": "6.0", "cohesion_coherence": "6.0",
+        "lexical_resource": "6.0", "grammatical_range": "5.5", "overall": "6.0",
+    },
+    "confidence": 0.85,  # Chỉ được xin ở lượt model nhẹ của cascade, thừa cũng không sao
+    "errors": [
+        {
+            "category": "Grammar", "type": "Subject-Verb Agreement", "impact_level": "High",
+            "explanation": "Chủ ngữ số nhiều phải đi với động từ số nhiều.",
+            "original": "the figures was", "correction": "THE FIGURES WERE",
+        },
+        {
+            "category": "Vocabulary", "type": "Word Choice", "impact_level": "Medium",
+            "explanation": "Dùng động từ mô tả xu hướng chính xác hơn.",
+            "original": "go up", "correction": "ROSE",
+        },
+    ],
+    "annotated_essay": (
+        "The graph illustrates how <del>the figures was</del> <ins class='grammar'>THE FIGURES WERE</ins> "
+        "distributed, and sales <del>go up</del> <ins class='vocab'>ROSE</ins> steadily."
+    ),
+    "revised_score": {
+        "word_count_check": "172 words - OK",
+        "logic_re_evaluation": "Bản sửa sạch lỗi ngữ pháp nhưng vẫn thiếu so sánh số liệu.",
+        "task_achievement": "6.5", "cohesion_coherence": "6.5",
+        "lexical_resource": "7.0", "grammatical_range": "7.0", "overall": "7.0",
+    },
+}
+
+_GRADING_MARKDOWN = """### 1. Task Achievement
+Bài viết nêu được xu hướng chính nhưng **thiếu overview** rõ ràng và so sánh số liệu.
+
+### 2. Coherence & Cohesion
+Bố cục 4 đoạn hợp lý; từ nối còn lặp lại (*Firstly, Secondly*).
+
+### 3. Lexical Resource
+Từ vựng mô tả xu hướng còn đơn giản (*go up, go down*).
+
+### 4. Grammatical Range & Accuracy
+Còn lỗi hòa hợp chủ ngữ - động từ và thì quá khứ.
+"""
+
+_SUMMARY_ANALYSIS = {
+    "step0_reasoning_scratchpad": {
+        "1_core_message": "Ô nhiễm nhựa và giải pháp tái chế.",
+        "2_candidate_filtering": "Câu 2 đoạn 1 bao quát nhất.",
+        "3_final_decision": "Chọn câu 2 đoạn 1.",
+    },
+    "extracted_text": "TEXT_PROVIDED",
+    "step1_skimming": {"topic": "Plastic pollution", "keywords": ["plastic", "recycling", "oceans"]},
+    "thesis_actual": "Plastic waste is one of the most urgent environmental problems of our time.",
+    "step1_paragraph_analysis": [
+        {"para_num": 1, "role": "Mở bài", "analysis": "Đặt vấn đề ô nhiễm nhựa.",
+         "key_sentence": "Plastic waste is one of the most urgent environmental problems of our time.", "is_thesis": True},
+        {"para_num": 2, "role": "Thân bài", "analysis": "Nêu tác hại với sinh vật biển.",
+         "key_sentence": "Marine animals often mistake plastic for food.", "is_thesis": False},
+    ],
+    "step1_reference_result": "Rác thải nhựa là vấn đề cấp bách và cần giải pháp tái chế.",
+    "step2_outline": {
+        "raw_points": ["Marine animals often mistake plastic for food.", "Recycling rates remain low."],
+        "deep_analysis": "Vấn đề -> Tác hại -> Giải pháp.",
+        "refined_points": ["Point 1: Sea creatures frequently ingest plastic.", "Point 2: Little plastic is recycled."],
+    },
+    "details_to_omit_guide": "Bỏ số liệu cụ thể và ví dụ minh họa.",
+    "details_to_omit": [
+        {"para_num": 2, "phrase": "such as turtles and seabirds", "type": "Ví dụ minh họa",
+         "deep_reason": "Ví dụ cụ thể không cần thiết trong bản tóm tắt."},
+    ],
+    "step3_drafting_reference": {
+        "intro": {
+            "original_text": "Plastic waste is one of the most urgent environmental problems of our time.",
+            "transformations": [{"method": "Từ đồng nghĩa", "original_part": "urgent",
+                                 "new_part": "pressing", "explanation": "Tránh lặp từ bài gốc."}],
+            "reporting_verb_used": "argues",
+            "final_sentence": "The article argues that plastic waste is a pressing environmental issue.",
+        },
+        "body": {
+            "original_text": "Sea creatures ingest plastic; little is recycled.",
+            "transformations": [{"method": "Đổi cấu trúc", "original_part": "mistake plastic for food",
+                                 "new_part": "swallow plastic", "explanation": "Rút gọn ý."}],
+            "final_sentence": "Many sea creatures swallow plastic debris, while only a small share of plastic is recycled.",
+        },
+        "concl": {
+            "original_text": "Cần tăng tái chế.",
+            "transformations": [{"method": "Danh từ hóa", "original_part": "recycle more",
+                                 "new_part": "greater recycling", "explanation": "Chốt ý ngắn gọn."}],
+            "final_sentence": "Greater recycling is therefore essential.",
+        },
+    },
+}
+
+_SUMMARY_GRADING = {
+    "total_score": "0.8/1.0",
+    "score_ideas": "0.3/0.4",
+    "feedback_ideas": "Đủ ý chính, thiếu ý giải pháp.",
+    "score_wording": "0.3/0.4",
+    "feedback_wording": "Có paraphrase nhưng còn chép nguyên cụm dài.",
+    "score_word_limit": "0.2/0.2",
+    "feedback_word_limit": "Số lượng từ nằm trong khoảng cho phép.",
+    "model_summary": "The article argues that plastic waste is a pressing environmental issue.",
+    "detailed_comparison": [
+        {"action": "NÂNG CẤP", "student_text": "plastic is very bad",
+         "suggested_text": "plastic waste is a pressing environmental issue", "explanation": "Học thuật hơn."},
+    ],
+    "grammar_spelling_errors": [
+        {"error": "plastics is", "correction": "plastics are", "reason": "Hòa hợp chủ ngữ - động từ."},
+    ],
+}
+
+DEFAULT_RESPONSES = {
+    "guide": json.dumps(_GUIDE, ensure_ascii=False, indent=2),
+    "grading": _GRADING_MARKDOWN + "\n```json\n" + json.dumps(_GRADING_JSON, ensure_ascii=False, indent=2) + "\n```",
+    "summary_analysis": json.dumps(_SUMMARY_ANALYSIS, ensure_ascii=False, indent=2),
+    "summary_grading": json.dumps(_SUMMARY_GRADING, ensure_ascii=False, indent=2),
+    "generic": "OK (fake backend)",
+}
+
+# Nhận diện loại prompt theo các trường JSON mà prompt yêu cầu (thứ tự quan trọng)
+_PROMPT_MARKERS = (
+    ("grading", '"original_score"'),
+    ("guide", '"intro_guide"'),
+    ("summary_grading", '"model_summary"'),
+    ("summary_analysis", '"details_to_omit"'),
+)
+
+
+def classify_prompt(text):
+    for kind, marker in _PROMPT_MARKERS:
+        if marker in text:
+            return kind
+    return "generic"
+
+
+# ---------- ĐỐI TƯỢNG GIẢ LẬP SDK ----------
+class FakeAPIError(Exception):
+    """Cùng dạng thông điệp với lỗi của SDK: "<code> <STATUS>. {...}"."""
+
+    def __init__(self, code, status, message):
+        self.code = code
+        self.status = status
+        super().__init__(f"{code} {status}. {{'error': {{'code': {code}, 'message': '{message}', 'status': '{status}'}}}}")
+
+
+def _usage(prompt_tokens, text, cached_tokens=None):
+    output_tokens = math.ceil(len(text) / CHARS_PER_TOKEN)
+    return SimpleNamespace(
+        prompt_token_count=prompt_tokens, candidates_token_count=output_tokens,
+        cached_content_token_count=cached_tokens, thoughts_token_count=None,
+        total_token_count=prompt_tokens + output_tokens,
+    )
+
+
+def _written_so_far(contents):
+    """Phần model đã viết (lượt role="model" cuối cùng) trong lệnh viết tiếp, None nếu không có."""
+    for part in reversed(contents):
+        if getattr(part, "role", None) == "model":
+            return "".join(getattr(p, "text", None) or "" for p in part.parts or [])
+    return None
+
+
+def _response(text, finish_reason=None, usage_metadata=None):
+    candidates = [SimpleNamespace(finish_reason=finish_reason)] if finish_reason else []
+    return SimpleNamespace(text=text, candidates=candidates, usage_metadata=usage_metadata)
+
+
+class FakeGeminiBackend:
+    def __init__(self, first_token=None, chunk_delay=None, chunk_chars=120, quota_error_rate=0.0,
+                 error_rate=0.0, truncate_rate=0.0, quota_keys=(), models=FAKE_MODELS, responses=None, seed=None,
+                 batch_delay=None):
+        self.first_token = make_latency(first_token)
+        self.chunk_delay = make_latency(chunk_delay)
+        self.chunk_chars = max(1, int(chunk_chars))
+        self.quota_error_rate = float(quota_error_rate)
+        self.error_rate = float(error_rate)
+        self.truncate_rate = float(truncate_rate)
+        self.quota_keys = set(quota_keys)  # Key luôn trả 429 (giả lập key đã cạn quota)
+        self.models = tuple(models)
+        self.responses = {**DEFAULT_RESPONSES, **(responses or {})}
+        self._rng = random.Random(seed)
+        self._caches = {}  # name -> nội dung prefix đã "cache"
+        self.batch_delay = make_latency(batch_delay)
+        self._batches = {}  # name -> batch job giả lập
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.injected_errors = 0
+        self.truncated = 0
+
+    def _roll(self, probability):
+        with self._lock:
+            return probability > 0 and self._rng.random() < probability
+
+    def _sample(self, latency):
+        with self._lock:
+            return max(0.0, latency(self._rng))
+
+    def _plan(self, api_key, model, contents, config):
+        """Quyết định kết quả của 1 lệnh gọi: (các chunk text, finish_reason, usage) hoặc raise lỗi."""
+        self.calls += 1
+        if model not in self.models:
+            raise FakeAPIError(404, "NOT_FOUND", f"models/{model} is not found")
+        if api_key in self.quota_keys or self._roll(self.quota_error_rate):
+            self.injected_errors += 1
+            raise FakeAPIError(429, "RESOURCE_EXHAUSTED", "Resource has been exhausted (e.g. check quota).")
+        if self._roll(self.error_rate):
+            self.injected_errors += 1
+            raise FakeAPIError(503, "UNAVAILABLE", "The model is overloaded. Please try again later.")
+
+        cached_name = getattr(config, "cached_content", None)
+        if cached_name and cached_name not in self._caches:
+            raise FakeAPIError(404, "NOT_FOUND", f"CachedContent not found (or permission denied): {cached_name}")
+        prefix = self._caches.get(cached_name, "") if cached_name else ""
+        prompt_text = prefix + "\n".join(part for part in contents if isinstance(part, str))
+        text = self.responses[classify_prompt(prompt_text)]
+        written = _written_so_far(contents)
+        if written is not None:
+            text = text[len(written):] if text.startswith(written) else text
+        finish_reason = "STOP"
+        if self._roll(self.truncate_rate):
+            # Cắt giữa chừng như khi chạm max_output_tokens -> JSON đứt gãy
+            self.truncated += 1
+            with self._lock:
+                text = text[: int(len(text) * self._rng.uniform(0.4, 0.9))]
+            finish_reason = "MAX_TOKENS"
+        cached_tokens = estimate_tokens([prefix]) if prefix else None
+        usage = _usage(estimate_tokens(contents) + (cached_tokens or 0), text, cached_tokens)
+        chunks = [text[i:i + self.chunk_chars] for i in range(0, len(text), self.chunk_chars)] or [""]
+        return chunks, finish_reason, usage
+
+    async def generate(self, api_key, model, contents, config):
+        chunks, finish_reason, usage = self._plan(api_key, model, contents, config)
+        delay = self._sample(self.first_token) + sum(self._sample(self.chunk_delay) for _ in chunks[1:])
+        await asyncio.sleep(delay)
+        return _response("".join(chunks), finish_reason, usage)
+
+    async def stream(self, api_key, model, contents, config):
+        chunks, finish_reason, usage = self._plan(api_key, model, contents, config)
+
+        async def iterate():
+            await asyncio.sleep(self._sample(self.first_token))
+            last = len(chunks) - 1
+            for i, chunk in enumerate(chunks):
+                if i:
+                    await asyncio.sleep(self._sample(self.chunk_delay))
+                # Giống SDK thật: usage + finish_reason chỉ có ở chunk cuối
+                yield _response(chunk, finish_reason if i == last else None, usage if i == last else None)
+
+        return iterate()
+
+    def create_cache(self, model, contents):
+        text = "\n".join(part for part in contents if isinstance(part, str))
+        with self._lock:
+            name = f"cachedContents/fake-{len(self._caches) + 1}"
+            self._caches[name] = text
+        return SimpleNamespace(name=name, model=model, expire_time=None)
+
+    # ---------- BATCH API ----------
+    def create_batch(self, api_key, model, src, display_name=None):
+        if model not in self.models:
+            raise FakeAPIError(404, "NOT_FOUND", f"models/{model} is not found")
+        with self._lock:
+            name = f"batches/fake-{len(self._batches) + 1}"
+            self._batches[name] = {
+                "api_key": api_key, "model": model, "src": list(src), "display_name": display_name,
+                "ready_at": time.monotonic() + max(0.0, self.batch_delay(self._rng)),
+                "state": "JOB_STATE_PENDING", "responses": None,
+            }
+        return self.get_batch(name)
+
+    def get_batch(self, name):
+        batch = self._batches.get(name)
+        if batch is None:
+            raise FakeAPIError(404, "NOT_FOUND", f"Batch not found: {name}")
+        if batch["state"] in ("JOB_STATE_PENDING", "JOB_STATE_RUNNING"):
+            if time.monotonic() >= batch["ready_at"]:
+                batch["responses"] = [self._batch_response(batch, request) for request in batch["src"]]
+                batch["state"] = "JOB_STATE_SUCCEEDED"
+            else:
+                batch["state"] = "JOB_STATE_RUNNING"
+        return SimpleNamespace(
+            name=name, model=batch["model"], display_name=batch["display_name"],
+            state=SimpleNamespace(name=batch["state"]), error=None,
+            dest=SimpleNamespace(inlined_responses=batch["responses"]) if batch["responses"] is not None else None,
+        )
+
+    def _batch_response(self, batch, request):
+        try:
+            chunks, finish_reason, usage = self._plan(batch["api_key"], batch["model"], request["contents"], request.get("config"))
+        except FakeAPIError as e:
+            return SimpleNamespace(response=None, error=str(e))
+        return SimpleNamespace(response=_response("".join(chunks), finish_reason, usage), error=None)
+
+    def cancel_batch(self, name):
+        batch = self._batches.get(name)
+        if batch is not None and batch["state"] in ("JOB_STATE_PENDING", "JOB_STATE_RUNNING"):
+            batch["state"] = "JOB_STATE_CANCELLED"
+
+    def stats(self):
+        return {
+            "calls": self.calls, "injected_errors": self.injected_errors,
+            "truncated": self.truncated, "cached_contents": len(self._caches), "batches": len(self._batches),
+        }
+
+
+class _FakeAsyncModels:
+    def __init__(self, backend, api_key):
+        self._backend = backend
+        self._api_key = api_key
+
+    async def generate_content(self, model, contents, config=None):
+        return await self._backend.generate(self._api_key, model, contents, config)
+
+    async def generate_content_stream(self, model, contents, config=None):
+        return await self._backend.stream(self._api_key, model, contents, config)
+
+
+class _FakeAsyncCaches:
+    def __init__(self, backend):
+        self._backend = backend
+
+    async def create(self, model, config):
+        return self._backend.create_cache(model, config.contents)
+
+    async def update(self, name, config):
+        if name not in self._backend._caches:
+            raise FakeAPIError(404, "NOT_FOUND", f"CachedContent not found: {name}")
+        return SimpleNamespace(name=name, expire_time=None)
+
+
+class _FakeBatches:
+    def __init__(self, backend, api_key):
+        self._backend = backend
+        self._api_key = api_key
+
+    def create(self, model, src, config=None):
+        display_name = (config or {}).get("display_name") if isinstance(config, Mapping) else getattr(config, "display_name", None)
+        return self._backend.create_batch(self._api_key, model, src, display_name)
+
+    def get(self, name):
+        return self._backend.get_batch(name)
+
+    def cancel(self, name):
+        self._backend.cancel_batch(name)
+
+
+class _FakeModels:
+    def __init__(self, backend):
+        self._backend = backend
+
+    def list(self):
+        return [SimpleNamespace(name=f"models/{model}") for model in self._backend.models]
+
+
+class FakeClient:
+    """Chỉ có đúng các phần của genai.Client mà ai_core dùng tới."""
+
+    def __init__(self, backend, api_key):
+        self.models = _FakeModels(backend)
+        self.batches = _FakeBatches(backend, api_key)
+        self.aio = SimpleNamespace(models=_FakeAsyncModels(backend, api_key), caches=_FakeAsyncCaches(backend))
+
+
+class FakeClientPool:
+    """Cùng giao diện với ClientPool, trả về FakeClient cho mọi key."""
+
+    def __init__(self, backend=None):
+        self.backend = backend or FakeGeminiBackend()
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    def get(self, api_key):
+        with self._lock:
+            client = self._clients.get(api_key)
+            if client is None:
+                client = self._clients[api_key] = FakeClient(self.backend, api_key)
+            return client
+
+    def warm_up(self, api_keys):
+        for api_key in api_keys:
+            self.get(api_key)
+
+    def evict(self, api_key):
+        with self._lock:
+            self._clients.pop(api_key, None)
+
+    def __len__(self):
+        return len(self._clients)
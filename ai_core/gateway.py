@@ -0,0 +1,913 @@
+import asyncio
+import concurrent.futures
+import threading
+import time
+from dataclasses import dataclass, replace
+
+from google.genai import types
+
+from ai_core.affinity import HashRing, affinity_label
+from ai_core.cascade import FAILED
+from ai_core.cache import get_response_cache, make_cache_key
+from ai_core.clients import get_client_pool, mask_key
+from ai_core.context_cache import get_context_cache_manager, is_cache_not_found
+from ai_core.continuation import CONTINUE_PROMPT, MAX_CONTINUATIONS, continuation_contents, is_truncated, merge_usage, stitch
+from ai_core.discovery import get_model_catalog
+from ai_core.health import PERMANENT_COOLDOWN_SECONDS, get_health_registry
+from ai_core.hedging import get_hedge_metrics
+from ai_core.metrics import get_metrics_store
+from ai_core.prompts import get_prefix_stats
+from ai_core.ratelimit import estimate_tokens, get_rate_limiter
+from ai_core.router import get_latency_router
+from ai_core.scheduler import FairScheduler
+from ai_core.retry import AUTH, INVALID, NOT_FOUND, QUOTA, RetryPolicy, classify_error, retry_after
+
+# ==========================================
+# LLM GATEWAY BẤT ĐỒNG BỘ (client.aio) DÙNG CHUNG CHO MỌI TRANG
+# ==========================================
+# - 1 event loop riêng chạy trên 1 luồng nền, sống suốt vòng đời server.
+# - Trang Streamlit gửi yêu cầu vào gateway và nhận lại 1 Future để chờ kết quả,
+#   nên hàng chục lệnh gọi AI có thể "đang bay" cùng lúc mà không cần
+#   mỗi học sinh giữ riêng 1 luồng chờ.
+# - Semaphore toàn cục giới hạn số lệnh gọi Gemini đồng thời.
+# - Trước mỗi lần gọi, RateLimiter kiểm tra hạn mức RPM/TPM của (key, model):
+#   key còn hạn mức được ưu tiên, nếu tất cả đều tạm cạn thì xếp hàng chờ ngắn.
+# - Kết quả được cache theo nội dung (prompt + ảnh + model + cấu hình):
+#   yêu cầu trùng lặp trả về ngay, không tốn quota.
+# - Phần prompt tĩnh (static_prefix) được gửi qua context cache tường minh nếu có
+#   ContextCacheManager; không cache được thì ghép lại vào đầu nội dung như cũ.
+# - Mọi lệnh gọi (kể cả cache hit / thất bại) được ghi vào MetricsStore theo
+#   nhãn page/step của request.
+# - Gộp lệnh gọi trùng (single-flight): nhiều yêu cầu cùng mã băm nội dung đến
+#   cùng lúc (VD: cả lớp cùng 1 đề + 1 biểu đồ) chỉ tạo 1 lệnh gọi lên Gemini,
+#   mọi người chờ nhận chung 1 kết quả (stream thì được phát lại từ đầu).
+# - Lỗi được phân loại (ai_core.retry): quota -> đổi key, lỗi tạm thời -> thử lại
+#   sau backoff có jitter / Retry-After, request sai (400) -> dừng ngay.
+# - Thứ tự model trên từng key do LatencyRouter quyết định: model đang chậm hơn
+#   SLO của bước (p95 gần đây) bị dời xuống sau các model nhẹ hơn.
+# - Mỗi bước có ngân sách thời gian (deadline): phần còn lại được truyền thành
+#   timeout của từng lần thử (HTTP + asyncio), còn ít quá thì không thử tiếp mà
+#   báo DeadlineExceeded để trang hiện "đang quá tải, thử lại" thay vì quay mãi.
+# - Lệnh gọi gắn với session + trang + bước đã gửi nó: reset, đổi bước, sang trang
+#   khác hay bỏ đi (session im lặng quá SESSION_IDLE_SECONDS) thì lệnh gọi bị hủy
+#   (retain / cancel_session) và được ghi outcome "cancelled" vào số liệu.
+# - Kết quả bị cắt ở MAX_TOKENS được viết tiếp trên cùng (key, model) và nối lại
+#   (ai_core.continuation) thay vì gọi lại từ đầu, tối đa request.max_continuations vòng.
+# - Key được chọn theo loại prompt (page/step + request.affinity) trên vòng băm
+#   (ai_core.affinity): cùng loại prompt luôn vào cùng key để cache phía server
+#   trúng; key đó không khỏe thì lùi sang các key kế tiếp trên vòng.
+# - request.cascade: model nhẹ làm trước, kết quả không đạt (cascade.check) mới
+#   chạy request trên model_priority (ai_core.cascade).
+# - Trước khi chạy, lệnh gọi phải được FairScheduler cho vào: giới hạn toàn server +
+#   giới hạn mỗi session, hàng chờ chia lượt công bằng giữa các session (WFQ);
+#   trang hỏi queue_position(session) để hiện vị trí trong hàng. Thời gian chờ lượt
+#   tính vào ngân sách thời gian của bước (request.submitted_at).
+
+DEFAULT_MAX_CONCURRENCY = 16
+MAX_QUEUE_WAIT_SECONDS = 8.0
+FALLBACK_MODEL = "gemini-1.5-flash"
+# Ngân sách thời gian (giây) cho cả lệnh gọi theo bước; request.deadline ghi đè
+DEFAULT_STEP_DEADLINES = {
+    "guide": 60.0,
+    "grading": 120.0,
+    "analysis": 90.0,
+}
+MAX_ATTEMPT_SECONDS = 180.0  # Trần cho 1 lần thử khi bước không có ngân sách (VD: chấm cả lớp)
+MIN_ATTEMPT_SECONDS = 5.0  # Còn ít hơn mức này thì không bắt đầu lần thử mới
+# Session không báo còn sống (retain / heartbeat) quá lâu -> coi như đã rời đi. Phải ngắn hơn
+# ngân sách thời gian của các bước (60-120s), nếu không lệnh gọi xong trước khi kịp bị hủy;
+# trang đang chờ kết quả gọi heartbeat mỗi nhịp chờ nên không bị hủy nhầm. Mất kết nối ngắn
+# (< SESSION_IDLE_SECONDS) vẫn mở lại được job qua URL.
+SESSION_IDLE_SECONDS = 30
+REAP_INTERVAL_SECONDS = 10
+WAIT_TICK_SECONDS = 0.5  # Nhịp heartbeat của generate() trong lúc chặn chờ kết quả
+
+_DONE = object()
+
+
+@dataclass
+class GenerationRequest:
+    contents: list  # Phần động (đề bài, bài làm, ảnh...)
+    model_priority: list
+    build_config: object  # callable(model) -> types.GenerateContentConfig
+    models_per_key: int = None  # None = thử hết model trên 1 key rồi mới đổi key
+    hedge_delay: float = None  # Chỉ dùng khi stream: None = không hedging
+    cache: bool = True
+    cache_if: object = None  # callable(text) -> bool: chỉ cache kết quả hợp lệ
+    cache_key: str = None  # Băm nội dung: khóa cache + khóa gộp lệnh gọi trùng (tính trên luồng của trang)
+    coalesce: bool = True  # Gộp với lệnh gọi giống hệt đang chạy
+    static_prefix: str = None  # Phần hướng dẫn tĩnh, đứng trước contents
+    page: str = None  # Nhãn cho số liệu (VD: "thuchanh")
+    step: str = None  # Nhãn cho số liệu (VD: "guide", "grading")
+    deadline: float = None  # Ngân sách thời gian (giây) cho cả lệnh gọi; None = DEFAULT_STEP_DEADLINES[step]
+    session: str = None  # Session đã gửi lệnh gọi (để hủy khi reset / đổi bước / rời trang); None = không gắn
+    complete_if: object = None  # callable(text) -> bool: kết quả đã hoàn chỉnh, không cần viết tiếp dù MAX_TOKENS
+    max_continuations: int = MAX_CONTINUATIONS  # Số vòng viết tiếp tối đa khi bị cắt ở MAX_TOKENS (0 = tắt)
+    affinity: str = None  # Thêm vào loại prompt khi chọn key (VD: đề bài) -> cùng đề vào cùng key
+    sticky: bool = True  # Chọn key theo loại prompt (vòng băm); False = theo sức khỏe như cũ
+    cascade: object = None  # ai_core.cascade.Cascade: thử model nhẹ trước; None = đi thẳng model_priority
+    submitted_at: float = None  # Lúc trang gửi (monotonic, gateway điền): ngân sách thời gian tính cả lúc xếp hàng
+
+    def full_contents(self):
+        if self.static_prefix is None:
+            return list(self.contents)
+        return [self.static_prefix, *self.contents]
+
+
+class DeadlineExceeded(TimeoutError):
+    """Hết ngân sách thời gian của bước trước khi có kết quả (không phải lỗi của key/model)."""
+
+
+@dataclass
+class GenerationResult:
+    text: str
+    model: str
+    api_key: str
+    attempts: int = 1
+    latency: float = 0.0
+    queue_wait: float = 0.0  # Chờ hạn mức RPM/TPM + chờ slot đồng thời
+    first_token_s: float = None
+    usage_metadata: object = None
+    finish_reason: object = None
+    hedged: bool = False
+    winner_role: str = "primary"
+    cached: bool = False
+    coalesced: bool = False  # Nhận chung kết quả của 1 lệnh gọi giống hệt đang chạy
+    continuations: int = 0  # Số vòng viết tiếp đã nối vào text (bị cắt ở MAX_TOKENS)
+    escalated: str = None  # Cascade: lý do phải chuyển sang model mạnh (None = không leo thang)
+
+    @property
+    def masked_key(self):
+        return mask_key(self.api_key)
+
+
+class _Flight:
+    """1 lệnh gọi lên Gemini đang chạy, có thể có nhiều người cùng chờ."""
+
+    def __init__(self):
+        self.task = None
+        self.waiters = 0
+        self.history = []  # Chunk đã phát (để người đến sau được phát lại từ đầu)
+        self.sinks = []
+
+    def put(self, item):
+        # Sink chung của lệnh gọi stream: chuyển tiếp cho mọi người đang chờ
+        if item is not _DONE:
+            self.history.append(item)
+        for sink in self.sinks:
+            sink.put(item)
+
+
+class _StreamAttempt:
+    def __init__(self, api_key, model, role):
+        self.api_key = api_key
+        self.model = model
+        self.role = role
+        self.first_token = asyncio.Event()
+        self.pending = []  # Chunk đã nhận trước khi được chọn làm luồng chính
+        self.sink = None
+        self.output_chars = 0
+        self.usage_metadata = None
+        self.queue_wait = 0.0
+
+
+def _finish_reason(response):
+    if response.candidates:
+        return response.candidates[0].finish_reason
+    return None
+
+
+class LLMGateway:
+    def __init__(self, api_keys=(), max_concurrency=DEFAULT_MAX_CONCURRENCY,
+                 client_pool=None, catalog=None, health=None, hedge_metrics=None, limiter=None, cache=None,
+                 context_cache=None, metrics=None, retry_policy=None, router=None,
+                 prefix_stats=None, scheduler=None):
+        self.api_keys = list(api_keys)
+        self.max_concurrency = max_concurrency
+        self.pool = client_pool if client_pool is not None else get_client_pool()  # Pool rỗng có len() == 0
+        self.catalog = catalog or get_model_catalog()
+        self.health = health or get_health_registry()
+        self.hedge_metrics = hedge_metrics or get_hedge_metrics()
+        self.limiter = limiter or get_rate_limiter()
+        self.cache = cache or get_response_cache()
+        self.context_cache = context_cache or get_context_cache_manager()
+        self.metrics = metrics or get_metrics_store()
+        self.retry = retry_policy or RetryPolicy()
+        self.router = router or get_latency_router()
+        self.prefixes = prefix_stats or get_prefix_stats()
+        self.scheduler = scheduler or FairScheduler(max_concurrency)
+        self.in_flight = 0
+        self.coalesced = 0
+        self.cancelled = 0
+        self.continuations = 0
+        self.cascades = {}  # "accepted" | lý do leo thang -> số lần
+        self.sticky = {}  # Nhãn loại prompt -> [số lần vào key ưu tiên, số lần phải lùi sang key khác]
+        self._ring = HashRing(())
+        self._calls = {}  # Future -> [session, page, step] của lệnh gọi đang chạy có gắn session
+        self._seen = {}  # session -> lần cuối script của session chạy (monotonic)
+        self._calls_lock = threading.Lock()
+        self._flights = {}  # ("generate" | "stream", cache_key) -> _Flight, chỉ truy cập trên event loop
+        self._slots = asyncio.Semaphore(max_concurrency)
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._run_loop, name="llm-gateway", daemon=True)
+        self._thread.start()
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self._loop)
+        self._loop.call_later(REAP_INTERVAL_SECONDS, self._reap_idle_sessions)
+        self._loop.run_forever()
+
+    # ---------- API CHO CÁC TRANG (GỌI TỪ LUỒNG STREAMLIT) ----------
+    def submit(self, request):
+        """Gửi yêu cầu vào event loop, trả về concurrent.futures.Future[GenerationResult | None]."""
+        self._prepare(request)
+        return self._track(request, asyncio.run_coroutine_threadsafe(
+            self._cancellable(request, self._single_flight(request, "generate", lambda: self._admitted(request, self._generate))),
+            self._loop,
+        ))
+
+    def generate(self, request, timeout=None):
+        """Bản chặn của submit; trong lúc chờ vẫn heartbeat session để không bị reaper hủy nhầm."""
+        future = self.submit(request)
+        give_up = None if timeout is None else time.monotonic() + timeout
+        while not concurrent.futures.wait([future], timeout=WAIT_TICK_SECONDS).done:
+            if request.session is not None:
+                self.heartbeat(request.session)
+            if give_up is not None and time.monotonic() >= give_up:
+                raise concurrent.futures.TimeoutError()
+        return future.result()
+
+    def submit_stream(self, request, sink):
+        """Bản stream của submit: từng đoạn text được sink.put(), kết thúc bằng _DONE."""
+        self._prepare(request)
+        future = self._track(request, asyncio.run_coroutine_threadsafe(
+            self._cancellable(request, self._single_flight(request, "stream", lambda flight: self._admitted(request, self._stream, flight), sink)),
+            self._loop,
+        ))
+        # Bị hủy khi còn xếp hàng (chưa vào _stream) thì không ai gửi _DONE: gửi ở đây
+        # (bị hủy giữa chừng thì sink có thể nhận _DONE 2 lần, bên đọc dừng ở lần đầu)
+        future.add_done_callback(lambda done: sink.put(_DONE) if done.cancelled() else None)
+        return future
+
+    # ---------- HỦY THEO SESSION / BƯỚC ----------
+    def retain(self, session, page, steps=()):
+        """Gọi ở đầu mỗi lần chạy trang: hủy lệnh gọi của session không thuộc (page, steps) hiện tại."""
+        with self._calls_lock:
+            self._seen[session] = time.monotonic()
+            stale = [f for f, (s, p, step) in self._calls.items() if s == session and (p != page or step not in steps)]
+        for future in stale:
+            future.cancel()
+        return len(stale)
+
+    def heartbeat(self, session):
+        """Gọi mỗi nhịp chờ của trang: session vẫn còn đây (không bị coi là đã rời đi)."""
+        with self._calls_lock:
+            self._seen[session] = time.monotonic()
+
+    def cancel_session(self, session):
+        """Hủy mọi lệnh gọi đang chạy của session (VD: nút Reset)."""
+        with self._calls_lock:
+            futures = [f for f, (s, _, _) in self._calls.items() if s == session]
+        for future in futures:
+            future.cancel()
+        return len(futures)
+
+    def reassign(self, future, session):
+        """Job được mở lại ở session mới (qua URL) -> lệnh gọi thuộc về session mới."""
+        with self._calls_lock:
+            if future in self._calls:
+                self._calls[future][0] = session
+
+    def _track(self, request, future):
+        if request.session is not None:
+            with self._calls_lock:
+                self._calls[future] = [request.session, request.page, request.step]
+                self._seen.setdefault(request.session, time.monotonic())
+            future.add_done_callback(self._untrack)
+        return future
+
+    def _untrack(self, future):
+        with self._calls_lock:
+            self._calls.pop(future, None)
+
+    def _reap_idle_sessions(self):
+        # Đóng tab / mất kết nối hẳn: session không còn chạy script -> hủy lệnh gọi của nó
+        cutoff = time.monotonic() - SESSION_IDLE_SECONDS
+        with self._calls_lock:
+            idle = {s for s, seen in self._seen.items() if seen < cutoff}
+            futures = [f for f, (s, _, _) in self._calls.items() if s in idle]
+            active = {s for s, _, _ in self._calls.values()}
+            for session in idle - active:
+                del self._seen[session]
+        for future in futures:
+            future.cancel()
+        self._loop.call_later(REAP_INTERVAL_SECONDS, self._reap_idle_sessions)
+
+    async def _cancellable(self, request, coro):
+        started = time.monotonic()
+        try:
+            return await coro
+        except asyncio.CancelledError:
+            # Không ai đọc kết quả nữa: đếm vào số liệu kèm thời gian đã chạy (ghi ở luồng khác, không chặn việc hủy)
+            self.cancelled += 1
+            self._loop.run_in_executor(
+                None, self.metrics.record, request.page, request.step, None, 0, time.monotonic() - started, "cancelled"
+            )
+            raise
+
+    def _prepare(self, request):
+        request.submitted_at = time.monotonic()
+        self.prefixes.record(request)
+        if (request.cache or request.coalesce) and request.cache_key is None:
+            request.cache_key = make_cache_key(
+                request.full_contents(), request.model_priority, request.build_config(request.model_priority[0])
+            )
+
+    # ---------- GỘP LỆNH GỌI TRÙNG (SINGLE-FLIGHT) ----------
+    async def _single_flight(self, request, kind, run, sink=None):
+        if not request.coalesce or not request.cache_key:
+            return await run() if sink is None else await run(sink)
+        flight_key = (kind, request.cache_key)
+        flight = self._flights.get(flight_key)
+        leader = flight is None
+        if leader:
+            flight = self._flights[flight_key] = _Flight()
+            flight.task = asyncio.ensure_future(run() if sink is None else run(flight))
+            flight.task.add_done_callback(lambda _: self._end_flight(flight_key, flight))
+        else:
+            self.coalesced += 1
+        if sink is not None:
+            for text in flight.history:
+                sink.put(text)
+            if flight.task.done():
+                sink.put(_DONE)
+            else:
+                flight.sinks.append(sink)
+        flight.waiters += 1
+        try:
+            result = await asyncio.shield(flight.task)
+        except asyncio.CancelledError:
+            # Người chờ bỏ đi; chỉ hủy lệnh gọi khi không còn ai chờ nữa
+            flight.waiters -= 1
+            if sink in flight.sinks:
+                flight.sinks.remove(sink)
+            if flight.waiters == 0:
+                flight.task.cancel()
+            raise
+        flight.waiters -= 1
+        if leader or result is None or result.cached:
+            return result
+        shared = replace(result, coalesced=True)
+        await self._record_metrics(request, shared)
+        return shared
+
+    def _end_flight(self, flight_key, flight):
+        if self._flights.get(flight_key) is flight:
+            del self._flights[flight_key]
+
+    # ---------- CACHE ----------
+    def _cached_result(self, request):
+        if not request.cache or not request.cache_key:
+            return None
+        entry = self.cache.get(request.cache_key)
+        if entry is None:
+            return None
+        return GenerationResult(text=entry["text"], model=entry["model"], api_key="", attempts=0, cached=True)
+
+    async def _store(self, request, result):
+        if not request.cache or not request.cache_key or not result.text:
+            return
+        if request.cache_if is not None and not request.cache_if(result.text):
+            return
+        await asyncio.to_thread(self.cache.put, request.cache_key, result.text, result.model)
+
+    # ---------- LẬP KẾ HOẠCH THỬ (KEY, MODEL) ----------
+    def plan(self, request):
+        """Danh sách (key, model) theo thứ tự sẽ thử.
+
+        Trên mỗi key, model được router sắp lại theo SLO độ trễ của bước rồi lấy tối đa
+        models_per_key model; key được xếp hạng theo sức khỏe của model đứng đầu.
+        """
+        per_key = {}
+        for api_key in self.api_keys:
+            models = self.catalog.resolve(api_key, request.model_priority, fallback=FALLBACK_MODEL)
+            usable = [m for m in models if not self.health.is_open(api_key, m)]
+            if usable:
+                per_key[api_key] = usable
+        per_key = {
+            api_key: models[:request.models_per_key] if request.models_per_key else models
+            for api_key, models in self.router.route(request, per_key).items()
+        }
+        if request.sticky and (request.page or request.step):
+            keys = self._sticky_order(request, per_key)
+        else:
+            keys = [api_key for api_key, _ in self.health.rank([(k, models[0]) for k, models in per_key.items()])]
+        plan = [(api_key, model) for api_key in keys for model in per_key[api_key]]
+        self.router.log(request, plan)
+        return plan
+
+    def _sticky_order(self, request, per_key):
+        """Key theo thứ tự trên vòng băm của loại prompt; key không khỏe dời xuống cuối."""
+        if self._ring.keys != self.api_keys:
+            self._ring = HashRing(self.api_keys)  # Danh sách key đổi theo secrets
+        label = affinity_label(request.page, request.step, request.affinity)
+        walked = [api_key for api_key in self._ring.walk(label) if api_key in per_key]
+        healthy = [api_key for api_key in walked if self.health.is_healthy(api_key, per_key[api_key][0])]
+        keys = healthy + [api_key for api_key in walked if api_key not in healthy]
+        counts = self.sticky.setdefault(label, [0, 0])
+        counts[0 if keys and keys[0] == self._ring.owner(label) else 1] += 1
+        return keys
+
+    def sticky_report(self):
+        """Mỗi loại prompt: key ưu tiên trên vòng băm và số lần phải lùi sang key khác."""
+        return [
+            {"prompt": label, "key": mask_key(self._ring.owner(label) or ""), "preferred": hits, "fallback": misses}
+            for label, (hits, misses) in sorted(self.sticky.items())
+        ]
+
+    async def _next_candidate(self, candidates, tokens, busy_keys=(), max_wait=MAX_QUEUE_WAIT_SECONDS, retry_at=None):
+        """Lấy ra (key, model) kế tiếp được phép gọi NGAY (còn hạn mức + cầu dao cho qua).
+
+        Nếu chỉ còn các cặp đang tạm cạn hạn mức / đang chờ backoff (retry_at) -> ngủ đúng
+        khoảng thời gian ngắn nhất cần chờ rồi thử lại, tổng thời gian chờ không quá max_wait.
+        Không còn gì -> None.
+        """
+        waited = 0.0
+        while candidates:
+            shortest = None
+            now = time.monotonic()
+            for api_key, model in list(candidates):
+                if api_key in busy_keys:
+                    continue
+                not_before = retry_at.get((api_key, model)) if retry_at else None
+                if not_before is not None and not_before > now:
+                    wait = not_before - now
+                    shortest = wait if shortest is None else min(shortest, wait)
+                    continue
+                if self.health.is_open(api_key, model):
+                    candidates.remove((api_key, model))
+                    continue
+                wait = self.limiter.try_acquire(api_key, model, tokens)
+                if wait > 0:
+                    shortest = wait if shortest is None else min(shortest, wait)
+                    continue
+                if not self.health.allow(api_key, model):
+                    self.limiter.refund(api_key, model, tokens)
+                    continue
+                candidates.remove((api_key, model))
+                return api_key, model
+            if shortest is None or waited + shortest > max_wait:
+                return None
+            await asyncio.sleep(shortest)
+            waited += shortest
+        return None
+
+    def _record_failure(self, api_key, model, error, request=None):
+        kind = classify_error(error)
+        if kind == INVALID:
+            return  # Lỗi do chính request, không phải do key/model
+        self.router.record(api_key, model, ok=False)
+        if kind == AUTH:
+            models = request.model_priority if request is not None else [model]
+            for each in models:
+                self.health.record_failure(api_key, each, error, cooldown=PERMANENT_COOLDOWN_SECONDS, trip=True)
+        elif kind == NOT_FOUND:
+            self.health.record_failure(api_key, model, error, cooldown=PERMANENT_COOLDOWN_SECONDS, trip=True)
+            self.catalog.invalidate(api_key)
+        else:
+            self.health.record_failure(api_key, model, error, cooldown=retry_after(error))
+        if kind == QUOTA:
+            self.limiter.exhaust(api_key, model)
+        if request is not None and request.static_prefix and is_cache_not_found(error):
+            self.context_cache.invalidate(api_key, model, request.static_prefix)
+
+    def _reschedule(self, candidates, retry_at, failures, api_key, model, error):
+        """Áp RetryPolicy sau 1 lần thử lỗi: bỏ key / hẹn thử lại (key, model) / dừng hẳn."""
+        pair = (api_key, model)
+        failures[pair] = failures.get(pair, 0) + 1
+        decision = self.retry.decide(error, failures[pair])
+        if decision.drop_key:
+            candidates[:] = [c for c in candidates if c[0] != api_key]
+        elif decision.retry_in is not None and not decision.give_up:
+            candidates.append(pair)
+            retry_at[pair] = time.monotonic() + decision.retry_in
+        return decision
+
+    async def _materialize(self, api_key, model, request, timeout=None):
+        """Nội dung + cấu hình thực sự gửi đi cho (key, model) này."""
+        config = request.build_config(model)
+        update = {}
+        if timeout is not None:
+            # Timeout HTTP của SDK tính bằng mili giây
+            update["http_options"] = types.HttpOptions(timeout=int(timeout * 1000))
+        contents = request.contents
+        if request.static_prefix is not None:
+            name = await self.context_cache.acquire(api_key, model, request.static_prefix)
+            if name is None:
+                contents = request.full_contents()
+            else:
+                update["cached_content"] = name
+        return contents, config.model_copy(update=update) if update else config
+
+    def _record_usage(self, api_key, model, tokens, usage_metadata):
+        actual = getattr(usage_metadata, "prompt_token_count", None) if usage_metadata else None
+        self.limiter.record_usage(api_key, model, tokens, actual)
+
+    async def _record_metrics(self, request, result, attempts=0, started=None, outcome=None):
+        latency = time.monotonic() - started if started is not None and result is None else None
+        await asyncio.to_thread(self.metrics.record, request.page, request.step, result, attempts, latency, outcome)
+
+    @staticmethod
+    def _deadline_at(request, started):
+        budget = request.deadline if request.deadline is not None else DEFAULT_STEP_DEADLINES.get(request.step)
+        return started + budget if budget else None
+
+    @staticmethod
+    def _attempt_timeout(deadline_at):
+        """Timeout cho lần thử kế tiếp (giây), None nếu ngân sách còn lại không đủ để thử."""
+        if deadline_at is None:
+            return MAX_ATTEMPT_SECONDS
+        remaining = deadline_at - time.monotonic()
+        return min(remaining, MAX_ATTEMPT_SECONDS) if remaining >= MIN_ATTEMPT_SECONDS else None
+
+    async def _deadline_exceeded(self, request, attempts, started):
+        await self._record_metrics(request, None, attempts, started, outcome="deadline")
+        return DeadlineExceeded(f"{request.step or 'request'}: hết {time.monotonic() - started:.0f}s ngân sách thời gian")
+
+    # ---------- GỌI THƯỜNG (CÓ FAILOVER) ----------
+    async def _generate(self, request):
+        started = time.monotonic()
+        attempts = 0
+        queue_wait = 0.0
+        deadline_at = self._deadline_at(request, started)
+        candidates = self.plan(request)
+        tokens = estimate_tokens(request.full_contents())
+        retry_at, failures = {}, {}
+        while True:
+            if self._attempt_timeout(deadline_at) is None:
+                raise await self._deadline_exceeded(request, attempts, started)
+            max_wait = MAX_QUEUE_WAIT_SECONDS
+            if deadline_at is not None:
+                max_wait = min(max_wait, deadline_at - time.monotonic() - MIN_ATTEMPT_SECONDS)
+            waiting = time.monotonic()
+            picked = await self._next_candidate(candidates, tokens, max_wait=max_wait, retry_at=retry_at)
+            queue_wait += time.monotonic() - waiting
+            if picked is None:
+                if candidates and self._attempt_timeout(deadline_at) is None:
+                    raise await self._deadline_exceeded(request, attempts, started)
+                await self._record_metrics(request, None, attempts, started)
+                return None
+            api_key, model = picked
+            attempts += 1
+            try:
+                result = await self._call(api_key, model, request, self._attempt_timeout(deadline_at))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self._record_failure(api_key, model, e, request)
+                if self._reschedule(candidates, retry_at, failures, api_key, model, e).give_up:
+                    await self._record_metrics(request, None, attempts, started, outcome=INVALID)
+                    return None
+                continue
+            self._record_usage(api_key, model, tokens, result.usage_metadata)
+            result = await self._continue(request, result, deadline_at)
+            result.attempts = attempts
+            result.latency = time.monotonic() - started
+            result.queue_wait += queue_wait
+            await self._store(request, result)
+            await self._record_metrics(request, result)
+            return result
+
+    async def _call(self, api_key, model, request, timeout=MAX_ATTEMPT_SECONDS):
+        client = self.pool.get(api_key)
+        # Timeout bao cả thời gian chờ slot: lần thử không được vượt ngân sách còn lại
+        async with asyncio.timeout(timeout):
+            contents, config = await self._materialize(api_key, model, request, timeout)
+            queued = time.monotonic()
+            async with self._slots:
+                self.in_flight += 1
+                started = time.monotonic()
+                try:
+                    response = await client.aio.models.generate_content(model=model, contents=contents, config=config)
+                finally:
+                    self.in_flight -= 1
+        self.health.record_success(api_key, model, time.monotonic() - started)
+        self.router.record(api_key, model, time.monotonic() - started)
+        return GenerationResult(
+            text=response.text or "", model=model, api_key=api_key, queue_wait=started - queued,
+            usage_metadata=response.usage_metadata, finish_reason=_finish_reason(response),
+        )
+
+    # ---------- XẾP HÀNG CÔNG BẰNG GIỮA CÁC SESSION ----------
+    async def _admitted(self, request, run, sink=None):
+        # Tra cache đúng 1 lần cho mỗi request (đọc đĩa ở luồng khác, không chặn event loop);
+        # trúng thì trả luôn, không cần chờ lượt
+        cached = await asyncio.to_thread(self._cached_result, request)
+        if cached is not None:
+            if sink is not None:
+                sink.put(cached.text)
+                sink.put(_DONE)
+            await self._record_metrics(request, cached)
+            return cached
+        # Thời gian xếp hàng trừ vào ngân sách của bước: không được cho vào kịp (còn đủ
+        # MIN_ATTEMPT_SECONDS để thử) thì báo hết hạn luôn thay vì chạy khi trang đã bỏ cuộc
+        started = request.submitted_at or time.monotonic()
+        deadline_at = self._deadline_at(request, started)
+        try:
+            if deadline_at is None:
+                ticket = await self.scheduler.acquire(request.session)
+            else:
+                if deadline_at - time.monotonic() < MIN_ATTEMPT_SECONDS:
+                    raise TimeoutError
+                async with asyncio.timeout(deadline_at - MIN_ATTEMPT_SECONDS - time.monotonic()):
+                    ticket = await self.scheduler.acquire(request.session)
+        except TimeoutError:
+            if sink is not None:
+                sink.put(_DONE)
+            raise await self._deadline_exceeded(request, 0, started) from None
+        if deadline_at is not None:
+            request = replace(request, deadline=deadline_at - time.monotonic())  # Phần ngân sách còn lại sau khi chờ
+        try:
+            result = await self._cascade(request, run, sink)
+        finally:
+            self.scheduler.release(ticket)
+        if result is not None:
+            result.queue_wait += ticket.started - ticket.enqueued
+        return result
+
+    def queue_position(self, session):
+        """(vị trí trong hàng, số giây chờ ước tính) của session; None = đang chạy / không chờ."""
+        return self.scheduler.position(session)
+
+    # ---------- CASCADE: MODEL NHẸ TRƯỚC, MODEL MẠNH KHI CẦN ----------
+    async def _cascade(self, request, run, sink=None):
+        cascade = request.cascade
+        if cascade is None:
+            return await (run(request) if sink is None else run(request, sink))
+        started = time.monotonic()
+        budget = request.deadline if request.deadline is not None else DEFAULT_STEP_DEADLINES.get(request.step)
+        try:
+            result = await self._generate(cascade.lite_request(request, budget))
+        except DeadlineExceeded:
+            result = None
+        reason = FAILED if result is None else cascade.check(result.text)
+        self.cascades[reason or "accepted"] = self.cascades.get(reason or "accepted", 0) + 1
+        if reason is None:
+            await self._store(request, result)
+            if sink is not None:
+                sink.put(result.text)
+                sink.put(_DONE)
+            return result
+        # Leo thang: request gốc chạy bình thường với phần ngân sách thời gian còn lại
+        strong = replace(request, cascade=None, deadline=budget - (time.monotonic() - started) if budget else None)
+        result = await (run(strong) if sink is None else run(strong, sink))
+        if result is not None:
+            result.escalated = reason
+        return result
+
+    # ---------- VIẾT TIẾP KHI BỊ CẮT Ở MAX_TOKENS ----------
+    def _needs_continuation(self, request, result):
+        if not is_truncated(result.finish_reason) or result.continuations >= request.max_continuations:
+            return False
+        return request.complete_if is None or not request.complete_if(result.text)
+
+    async def _continue(self, request, result, deadline_at, sink=None):
+        """Bị cắt -> gọi viết tiếp trên cùng (key, model), nối vào result (và sink nếu đang stream).
+
+        Lỗi / hết ngân sách giữa chừng thì dừng và trả về phần đã có (trang xử lý như bản bị cắt).
+        """
+        while self._needs_continuation(request, result):
+            if self._attempt_timeout(deadline_at) is None:
+                break
+            follow = replace(request, contents=continuation_contents(request.contents, result.text))
+            tokens = estimate_tokens([*request.full_contents(), result.text, CONTINUE_PROMPT])
+            max_wait = MAX_QUEUE_WAIT_SECONDS
+            if deadline_at is not None:
+                max_wait = min(max_wait, deadline_at - time.monotonic() - MIN_ATTEMPT_SECONDS)
+            pair = (result.api_key, result.model)
+            if await self._next_candidate([pair], tokens, max_wait=max_wait) is None:
+                break
+            try:
+                more = await self._call(*pair, follow, self._attempt_timeout(deadline_at) or MIN_ATTEMPT_SECONDS)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self._record_failure(*pair, e, request)
+                break
+            self._record_usage(*pair, tokens, more.usage_metadata)
+            text = stitch(result.text, more.text)
+            if sink is not None and len(text) > len(result.text):
+                sink.put(text[len(result.text):])
+            result.text = text
+            result.finish_reason = more.finish_reason
+            result.usage_metadata = merge_usage(result.usage_metadata, more.usage_metadata)
+            result.queue_wait += more.queue_wait
+            result.continuations += 1
+            self.continuations += 1
+        return result
+
+    # ---------- GỌI STREAM (FAILOVER TRƯỚC TOKEN ĐẦU + HEDGING) ----------
+    async def _stream_attempt(self, attempt, request, timeout=MAX_ATTEMPT_SECONDS):
+        timer = asyncio.timeout(timeout)
+        try:
+            async with timer:
+                return await self._stream_once(attempt, request, timeout)
+        except TimeoutError as e:
+            if timer.expired():
+                self._record_failure(attempt.api_key, attempt.model, e, request)
+            raise
+
+    async def _stream_once(self, attempt, request, timeout):
+        client = self.pool.get(attempt.api_key)
+        parts = []
+        finish_reason = None
+        first_token_s = None
+        contents, config = await self._materialize(attempt.api_key, attempt.model, request, timeout)
+        queued = time.monotonic()
+        async with self._slots:
+            self.in_flight += 1
+            started = time.monotonic()
+            attempt.queue_wait += started - queued
+            try:
+                stream = await client.aio.models.generate_content_stream(
+                    model=attempt.model, contents=contents, config=config
+                )
+                async for chunk in stream:
+                    if chunk.usage_metadata is not None:
+                        attempt.usage_metadata = chunk.usage_metadata
+                    if chunk.candidates and chunk.candidates[0].finish_reason:
+                        finish_reason = chunk.candidates[0].finish_reason
+                    text = chunk.text or ""
+                    if not text:
+                        continue
+                    if first_token_s is None:
+                        first_token_s = time.monotonic() - started
+                        attempt.first_token.set()
+                    parts.append(text)
+                    attempt.output_chars += len(text)
+                    if attempt.sink is not None:
+                        attempt.sink.put(text)
+                    else:
+                        attempt.pending.append(text)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self._record_failure(attempt.api_key, attempt.model, e, request)
+                raise
+            finally:
+                self.in_flight -= 1
+        if not parts:
+            error = RuntimeError("Empty response")
+            self.health.record_failure(attempt.api_key, attempt.model, error)
+            raise error
+        self.health.record_success(attempt.api_key, attempt.model, time.monotonic() - started)
+        self.router.record(attempt.api_key, attempt.model, time.monotonic() - started)
+        return GenerationResult(
+            text="".join(parts), model=attempt.model, api_key=attempt.api_key, queue_wait=attempt.queue_wait,
+            first_token_s=first_token_s, usage_metadata=attempt.usage_metadata, finish_reason=finish_reason,
+        )
+
+    async def _stream(self, request, sink):
+        started = time.monotonic()
+        deadline_at = self._deadline_at(request, started)
+        candidates = self.plan(request)
+        tokens = estimate_tokens(request.full_contents())
+        running = {}  # task -> _StreamAttempt
+        retry_at, failures = {}, {}
+        hedged = False
+        attempts = 0
+
+        async def launch(role, max_wait=MAX_QUEUE_WAIT_SECONDS):
+            nonlocal attempts
+            if self._attempt_timeout(deadline_at) is None:
+                return None  # Ngân sách còn lại không đủ cho 1 lần thử nữa
+            if deadline_at is not None:
+                max_wait = min(max_wait, deadline_at - time.monotonic() - MIN_ATTEMPT_SECONDS)
+            busy_keys = {a.api_key for a in running.values()}
+            waiting = time.monotonic()
+            picked = await self._next_candidate(candidates, tokens, busy_keys, max_wait, retry_at)
+            if picked is None:
+                return None
+            attempts += 1
+            attempt = _StreamAttempt(*picked, role)
+            attempt.queue_wait = time.monotonic() - waiting
+            timeout = self._attempt_timeout(deadline_at) or MIN_ATTEMPT_SECONDS
+            running[asyncio.ensure_future(self._stream_attempt(attempt, request, timeout))] = attempt
+            return attempt
+
+        try:
+            await launch("primary")
+            hedge_at = started + request.hedge_delay if request.hedge_delay is not None else None
+
+            # --- GIAI ĐOẠN 1: chờ token đầu tiên từ bất kỳ lần thử nào ---
+            leader = None
+            while running:
+                leader = next((a for a in running.values() if a.first_token.is_set()), None)
+                if leader is not None:
+                    break
+                give_up = False
+                for task in [t for t in running if t.done()]:
+                    attempt = running.pop(task)
+                    error = None if task.cancelled() else task.exception()  # Đã ghi vào bảng sức khỏe
+                    if error is not None and self._reschedule(
+                        candidates, retry_at, failures, attempt.api_key, attempt.model, error
+                    ).give_up:
+                        give_up = True
+                        break
+                    if not running:
+                        await launch(attempt.role)  # Lỗi trước token đầu -> failover / thử lại sau backoff
+                if give_up:
+                    for task in running:
+                        task.cancel()
+                    self.hedge_metrics.record_call(time.monotonic() - started, hedged, None)
+                    await self._record_metrics(request, None, attempts, started, outcome=INVALID)
+                    return None
+                if not running:
+                    break
+                waiters = [asyncio.ensure_future(a.first_token.wait()) for a in running.values()]
+                timeout = None if hedge_at is None else max(0.0, hedge_at - time.monotonic())
+                done, _ = await asyncio.wait(
+                    set(running) | set(waiters), timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+                )
+                for waiter in waiters:
+                    waiter.cancel()
+                if not done and hedge_at is not None:
+                    # Quá hạn mà chưa có token đầu tiên -> bắn lần dự phòng (chỉ 1 lần)
+                    hedge_at = None
+                    # Lần dự phòng không xếp hàng chờ: không có key rảnh thì thôi
+                    if await launch("hedge", max_wait=0) is not None:
+                        hedged = True
+
+            if leader is None:
+                self.hedge_metrics.record_call(time.monotonic() - started, hedged, None)
+                if candidates and self._attempt_timeout(deadline_at) is None:
+                    raise await self._deadline_exceeded(request, attempts, started)
+                await self._record_metrics(request, None, attempts, started)
+                return None
+
+            leader_task = None
+            for task, attempt in running.items():
+                if attempt is leader:
+                    leader_task = task
+                else:
+                    task.cancel()
+                    self.hedge_metrics.record_loser(attempt)
+
+            # --- GIAI ĐOẠN 2: stream tiếp từ bên thắng ---
+            for text in leader.pending:
+                sink.put(text)
+            leader.pending = []
+            leader.sink = sink
+            try:
+                result = await leader_task
+            except TimeoutError as e:
+                if deadline_at is not None and time.monotonic() >= deadline_at - MIN_ATTEMPT_SECONDS:
+                    raise await self._deadline_exceeded(request, attempts, started) from e
+                await self._record_metrics(request, None, attempts, started)
+                raise
+            except Exception:
+                await self._record_metrics(request, None, attempts, started)  # Đứt giữa chừng
+                raise
+            finally:
+                self.hedge_metrics.record_call(time.monotonic() - started, hedged, leader.role)
+            self._record_usage(result.api_key, result.model, tokens, result.usage_metadata)
+            result = await self._continue(request, result, deadline_at, sink)
+            result.attempts = attempts
+            result.latency = time.monotonic() - started
+            result.hedged = hedged
+            result.winner_role = leader.role
+            await self._store(request, result)
+            await self._record_metrics(request, result)
+            return result
+        except asyncio.CancelledError:
+            for task in running:
+                task.cancel()
+            raise
+        finally:
+            sink.put(_DONE)
+
+
+def release_session(session):
+    """Trang không dùng AI (trang chủ, writing...): hủy mọi lệnh gọi còn chạy của session.
+
+    Không tạo gateway nếu tiến trình chưa có (trang đó không cần event loop + key).
+    """
+    if _GATEWAY is not None and session is not None:
+        _GATEWAY.retain(session, None, ())
+
+
+_GATEWAY = None
+_GATEWAY_LOCK = threading.Lock()
+
+
+def get_gateway(api_keys=None, max_concurrency=DEFAULT_MAX_CONCURRENCY, max_per_session=None):
+    """Gateway dùng chung toàn tiến trình; danh sách key + giới hạn mỗi session được cập nhật theo secrets mới nhất."""
+    global _GATEWAY
+    with _GATEWAY_LOCK:
+        if _GATEWAY is None:
+            _GATEWAY = LLMGateway(api_keys or (), max_concurrency=max_concurrency)
+        elif api_keys is not None:
+            _GATEWAY.api_keys = list(api_keys)
+        if max_per_session is not None:
+            _GATEWAY.scheduler.per_session = max_per_session
+    return _GATEWAY
@@ -0,0 +1,181 @@
+import random
+import threading
+import time
+from collections import deque
+
+from ai_core.clients import mask_key
+
+# ==========================================
+# BẢNG SỨC KHỎE KEY/MODEL + CẦU DAO (CIRCUIT BREAKER)
+# ==========================================
+# Mỗi cặp (key, model) có 1 "cầu dao":
+#   - CLOSED    : hoạt động bình thường.
+#   - OPEN      : vừa dính 429/quota hoặc lỗi liên tiếp -> bỏ qua ngay, không thử,
+#                 cho tới khi hết thời gian hạ nhiệt (cooldown).
+#   - HALF_OPEN : hết cooldown -> cho đúng 1 request "thăm dò" đi qua;
+#                 thành công thì đóng cầu dao, thất bại thì mở lại (cooldown dài hơn).
+# Key được xếp hạng theo tỷ lệ thành công và độ trễ gần đây.
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+QUOTA_COOLDOWN_SECONDS = 60
+QUOTA_COOLDOWN_MAX_SECONDS = 15 * 60
+ERROR_COOLDOWN_SECONDS = 30
+PERMANENT_COOLDOWN_SECONDS = 15 * 60  # Key sai / model không tồn tại với key
+FAILURES_TO_OPEN = 3
+PROBE_TIMEOUT_SECONDS = 120
+WINDOW_SIZE = 50
+LATENCY_EWMA_ALPHA = 0.3
+DEFAULT_LATENCY_SECONDS = 15.0
+
+
+def is_quota_error(error):
+    text = str(error).lower()
+    return "429" in text or "quota" in text or "resource_exhausted" in text
+
+
+class _Stats:
+    def __init__(self):
+        self.state = CLOSED
+        self.cooldown_until = 0.0
+        self.consecutive_failures = 0
+        self.quota_strikes = 0
+        self.probe_started = None
+        self.latency_ewma = None
+        self.outcomes = deque(maxlen=WINDOW_SIZE)  # (timestamp, ok)
+        self.last_error = ""
+
+    def success_rate(self):
+        # Làm trơn Laplace: key chưa có dữ liệu vẫn được thử (≈ 0.5 -> 1.0)
+        ok = sum(1 for _, good in self.outcomes if good)
+        return (ok + 1) / (len(self.outcomes) + 1)
+
+
+class HealthRegistry:
+    def __init__(self):
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def _get(self, key, model):
+        stats = self._stats.get((key, model))
+        if stats is None:
+            stats = self._stats.setdefault((key, model), _Stats())
+        return stats
+
+    # ---------- QUYẾT ĐỊNH CÓ ĐƯỢC THỬ HAY KHÔNG ----------
+    def allow(self, key, model):
+        now = time.monotonic()
+        with self._lock:
+            stats = self._get(key, model)
+            if stats.state == CLOSED:
+                return True
+            if stats.state == OPEN:
+                if now < stats.cooldown_until:
+                    return False
+                stats.state = HALF_OPEN
+                stats.probe_started = now
+                return True
+            # HALF_OPEN: chỉ 1 request thăm dò tại một thời điểm
+            if stats.probe_started is None or now - stats.probe_started > PROBE_TIMEOUT_SECONDS:
+                stats.probe_started = now
+                return True
+            return False
+
+    def is_open(self, key, model):
+        stats = self._stats.get((key, model))
+        return stats is not None and stats.state == OPEN and time.monotonic() < stats.cooldown_until
+
+    def is_healthy(self, key, model):
+        """Cầu dao đóng và lần gọi gần nhất không lỗi (dùng để giữ key ưu tiên hay lùi sang key khác)."""
+        stats = self._stats.get((key, model))
+        return stats is None or (stats.state == CLOSED and stats.consecutive_failures == 0)
+
+    def pick_model(self, key, models):
+        """Model đầu tiên (theo thứ tự ưu tiên) mà cầu dao của key còn đóng."""
+        for model in models:
+            if not self.is_open(key, model):
+                return model
+        return None
+
+    def score(self, key, model):
+        # Thời gian kỳ vọng cho 1 lần thành công: độ trễ / tỷ lệ thành công (thấp = tốt)
+        stats = self._stats.get((key, model))
+        if stats is None:
+            return DEFAULT_LATENCY_SECONDS / 0.5
+        latency = stats.latency_ewma if stats.latency_ewma is not None else DEFAULT_LATENCY_SECONDS
+        return latency / stats.success_rate()
+
+    def rank(self, candidates):
+        """Sắp xếp các cặp (key, model) còn dùng được, tốt nhất lên đầu.
+
+        Nhiễu nhỏ giúp các key ngang điểm nhau được chia tải thay vì dồn vào 1 key.
+        """
+        usable = [(k, m) for k, m in candidates if not self.is_open(k, m)]
+        return sorted(usable, key=lambda c: self.score(*c) * random.uniform(0.9, 1.1))
+
+    # ---------- GHI NHẬN KẾT QUẢ ----------
+    def record_success(self, key, model, latency):
+        now = time.monotonic()
+        with self._lock:
+            stats = self._get(key, model)
+            stats.outcomes.append((now, True))
+            stats.consecutive_failures = 0
+            stats.quota_strikes = 0
+            stats.state = CLOSED
+            stats.probe_started = None
+            if stats.latency_ewma is None:
+                stats.latency_ewma = latency
+            else:
+                stats.latency_ewma += LATENCY_EWMA_ALPHA * (latency - stats.latency_ewma)
+
+    def record_failure(self, key, model, error, cooldown=None, trip=False):
+        now = time.monotonic()
+        with self._lock:
+            stats = self._get(key, model)
+            stats.outcomes.append((now, False))
+            stats.consecutive_failures += 1
+            stats.last_error = str(error)[:200]
+            stats.probe_started = None
+            if is_quota_error(error):
+                # Hết quota: mở cầu dao ngay, cooldown tăng gấp đôi mỗi lần dính lại
+                stats.quota_strikes += 1
+                wait = cooldown or min(
+                    QUOTA_COOLDOWN_SECONDS * 2 ** (stats.quota_strikes - 1), QUOTA_COOLDOWN_MAX_SECONDS
+                )
+            elif trip or stats.state == HALF_OPEN or stats.consecutive_failures >= FAILURES_TO_OPEN:
+                wait = cooldown or ERROR_COOLDOWN_SECONDS
+            else:
+                return
+            stats.state = OPEN
+            stats.cooldown_until = now + wait
+
+    def snapshot(self):
+        """Dữ liệu cho bảng debug: mỗi dòng là 1 cặp (key, model)."""
+        now = time.monotonic()
+        rows = []
+        for (key, model), stats in list(self._stats.items()):
+            rows.append({
+                "key": mask_key(key),
+                "model": model,
+                "state": stats.state,
+                "cooldown_left_s": round(max(0.0, stats.cooldown_until - now), 1),
+                "success_rate": round(stats.success_rate(), 2),
+                "latency_s": round(stats.latency_ewma, 2) if stats.latency_ewma is not None else None,
+                "last_error": stats.last_error,
+            })
+        return rows
+
+
+_REGISTRY = None
+_REGISTRY_LOCK = threading.Lock()
+
+
+def get_health_registry():
+    global _REGISTRY
+    if _REGISTRY is None:
+        with _REGISTRY_LOCK:
+            if _REGISTRY is None:
+                _REGISTRY = HealthRegistry()
+    return _REGISTRY
@@ -0,0 +1,76 @@
+import threading
+
+from ai_core.metrics import percentile
+
+# ==========================================
+# HEDGED REQUEST (GỬI DỰ PHÒNG): CẤU HÌNH + SỐ LIỆU
+# ==========================================
+# Lần gọi chính chạy dạng stream. Nếu sau hedge_delay giây mà chưa nhận được
+# token đầu tiên, 1 lần gọi dự phòng được bắn sang KEY KHÁC đang khỏe.
+# Vì chỉ hiển thị được 1 stream cho học sinh, bên nào ra token đầu tiên trước
+# sẽ thắng và được stream tiếp; bên còn lại bị hủy (task bị cancel, đóng kết nối).
+# Cuộc đua được chạy trong LLMGateway (ai_core.gateway); module này giữ số liệu.
+
+DEFAULT_HEDGE_DELAY_SECONDS = 10.0
+
+
+class HedgeMetrics:
+    """Đếm chi phí (request/token thừa) và lợi ích (độ trễ) của hedging."""
+
+    def __init__(self, window=500):
+        self._lock = threading.Lock()
+        self._window = window
+        self.calls = 0
+        self.hedges_fired = 0
+        self.hedge_wins = 0
+        self.primary_wins = 0
+        self.losers_cancelled = 0
+        self.wasted_output_chars = 0
+        self.wasted_tokens = 0
+        self._latencies = []
+        self._hedged_latencies = []
+
+    def record_call(self, latency, hedged, winner_role):
+        with self._lock:
+            self.calls += 1
+            self._latencies = (self._latencies + [latency])[-self._window:]
+            if hedged:
+                self.hedges_fired += 1
+                self._hedged_latencies = (self._hedged_latencies + [latency])[-self._window:]
+            if winner_role == "hedge":
+                self.hedge_wins += 1
+            elif winner_role == "primary":
+                self.primary_wins += 1
+
+    def record_loser(self, attempt):
+        with self._lock:
+            self.losers_cancelled += 1
+            self.wasted_output_chars += attempt.output_chars
+            usage = attempt.usage_metadata
+            if usage is not None:
+                self.wasted_tokens += (getattr(usage, "prompt_token_count", 0) or 0) + (
+                    getattr(usage, "candidates_token_count", 0) or 0
+                )
+
+    def summary(self):
+        with self._lock:
+            return {
+                "calls": self.calls,
+                "hedge_rate": round(self.hedges_fired / self.calls, 3) if self.calls else 0.0,
+                "hedge_wins": self.hedge_wins,
+                "primary_wins": self.primary_wins,
+                "extra_requests": self.hedges_fired,
+                "losers_cancelled": self.losers_cancelled,
+                "wasted_output_chars": self.wasted_output_chars,
+                "wasted_tokens": self.wasted_tokens,
+                "p50_s": percentile(self._latencies, 50),
+                "p99_s": percentile(self._latencies, 99),
+                "hedged_p99_s": percentile(self._hedged_latencies, 99),
+            }
+
+
+_METRICS = HedgeMetrics()
+
+
+def get_hedge_metrics():
+    return _METRICS
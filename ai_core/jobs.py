@@ -0,0 +1,253 @@
+import threading
+import time
+import uuid
+
+from ai_core.gateway import _DONE, get_gateway
+
+# ==========================================
+# JOB NỀN CHO CÁC LỆNH GỌI AI DÀI (CHẤM BÀI, HƯỚNG DẪN)
+# ==========================================
+# Lệnh gọi được gửi vào gateway (event loop riêng) và chạy tới cùng, độc lập với
+# lần chạy script của trang: rerun, mất websocket, điện thoại tắt màn hình...
+# không làm mất kết quả đã trả tiền. Trang chỉ giữ job_id (session state / URL)
+# và hỏi lại (poll) tiến độ + kết quả ở các lần chạy sau.
+#
+# BatchJob: nhiều lệnh gọi (VD: chấm cả lớp) chạy với số lệnh đồng thời giới hạn
+# (để chừa chỗ cho học sinh đang dùng trang), bài nào gateway đã thử hết key mà
+# vẫn lỗi thì được xếp lại cuối hàng và thử lại sau BATCH_RETRY_DELAY_SECONDS.
+
+JOB_TTL_SECONDS = 3600  # Job đã xong được giữ lại 1 giờ để trang kịp nhận kết quả
+POLL_INTERVAL_SECONDS = 0.25
+BATCH_MAX_TRIES = 3
+BATCH_RETRY_DELAY_SECONDS = 20
+
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+QUEUED = "queued"
+
+
+class Job:
+    def __init__(self, kind, meta=None):
+        self.id = uuid.uuid4().hex[:12]
+        self.kind = kind
+        self.meta = meta or {}  # Dữ liệu để dựng lại trang (đề bài, bài làm, ảnh...)
+        self.status = RUNNING
+        self.created = time.time()
+        self.finished = None
+        self.chunks = []  # Text nhận dần (job stream)
+        self.result = None  # GenerationResult | None
+        self.error = None
+        self.future = None
+
+    @property
+    def done(self):
+        return self.status != RUNNING
+
+    @property
+    def text(self):
+        return "".join(self.chunks)
+
+    def put(self, item):
+        # Sink của gateway khi stream
+        if item is not _DONE:
+            self.chunks.append(item)
+
+    def _finish(self, future):
+        if future.cancelled():
+            self.status = CANCELLED
+        elif future.exception() is not None:
+            self.error = future.exception()
+            self.status = FAILED
+        else:
+            self.result = future.result()
+            self.status = DONE if self.result is not None else FAILED
+        self.finished = time.time()
+
+
+class BatchItem:
+    def __init__(self, name, request, meta=None):
+        self.name = name
+        self.request = request
+        self.meta = meta or {}
+        self.status = QUEUED
+        self.tries = 0
+        self.result = None
+        self.future = None
+
+
+class BatchJob:
+    """Nhóm lệnh gọi không stream, tối đa `concurrency` lệnh chạy cùng lúc."""
+
+    def __init__(self, kind, items, gateway, concurrency, max_tries=BATCH_MAX_TRIES,
+                 retry_delay=BATCH_RETRY_DELAY_SECONDS, meta=None):
+        self.id = uuid.uuid4().hex[:12]
+        self.kind = kind
+        self.meta = meta or {}
+        self.items = items
+        self.status = RUNNING if items else DONE
+        self.created = time.time()
+        self.finished = None if items else self.created
+        self.retries = 0
+        self._gateway = gateway
+        self._concurrency = max(1, concurrency)
+        self._max_tries = max_tries
+        self._retry_delay = retry_delay
+        self._queue = list(items)
+        self._running = 0
+        self._waiting = 0  # Bài đang chờ hẹn giờ để thử lại
+        self._lock = threading.Lock()
+
+    @property
+    def done(self):
+        return self.status != RUNNING
+
+    def start(self):
+        self._pump()
+        return self
+
+    def _pump(self):
+        while True:
+            with self._lock:
+                if self.status != RUNNING or not self._queue or self._running >= self._concurrency:
+                    return
+                item = self._queue.pop(0)
+                item.status = RUNNING
+                item.tries += 1
+                self._running += 1
+            item.future = self._gateway.submit(item.request)
+            item.future.add_done_callback(lambda future, item=item: self._item_done(item, future))
+
+    def _item_done(self, item, future):
+        result = None if future.cancelled() or future.exception() is not None else future.result()
+        retry = False
+        with self._lock:
+            self._running -= 1
+            if result is not None:
+                item.result = result
+                item.status = DONE
+            elif self.status == RUNNING and item.tries < self._max_tries:
+                item.status = QUEUED
+                self.retries += 1
+                self._waiting += 1
+                retry = True
+            else:
+                item.status = CANCELLED if self.status == CANCELLED else FAILED
+            if self.status == RUNNING and self._running == 0 and self._waiting == 0 and not self._queue:
+                self.status = DONE
+                self.finished = time.time()
+        if retry:
+            # Gateway đã thử hết key -> chờ hạn mức hồi lại rồi mới xếp hàng lại
+            timer = threading.Timer(self._retry_delay, self._requeue, args=(item,))
+            timer.daemon = True
+            timer.start()
+        self._pump()
+
+    def _requeue(self, item):
+        with self._lock:
+            self._waiting -= 1
+            if self.status != RUNNING:
+                item.status = CANCELLED
+                return
+            self._queue.append(item)
+        self._pump()
+
+    def cancel(self):
+        with self._lock:
+            if self.status != RUNNING:
+                return
+            self.status = CANCELLED
+            self.finished = time.time()
+            for item in self._queue:
+                item.status = CANCELLED
+            self._queue = []
+            running = [i for i in self.items if i.status == RUNNING and i.future is not None]
+        for item in running:
+            item.future.cancel()
+
+    def progress(self):
+        with self._lock:
+            counts = {status: sum(i.status == status for i in self.items) for status in (QUEUED, RUNNING, DONE, FAILED, CANCELLED)}
+        counts["total"] = len(self.items)
+        counts["retries"] = self.retries
+        return counts
+
+
+class JobManager:
+    def __init__(self, gateway=None, ttl=JOB_TTL_SECONDS):
+        self._gateway = gateway
+        self.ttl = ttl
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    @property
+    def gateway(self):
+        return self._gateway or get_gateway()
+
+    def submit(self, request, kind, stream=False, **meta):
+        """Gửi lệnh gọi chạy nền, trả về job_id."""
+        job = Job(kind, meta)
+        with self._lock:
+            self._prune()
+            self._jobs[job.id] = job
+        if stream:
+            job.future = self.gateway.submit_stream(request, job)
+        else:
+            job.future = self.gateway.submit(request)
+        job.future.add_done_callback(job._finish)
+        return job.id
+
+    def submit_batch(self, kind, items, concurrency, **meta):
+        """items: [(tên, GenerationRequest, meta của từng mục)]. Trả về job_id của cả nhóm."""
+        batch = BatchJob(kind, [BatchItem(*item) for item in items], self.gateway, concurrency, meta=meta)
+        with self._lock:
+            self._prune()
+            self._jobs[batch.id] = batch
+        batch.start()
+        return batch.id
+
+    def get(self, job_id):
+        if not job_id:
+            return None
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def wait(self, job_id, timeout=None):
+        """Chờ job xong (hoặc hết timeout); trả về Job (None nếu không còn job này)."""
+        job = self.get(job_id)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while job is not None and not job.done:
+            if deadline is not None and time.monotonic() >= deadline:
+                break
+            time.sleep(POLL_INTERVAL_SECONDS)
+        return job
+
+    def cancel(self, job_id):
+        job = self.get(job_id)
+        if isinstance(job, BatchJob):
+            job.cancel()
+        elif job is not None and job.future is not None:
+            job.future.cancel()
+
+    def _prune(self):
+        now = time.time()
+        for job_id in [j.id for j in self._jobs.values() if j.finished and now - j.finished > self.ttl]:
+            del self._jobs[job_id]
+
+    def stats(self):
+        with self._lock:
+            jobs = list(self._jobs.values())
+        return {status: sum(j.status == status for j in jobs) for status in (RUNNING, DONE, FAILED, CANCELLED)}
+
+
+_MANAGER = None
+_MANAGER_LOCK = threading.Lock()
+
+
+def get_job_manager(**settings):
+    global _MANAGER
+    with _MANAGER_LOCK:
+        if _MANAGER is None:
+            _MANAGER = JobManager(**settings)
+    return _MANAGER
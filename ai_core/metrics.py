@@ -0,0 +1,190 @@
+import os
+import sqlite3
+import threading
+import time
+
+from ai_core.clients import mask_key
+
+# ==========================================
+# SỐ LIỆU TỪNG LỆNH GỌI AI (TOKEN + ĐỘ TRỄ) -> SQLITE CỤC BỘ
+# ==========================================
+# Mỗi lệnh gọi qua gateway (thành công, lấy từ cache hay thất bại) ghi 1 dòng:
+# trang, bước, key (đã che), model, số lần thử, thời gian xếp hàng, thời gian
+# tới token đầu tiên, tổng độ trễ và số token (prompt / output / thinking / cached)
+# lấy từ usage_metadata. Dùng để chỉnh prompt và chọn model khi tải cao.
+# outcome: ok | cached | coalesced | batch | failed | invalid (400) | deadline (hết ngân sách thời gian)
+# | cancelled (người gửi đã reset / đổi bước / rời trang).
+# Ghi lỗi ổ đĩa thì bỏ qua: số liệu không được làm hỏng lệnh gọi AI.
+
+DEFAULT_METRICS_PATH = os.path.join(".cache", "llm_metrics.sqlite3")
+
+_COLUMNS = (
+    "ts", "page", "step", "api_key", "model", "outcome", "attempts", "queue_wait_s", "ttft_s",
+    "latency_s", "prompt_tokens", "output_tokens", "thoughts_tokens", "cached_tokens", "finish_reason", "hedged",
+)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS llm_calls (
+    ts REAL NOT NULL,
+    page TEXT,
+    step TEXT,
+    api_key TEXT,
+    model TEXT,
+    outcome TEXT NOT NULL,
+    attempts INTEGER,
+    queue_wait_s REAL,
+    ttft_s REAL,
+    latency_s REAL,
+    prompt_tokens INTEGER,
+    output_tokens INTEGER,
+    thoughts_tokens INTEGER,
+    cached_tokens INTEGER,
+    finish_reason TEXT,
+    hedged INTEGER
+);
+CREATE INDEX IF NOT EXISTS llm_calls_page_step ON llm_calls (page, step, ts);
+"""
+
+
+def metrics_path(backend="gemini"):
+    # Số liệu đo với backend giả lập ghi ra file riêng
+    return DEFAULT_METRICS_PATH if backend == "gemini" else DEFAULT_METRICS_PATH.replace(".sqlite3", f"_{backend}.sqlite3")
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def usage_counts(usage_metadata):
+    """(prompt, output, thinking, cached) token từ usage_metadata (None nếu không có)."""
+    if usage_metadata is None:
+        return None, None, None, None
+    return tuple(
+        getattr(usage_metadata, field, None)
+        for field in ("prompt_token_count", "candidates_token_count", "thoughts_token_count",
+                      "cached_content_token_count")
+    )
+
+
+class MetricsStore:
+    def __init__(self, path=DEFAULT_METRICS_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def _connect(self):
+        if self._conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.executescript(_SCHEMA)
+        return self._conn
+
+    def record(self, page, step, result=None, attempts=0, latency=None, outcome=None):
+        """Ghi 1 lệnh gọi. result = GenerationResult (None nếu mọi lần thử đều thất bại)."""
+        if result is None:
+            row = (time.time(), page, step, None, None, outcome or "failed", attempts, None, None,
+                   latency, None, None, None, None, None, 0)
+        else:
+            # Kết quả dùng chung (coalesced) không tốn thêm token -> không cộng lại
+            usage = None if result.coalesced else result.usage_metadata
+            prompt, output, thoughts, cached = usage_counts(usage)
+            if outcome is None:
+                outcome = "cached" if result.cached else "coalesced" if result.coalesced else "ok"
+            row = (
+                time.time(), page, step, mask_key(result.api_key) if result.api_key else None, result.model,
+                outcome, result.attempts, result.queue_wait,
+                result.first_token_s, result.latency, prompt, output, thoughts, cached,
+                str(result.finish_reason) if result.finish_reason is not None else None, int(result.hedged),
+            )
+        try:
+            with self._lock:
+                conn = self._connect()
+                conn.execute(f"INSERT INTO llm_calls ({', '.join(_COLUMNS)}) VALUES ({', '.join('?' * len(_COLUMNS))})", row)
+                conn.commit()
+        except (OSError, sqlite3.Error):
+            pass
+
+    def summary(self, since=None):
+        """Tổng hợp theo (trang, bước): số lệnh gọi, số lỗi/cache/gộp/bị hủy, p50/p95 độ trễ, token trung bình."""
+        where, params = ("WHERE ts >= ?", (since,)) if since is not None else ("", ())
+        try:
+            with self._lock:
+                conn = self._connect()
+                groups = conn.execute(f"""
+                    SELECT page, step, COUNT(*),
+                           SUM(outcome IN ('failed', 'invalid', 'deadline')), SUM(outcome = 'cached'), SUM(outcome = 'coalesced'), SUM(outcome = 'cancelled'),
+                           AVG(CASE WHEN outcome = 'ok' THEN attempts END),
+                           AVG(CASE WHEN outcome = 'ok' THEN queue_wait_s END),
+                           AVG(prompt_tokens), AVG(output_tokens), AVG(thoughts_tokens), AVG(cached_tokens),
+                           SUM(COALESCE(prompt_tokens, 0) + COALESCE(output_tokens, 0) + COALESCE(thoughts_tokens, 0))
+                    FROM llm_calls {where}
+                    GROUP BY page, step ORDER BY page, step
+                """, params).fetchall()
+                timings = conn.execute(f"""
+                    SELECT page, step, latency_s, ttft_s FROM llm_calls
+                    {where + ' AND' if where else 'WHERE'} outcome = 'ok'
+                """, params).fetchall()
+        except (OSError, sqlite3.Error):
+            return []
+        latencies, ttfts = {}, {}
+        for page, step, latency, ttft in timings:
+            if latency is not None:
+                latencies.setdefault((page, step), []).append(latency)
+            if ttft is not None:
+                ttfts.setdefault((page, step), []).append(ttft)
+        rows = []
+        for (page, step, calls, failed, cached, coalesced, cancelled, attempts, queue_wait,
+             prompt, output, thoughts, cached_tokens, total_tokens) in groups:
+            lat = latencies.get((page, step), [])
+            ttft = ttfts.get((page, step), [])
+            rows.append({
+                "page": page, "step": step, "calls": calls,
+                "failed": failed or 0, "cached": cached or 0, "coalesced": coalesced or 0, "cancelled": cancelled or 0,
+                "avg_attempts": _round(attempts), "avg_queue_wait_s": _round(queue_wait),
+                "p50_latency_s": _round(percentile(lat, 50)), "p95_latency_s": _round(percentile(lat, 95)),
+                "p50_ttft_s": _round(percentile(ttft, 50)), "p95_ttft_s": _round(percentile(ttft, 95)),
+                "avg_prompt_tokens": _round(prompt, 0), "avg_output_tokens": _round(output, 0),
+                "avg_thoughts_tokens": _round(thoughts, 0), "avg_cached_tokens": _round(cached_tokens, 0),
+                "total_tokens": total_tokens or 0,
+            })
+        return rows
+
+    def by_model(self, since=None):
+        """Tổng hợp theo model: dùng để chọn model khi tải cao."""
+        where, params = ("AND ts >= ?", (since,)) if since is not None else ("", ())
+        try:
+            with self._lock:
+                rows = self._connect().execute(f"""
+                    SELECT model, COUNT(*), AVG(latency_s), AVG(ttft_s), AVG(output_tokens)
+                    FROM llm_calls WHERE outcome = 'ok' {where}
+                    GROUP BY model ORDER BY COUNT(*) DESC
+                """, params).fetchall()
+        except (OSError, sqlite3.Error):
+            return []
+        return [
+            {"model": model, "calls": calls, "avg_latency_s": _round(latency),
+             "avg_ttft_s": _round(ttft), "avg_output_tokens": _round(output, 0)}
+            for model, calls, latency, ttft, output in rows
+        ]
+
+
+def _round(value, digits=2):
+    return None if value is None else round(value, digits)
+
+
+_STORE = None
+_STORE_LOCK = threading.Lock()
+
+
+def get_metrics_store(**settings):
+    global _STORE
+    with _STORE_LOCK:
+        if _STORE is None:
+            _STORE = MetricsStore(**settings)
+    return _STORE
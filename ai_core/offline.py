@@ -0,0 +1,370 @@
+import io
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+from ai_core.gateway import GenerationResult, get_gateway
+
+# ==========================================
+# CHẤM QUA ĐÊM: GEMINI BATCH API + SỔ THEO DÕI CỤC BỘ (SQLITE)
+# ==========================================
+# Bài tập về nhà không cần kết quả trong vài giây: gom nhiều lệnh gọi (chấm bài,
+# phân tích tóm tắt...) thành 1 batch job của Gemini. Batch chạy trên hạn mức
+# riêng, giá rẻ hơn, và không tranh quota với học sinh đang dùng trang.
+# Mọi batch + từng bài được ghi vào sqlite nên khởi động lại server không mất:
+# lần hỏi sau (trang hoặc luồng nền) đọc lại danh sách batch còn đang chạy,
+# hỏi trạng thái và rải kết quả về từng học sinh khi batch xong.
+# Backend giả lập (ai_core.fake_backend) có client.batches để thử toàn bộ luồng này.
+# Request tạo batch inline có giới hạn kích thước (~20MB, ảnh đi kèm dạng base64 ở
+# MỖI bài): submit() ước lượng kích thước từng bài và chia thành nhiều batch nhỏ hơn
+# MAX_INLINE_BATCH_BYTES (mỗi phần 1 dòng trong sổ, meta "part" = "i/n").
+
+DEFAULT_BATCHES_PATH = os.path.join(".cache", "llm_batches.sqlite3")
+POLL_INTERVAL_SECONDS = 5 * 60  # Batch thường mất hàng giờ: hỏi thưa thôi
+MAX_INLINE_BATCH_BYTES = 18 * 1024 * 1024  # Chừa khoảng trống dưới giới hạn 20MB của request inline
+ITEM_OVERHEAD_BYTES = 2048  # Config + khung JSON của mỗi bài
+
+# Trạng thái batch (JobState của SDK)
+PENDING = "JOB_STATE_PENDING"
+RUNNING = "JOB_STATE_RUNNING"
+SUCCEEDED = "JOB_STATE_SUCCEEDED"
+FAILED = "JOB_STATE_FAILED"
+CANCELLED = "JOB_STATE_CANCELLED"
+EXPIRED = "JOB_STATE_EXPIRED"
+TERMINAL_STATES = {SUCCEEDED, FAILED, CANCELLED, EXPIRED}
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS batches (
+    id TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    remote_name TEXT,
+    api_key TEXT,
+    model TEXT,
+    page TEXT,
+    step TEXT,
+    state TEXT NOT NULL,
+    error TEXT,
+    meta TEXT,
+    created REAL NOT NULL,
+    polled REAL,
+    finished REAL
+);
+CREATE TABLE IF NOT EXISTS batch_items (
+    batch_id TEXT NOT NULL,
+    idx INTEGER NOT NULL,
+    name TEXT,
+    meta TEXT,
+    status TEXT NOT NULL,
+    text TEXT,
+    finish_reason TEXT,
+    error TEXT,
+    PRIMARY KEY (batch_id, idx)
+);
+"""
+
+
+def batches_path(backend="gemini"):
+    # Batch của backend giả lập ghi ra file riêng
+    return DEFAULT_BATCHES_PATH if backend == "gemini" else DEFAULT_BATCHES_PATH.replace(".sqlite3", f"_{backend}.sqlite3")
+
+
+def _part_size(part, encoded):
+    """Số byte 1 phần contents chiếm trong request inline (ảnh: bytes đã mã hóa x 4/3 do base64)."""
+    if isinstance(part, str):
+        return len(part.encode("utf-8"))
+    if isinstance(part, (bytes, bytearray)):
+        return len(part) * 4 // 3 + 4
+    if hasattr(part, "save") and hasattr(part, "size"):
+        # Ảnh PIL: mã hóa 1 lần cho mỗi đối tượng (cả lớp dùng chung 1 ảnh đề bài)
+        if id(part) not in encoded:
+            buffer = io.BytesIO()
+            part.save(buffer, format=part.format or "PNG")
+            encoded[id(part)] = len(buffer.getvalue()) * 4 // 3 + 4
+        return encoded[id(part)]
+    return len(repr(part).encode("utf-8"))
+
+
+def _too_large(error):
+    text = str(error).lower()
+    return "413" in text or "too large" in text or "payload size" in text
+
+
+def state_name(state):
+    """JobState (enum của SDK) hoặc chuỗi -> "JOB_STATE_..."."""
+    return getattr(state, "name", None) or str(state).rsplit(".", 1)[-1]
+
+
+class OfflineItem:
+    def __init__(self, name, meta, status, result=None, error=None):
+        self.name = name
+        self.meta = meta
+        self.status = status  # queued | done | failed
+        self.result = result
+        self.error = error
+        self.tries = 1
+
+
+class OfflineBatch:
+    def __init__(self, row, items):
+        (self.id, self.kind, self.remote_name, self.api_key, self.model, self.page, self.step,
+         self.state, self.error, meta, self.created, self.polled, self.finished) = row
+        self.meta = json.loads(meta or "{}")
+        self.items = items
+
+    @property
+    def done(self):
+        return self.state in TERMINAL_STATES
+
+    def progress(self):
+        counts = {status: sum(i.status == status for i in self.items) for status in ("queued", "done", "failed")}
+        counts["total"] = len(self.items)
+        return counts
+
+
+class OfflineBatchManager:
+    def __init__(self, path=DEFAULT_BATCHES_PATH, gateway=None, poll_interval=POLL_INTERVAL_SECONDS):
+        self.path = path
+        self._gateway = gateway
+        self.poll_interval = poll_interval
+        self._lock = threading.Lock()
+        self._conn = None
+        self._poller = None
+
+    @property
+    def gateway(self):
+        return self._gateway or get_gateway()
+
+    def _connect(self):
+        if self._conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.executescript(_SCHEMA)
+        return self._conn
+
+    # ---------- GỬI ----------
+    def submit(self, kind, items, **meta):
+        """items: [(tên, GenerationRequest, meta của từng mục)], cùng model_priority.
+
+        Chia items thành các phần nhỏ hơn MAX_INLINE_BATCH_BYTES (giữ thứ tự), mỗi
+        phần 1 batch. Trả về danh sách id cục bộ của các batch. 1 bài đã vượt giới
+        hạn (VD: ảnh quá nặng) -> ValueError, không tạo batch nào.
+        """
+        if not items:
+            raise ValueError("Batch rỗng")
+        encoded = {}
+        chunks, size = [[]], 0
+        for name, request, item_meta in items:
+            item_size = ITEM_OVERHEAD_BYTES + sum(_part_size(part, encoded) for part in request.full_contents())
+            if item_size > MAX_INLINE_BATCH_BYTES:
+                raise ValueError(
+                    f"Bài \"{name}\" quá lớn để gửi batch (~{item_size / 2**20:.1f}MB, tối đa "
+                    f"{MAX_INLINE_BATCH_BYTES / 2**20:.0f}MB) – hãy dùng ảnh đề bài nhỏ hơn."
+                )
+            if chunks[-1] and size + item_size > MAX_INLINE_BATCH_BYTES:
+                chunks.append([])
+                size = 0
+            chunks[-1].append((name, request, item_meta))
+            size += item_size
+        if len(chunks) == 1:
+            return [self._create(kind, chunks[0], meta)]
+        return [self._create(kind, chunk, {**meta, "part": f"{i}/{len(chunks)}"}) for i, chunk in enumerate(chunks, 1)]
+
+    def _create(self, kind, items, meta):
+        """Chọn (key, model) theo gateway.plan() (key khỏe nhất trước), tạo 1 batch với
+        mọi lệnh gọi gửi kèm (inline) và ghi vào sổ. Trả về id cục bộ của batch."""
+        first = items[0][1]
+        batch_id = uuid.uuid4().hex[:12]
+        plan = self.gateway.plan(first)
+        remote, api_key, model = None, None, None
+        # Không còn (key, model) nào dùng được -> ghi rõ lý do thay vì "None"
+        error = None if plan else "Không có key/model nào dùng được (chưa cấu hình key hoặc mọi key đang hạ nhiệt)"
+        for api_key, model in plan:
+            src = [
+                {"contents": request.full_contents(), "config": request.build_config(model)}
+                for _, request, _ in items
+            ]
+            try:
+                client = self.gateway.pool.get(api_key)
+                remote = client.batches.create(model=model, src=src, config={"display_name": f"{kind}-{batch_id}"})
+                break
+            except Exception as e:
+                if _too_large(e):
+                    # Không phải lỗi của key: key khác cũng từ chối y như vậy
+                    error = f"Batch vượt giới hạn kích thước request ({type(e).__name__}: {e}) – hãy chia lớp thành nhiều file nhỏ hơn."
+                    break
+                error = e
+                self.gateway.health.record_failure(api_key, model, e)
+        state = state_name(remote.state) if remote is not None else FAILED
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            conn.execute(
+                "INSERT INTO batches VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (batch_id, kind, remote.name if remote is not None else None, api_key, model,
+                 first.page, first.step, state, None if remote is not None else str(error),
+                 json.dumps(meta, ensure_ascii=False, default=str), now, now,
+                 None if remote is not None else now),
+            )
+            conn.executemany(
+                "INSERT INTO batch_items (batch_id, idx, name, meta, status) VALUES (?, ?, ?, ?, ?)",
+                [(batch_id, i, name, json.dumps(item_meta or {}, ensure_ascii=False, default=str),
+                  "queued" if remote is not None else "failed")
+                 for i, (name, _, item_meta) in enumerate(items)],
+            )
+            conn.commit()
+        if state == SUCCEEDED:
+            self._collect(batch_id, remote)  # Xong ngay lúc tạo (batch nhỏ / backend giả lập): refresh sẽ bỏ qua
+        return batch_id
+
+    # ---------- THEO DÕI ----------
+    def refresh(self, force=False):
+        """Hỏi trạng thái mọi batch chưa xong (mỗi batch tối đa 1 lần / poll_interval)."""
+        now = time.time()
+        with self._lock:
+            rows = self._connect().execute(
+                f"SELECT id, remote_name, api_key, polled FROM batches WHERE state NOT IN ({', '.join('?' * len(TERMINAL_STATES))})",
+                tuple(TERMINAL_STATES),
+            ).fetchall()
+        for batch_id, remote_name, api_key, polled in rows:
+            if not force and polled is not None and now - polled < self.poll_interval:
+                continue
+            try:
+                self._poll(batch_id, remote_name, api_key, now)
+            except Exception as e:
+                # Phản hồi lạ (sai dạng...) của 1 batch không được làm dừng các batch khác / luồng nền;
+                # ghi lỗi để trang hiện ra, lần sau hỏi lại
+                self._update(batch_id, polled=now, error=f"{type(e).__name__}: {e}")
+
+    def _poll(self, batch_id, remote_name, api_key, now):
+        try:
+            remote = self.gateway.pool.get(api_key).batches.get(name=remote_name)
+        except Exception:
+            self._update(batch_id, polled=now)  # Lỗi mạng: lần sau hỏi lại
+            return
+        state = state_name(remote.state)
+        if state == SUCCEEDED:
+            self._collect(batch_id, remote)
+        elif state in TERMINAL_STATES:
+            error = getattr(remote, "error", None)
+            self._update(batch_id, state=state, polled=now, finished=now, error=str(error) if error else state)
+            with self._lock:
+                conn = self._connect()
+                conn.execute("UPDATE batch_items SET status = 'failed' WHERE batch_id = ? AND status = 'queued'", (batch_id,))
+                conn.commit()
+        else:
+            self._update(batch_id, state=state, polled=now)
+
+    def _collect(self, batch_id, remote):
+        """Batch xong: rải kết quả về từng mục (theo đúng thứ tự đã gửi) + ghi số liệu token."""
+        batch = self.get(batch_id)
+        responses = list(getattr(getattr(remote, "dest", None), "inlined_responses", None) or [])
+        updates = []
+        for idx, item in enumerate(batch.items):
+            inlined = responses[idx] if idx < len(responses) else None
+            response = getattr(inlined, "response", None)
+            error = getattr(inlined, "error", None) if inlined is not None else "missing response"
+            text = getattr(response, "text", None) if response is not None else None
+            if text:
+                candidates = getattr(response, "candidates", None)
+                finish_reason = candidates[0].finish_reason if candidates else None
+                updates.append(("done", text, str(finish_reason) if finish_reason is not None else None, None, batch_id, idx))
+                result = GenerationResult(
+                    text=text, model=batch.model, api_key=batch.api_key, attempts=1,
+                    usage_metadata=getattr(response, "usage_metadata", None), finish_reason=finish_reason,
+                )
+                self.gateway.metrics.record(batch.page, batch.step, result, outcome="batch")
+            else:
+                updates.append(("failed", None, None, str(error or "empty response"), batch_id, idx))
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            conn.executemany(
+                "UPDATE batch_items SET status = ?, text = ?, finish_reason = ?, error = ? WHERE batch_id = ? AND idx = ?",
+                updates,
+            )
+            conn.commit()
+        self._update(batch_id, state=SUCCEEDED, polled=now, finished=now, error=None)
+
+    def _update(self, batch_id, **fields):
+        with self._lock:
+            conn = self._connect()
+            conn.execute(
+                f"UPDATE batches SET {', '.join(f'{k} = ?' for k in fields)} WHERE id = ?",
+                (*fields.values(), batch_id),
+            )
+            conn.commit()
+
+    def start_poller(self):
+        """Luồng nền hỏi trạng thái định kỳ: kết quả về sẵn dù không ai mở trang."""
+        with self._lock:
+            if self._poller is not None:
+                return
+            self._poller = threading.Thread(target=self._poll_forever, name="llm-batch-poller", daemon=True)
+        self._poller.start()
+
+    def _poll_forever(self):
+        while True:
+            try:
+                self.refresh()
+            except Exception:
+                pass  # Luồng nền chết là kết quả qua đêm không bao giờ về nữa: lỗi gì cũng chờ lượt sau
+            time.sleep(self.poll_interval)
+
+    def cancel(self, batch_id):
+        batch = self.get(batch_id)
+        if batch is None or batch.done:
+            return
+        if batch.remote_name:
+            try:
+                self.gateway.pool.get(batch.api_key).batches.cancel(name=batch.remote_name)
+            except Exception:
+                pass
+        now = time.time()
+        self._update(batch_id, state=CANCELLED, polled=now, finished=now)
+
+    # ---------- ĐỌC ----------
+    def get(self, batch_id):
+        if not batch_id:
+            return None
+        with self._lock:
+            conn = self._connect()
+            row = conn.execute("SELECT * FROM batches WHERE id = ?", (batch_id,)).fetchone()
+            if row is None:
+                return None
+            item_rows = conn.execute(
+                "SELECT name, meta, status, text, finish_reason, error FROM batch_items WHERE batch_id = ? ORDER BY idx",
+                (batch_id,),
+            ).fetchall()
+        batch = OfflineBatch(row, [])
+        for name, meta, status, text, finish_reason, error in item_rows:
+            result = None
+            if text is not None:
+                result = GenerationResult(text=text, model=batch.model, api_key=batch.api_key, finish_reason=finish_reason)
+            batch.items.append(OfflineItem(name, json.loads(meta or "{}"), status, result, error))
+        return batch
+
+    def list(self, kind=None, limit=20):
+        """Các batch mới nhất (kèm từng mục), có thể lọc theo loại."""
+        where, params = ("WHERE kind = ?", (kind,)) if kind else ("", ())
+        with self._lock:
+            ids = [row[0] for row in self._connect().execute(
+                f"SELECT id FROM batches {where} ORDER BY created DESC LIMIT ?", (*params, limit)
+            ).fetchall()]
+        return [self.get(batch_id) for batch_id in ids]
+
+
+_MANAGER = None
+_MANAGER_LOCK = threading.Lock()
+
+
+def get_offline_batches(**settings):
+    global _MANAGER
+    with _MANAGER_LOCK:
+        if _MANAGER is None:
+            _MANAGER = OfflineBatchManager(**settings)
+    return _MANAGER
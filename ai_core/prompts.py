@@ -0,0 +1,119 @@
+import re
+import threading
+
+from ai_core.ratelimit import CHARS_PER_TOKEN
+
+# ==========================================
+# BỐ CỤC PROMPT: KHỐI TĨNH TRƯỚC, DỮ LIỆU ĐỘNG SAU (TẬN DỤNG PREFIX CACHE)
+# ==========================================
+# Gemini tự cache phần đầu request trùng byte-với-byte với các request trước
+# (implicit caching: giảm giá token đầu vào + prefill nhanh hơn) khi phần trùng
+# đủ dài (~1024 token với Flash, ~2048 với Pro). Muốn vậy:
+#   - khối hướng dẫn tĩnh luôn đứng ĐẦU và không đổi 1 byte nào giữa các lần gọi
+#     (không chèn đề bài / số từ / bài làm vào giữa);
+#   - dữ liệu động (đề bài, bài làm, văn bản gốc...) và ảnh đứng CUỐI.
+# PromptLayout dựng (static_prefix, contents) theo đúng thứ tự đó cho GenerationRequest;
+# khối tĩnh cũng là thứ được gửi qua context cache tường minh nếu có.
+# PrefixStats đo độ dài tiền tố trùng thực tế giữa các request cùng loại (page/step).
+
+MIN_IMPLICIT_CACHE_TOKENS = 1024
+_PLACEHOLDER = re.compile(r"\{\{([A-Z_]+)\}\}")
+
+
+class PromptLayout:
+    """Khối hướng dẫn tĩnh (bất biến) + khối dữ liệu động có {{CHỖ_TRỐNG}}, luôn đặt ở cuối."""
+
+    def __init__(self, static, dynamic):
+        placeholders = _PLACEHOLDER.findall(static)
+        if placeholders:
+            raise ValueError(f"Khối tĩnh không được chứa dữ liệu động: {', '.join(sorted(set(placeholders)))}")
+        self.static = static
+        self.dynamic = dynamic
+        self.fields = set(_PLACEHOLDER.findall(dynamic))
+
+    def render(self, values, image=None, suffix=""):
+        """-> (static_prefix, contents): contents = [văn bản động (+ suffix), ảnh]."""
+        unknown = self.fields - set(values)
+        if unknown:
+            raise KeyError(f"Thiếu giá trị cho: {', '.join(sorted(unknown))}")
+        text = _PLACEHOLDER.sub(lambda m: str(values[m.group(1)]), self.dynamic) + suffix
+        contents = [text] if text else []
+        if image is not None:
+            contents.append(image)
+        return self.static, contents
+
+
+def _text_prefix(contents):
+    """Phần văn bản đầu request, dừng ở ảnh đầu tiên (ảnh của mỗi học sinh mỗi khác)."""
+    parts = []
+    for part in contents:
+        if not isinstance(part, str):
+            break
+        parts.append(part)
+    return "\x00".join(parts)
+
+
+def _shared_length(a, b):
+    size = min(len(a), len(b))
+    if a[:size] == b[:size]:
+        return size
+    low, high = 0, size  # a[:low] trùng, a[:high] không trùng
+    while high - low > 1:
+        mid = (low + high) // 2
+        if a[:mid] == b[:mid]:
+            low = mid
+        else:
+            high = mid
+    return low
+
+
+class PrefixStats:
+    """Độ dài tiền tố trùng (token ước lượng) giữa các request liên tiếp cùng page/step."""
+
+    def __init__(self):
+        self._last = {}  # (page, step) -> văn bản đầu của request trước
+        self._stats = {}  # (page, step) -> [số request, tổng token trùng, tổng token văn bản, token khối tĩnh]
+        self._lock = threading.Lock()
+
+    def record(self, request):
+        prefix = _text_prefix(request.full_contents())
+        static_tokens = int(len(request.static_prefix or "") / CHARS_PER_TOKEN)
+        key = (request.page, request.step)
+        with self._lock:
+            previous = self._last.get(key)
+            self._last[key] = prefix
+            stats = self._stats.setdefault(key, [0, 0, 0, static_tokens])
+            if previous is None:
+                return
+            stats[0] += 1
+            stats[1] += _shared_length(previous, prefix) / CHARS_PER_TOKEN
+            stats[2] += len(prefix) / CHARS_PER_TOKEN
+            stats[3] = static_tokens
+
+    def report(self):
+        """Mỗi loại request: tiền tố trùng trung bình với request trước và có đủ dài để được cache không."""
+        with self._lock:
+            items = sorted(self._stats.items(), key=lambda item: (str(item[0][0]), str(item[0][1])))
+        rows = []
+        for (page, step), (count, shared, total, static_tokens) in items:
+            avg_shared = round(shared / count) if count else None
+            rows.append({
+                "page": page, "step": step, "compared": count, "static_tokens": static_tokens,
+                "avg_shared_prefix_tokens": avg_shared,
+                "avg_text_tokens": round(total / count) if count else None,
+                "shared_pct": round(100 * shared / total, 1) if total else None,
+                "cacheable": avg_shared is not None and avg_shared >= MIN_IMPLICIT_CACHE_TOKENS,
+            })
+        return rows
+
+
+_STATS = None
+_STATS_LOCK = threading.Lock()
+
+
+def get_prefix_stats():
+    global _STATS
+    with _STATS_LOCK:
+        if _STATS is None:
+            _STATS = PrefixStats()
+    return _STATS
@@ -0,0 +1,158 @@
+import math
+import threading
+import time
+
+from ai_core.clients import mask_key
+
+# ==========================================
+# GIỚI HẠN TỐC ĐỘ THEO KEY + MODEL (TOKEN BUCKET: RPM & TPM)
+# ==========================================
+# Mỗi cặp (key, model) có 2 "xô":
+#   - RPM: số request mỗi phút.
+#   - TPM: số token đầu vào mỗi phút (prompt + ảnh) -> đây là giới hạn hay bị
+#          chạm nhất với GRADING_PROMPT_TEMPLATE rất dài.
+# Xô đầy lại đều theo thời gian. Request chỉ được gửi khi cả 2 xô còn đủ chỗ,
+# nên ta né được các lần gọi "chắc chắn dính 429" thay vì chờ lỗi rồi mới đổi key.
+# Sau khi gọi xong, số token ước lượng được hiệu chỉnh theo usage_metadata thật.
+
+# Hạn mức mặc định (free tier). Ghi đè trong secrets.toml:
+# [RATE_LIMITS."gemini-2.5-flash"]
+# rpm = 1000
+# tpm = 1000000
+DEFAULT_LIMITS = {
+    "gemini-2.5-pro": {"rpm": 5, "tpm": 250_000},
+    "gemini-2.5-flash": {"rpm": 10, "tpm": 250_000},
+    "gemini-2.5-flash-lite": {"rpm": 15, "tpm": 250_000},
+    "gemini-2.0-flash": {"rpm": 15, "tpm": 1_000_000},
+    "gemini-1.5-pro": {"rpm": 2, "tpm": 32_000},
+    "gemini-1.5-flash": {"rpm": 15, "tpm": 1_000_000},
+}
+
+CHARS_PER_TOKEN = 3.0  # Tiếng Việt có dấu tốn token hơn tiếng Anh (~4 ký tự/token)
+IMAGE_TILE_PX = 768
+TOKENS_PER_IMAGE_TILE = 258
+
+
+def estimate_image_tokens(image):
+    size = getattr(image, "size", None)
+    if not size or not isinstance(size, tuple):
+        return TOKENS_PER_IMAGE_TILE
+    width, height = size
+    if width <= 384 and height <= 384:
+        return TOKENS_PER_IMAGE_TILE
+    return math.ceil(width / IMAGE_TILE_PX) * math.ceil(height / IMAGE_TILE_PX) * TOKENS_PER_IMAGE_TILE
+
+
+def estimate_tokens(contents):
+    """Ước lượng token đầu vào của 1 request (văn bản + ảnh)."""
+    total = 0
+    for part in contents:
+        if isinstance(part, str):
+            total += math.ceil(len(part) / CHARS_PER_TOKEN)
+        elif part is not None:
+            total += estimate_image_tokens(part)
+    return total
+
+
+class TokenBucket:
+    def __init__(self, capacity, period=60.0):
+        self.capacity = float(capacity)
+        self.rate = self.capacity / period
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount, now):
+        """Số giây cần chờ để đủ `amount` (inf nếu vượt quá sức chứa của xô)."""
+        self._refill(now)
+        if amount > self.capacity:
+            return math.inf
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+
+class RateLimiter:
+    def __init__(self, limits=None):
+        self.limits = {**DEFAULT_LIMITS, **(limits or {})}
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def _get(self, api_key, model):
+        buckets = self._buckets.get((api_key, model))
+        if buckets is None:
+            limit = self.limits.get(model)
+            if not limit:
+                return None  # Model chưa khai báo hạn mức -> không giới hạn
+            buckets = (TokenBucket(limit["rpm"]), TokenBucket(limit["tpm"]))
+            self._buckets[(api_key, model)] = buckets
+        return buckets
+
+    def try_acquire(self, api_key, model, tokens):
+        """Nhận request ngay nếu còn hạn mức (trả 0.0), ngược lại trả số giây nên chờ."""
+        with self._lock:
+            buckets = self._get(api_key, model)
+            if buckets is None:
+                return 0.0
+            rpm, tpm = buckets
+            now = time.monotonic()
+            wait = max(rpm.wait_time(1, now), tpm.wait_time(tokens, now))
+            if wait == 0.0:
+                rpm.tokens -= 1
+                tpm.tokens -= tokens
+            return wait
+
+    def refund(self, api_key, model, tokens):
+        with self._lock:
+            buckets = self._buckets.get((api_key, model))
+            if buckets:
+                rpm, tpm = buckets
+                rpm.tokens = min(rpm.capacity, rpm.tokens + 1)
+                tpm.tokens = min(tpm.capacity, tpm.tokens + tokens)
+
+    def record_usage(self, api_key, model, estimated, actual):
+        # Hiệu chỉnh theo số token thật từ usage_metadata (có thể âm -> trả lại hạn mức)
+        if actual is None:
+            return
+        with self._lock:
+            buckets = self._buckets.get((api_key, model))
+            if buckets:
+                buckets[1].tokens = min(buckets[1].capacity, buckets[1].tokens - (actual - estimated))
+
+    def exhaust(self, api_key, model):
+        # Server báo 429 dù ta tính còn hạn mức -> đồng bộ lại: coi như xô đã cạn
+        with self._lock:
+            buckets = self._buckets.get((api_key, model))
+            if buckets:
+                for bucket in buckets:
+                    bucket.tokens = min(bucket.tokens, 0.0)
+
+    def snapshot(self):
+        now = time.monotonic()
+        rows = []
+        with self._lock:
+            for (api_key, model), (rpm, tpm) in self._buckets.items():
+                rpm._refill(now)
+                tpm._refill(now)
+                rows.append({
+                    "key": mask_key(api_key), "model": model,
+                    "rpm_left": round(rpm.tokens, 1), "tpm_left": int(tpm.tokens),
+                })
+        return rows
+
+
+_LIMITER = None
+_LIMITER_LOCK = threading.Lock()
+
+
+def get_rate_limiter(limits=None):
+    global _LIMITER
+    with _LIMITER_LOCK:
+        if _LIMITER is None:
+            _LIMITER = RateLimiter(limits)
+        elif limits:
+            _LIMITER.limits.update(limits)
+    return _LIMITER
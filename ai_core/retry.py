@@ -0,0 +1,125 @@
+import asyncio
+import random
+import re
+from dataclasses import dataclass
+
+# ==========================================
+# CHÍNH SÁCH THỬ LẠI THEO LOẠI LỖI (BACKOFF LŨY THỪA + JITTER + RETRY-AFTER)
+# ==========================================
+# Mỗi lỗi được phân loại trước khi quyết định làm gì tiếp:
+#   - quota     (429 / RESOURCE_EXHAUSTED): key này tạm hết hạn mức -> đổi key ngay,
+#                 cầu dao của key nghỉ đúng khoảng server gợi ý (retryDelay / Retry-After).
+#   - transient (500, 502, 503, UNAVAILABLE, lỗi kết nối) và timeout: có thể thử lại
+#                 chính (key, model) đó sau backoff lũy thừa có jitter; trong lúc chờ,
+#                 key khác vẫn được thử ngay.
+#   - auth      (401, 403, API key sai): bỏ cả key khỏi lượt gọi này.
+#   - not_found (404, model không có với key này): bỏ (key, model) này.
+#   - invalid   (400, prompt/cấu hình sai): đổi key cũng vô ích -> dừng ngay, không đốt key.
+
+QUOTA = "quota"
+TRANSIENT = "transient"
+TIMEOUT = "timeout"
+AUTH = "auth"
+NOT_FOUND = "not_found"
+INVALID = "invalid"
+
+RETRYABLE = {QUOTA, TRANSIENT, TIMEOUT}
+
+_STATUS_BY_NAME = {
+    "RESOURCE_EXHAUSTED": 429, "UNAVAILABLE": 503, "INTERNAL": 500, "DEADLINE_EXCEEDED": 504,
+    "INVALID_ARGUMENT": 400, "FAILED_PRECONDITION": 400, "UNAUTHENTICATED": 401,
+    "PERMISSION_DENIED": 403, "NOT_FOUND": 404,
+}
+_LEADING_CODE = re.compile(r"^\s*(\d{3})\b")
+_RETRY_DELAY = re.compile(r"retry[_ ]?delay['\"]?\s*[:=]\s*['\"]?(\d+(?:\.\d+)?)s", re.IGNORECASE)
+
+
+def status_code(error):
+    """Mã HTTP của lỗi SDK (google.genai.errors.APIError có .code), hoặc đoán từ thông điệp."""
+    code = getattr(error, "code", None)
+    if isinstance(code, int):
+        return code
+    text = str(error)
+    match = _LEADING_CODE.match(text)
+    if match:
+        return int(match.group(1))
+    for name, value in _STATUS_BY_NAME.items():
+        if name in text:
+            return value
+    return None
+
+
+def classify_error(error):
+    if isinstance(error, (asyncio.TimeoutError, TimeoutError)) or "timeout" in type(error).__name__.lower():
+        return TIMEOUT
+    code = status_code(error)
+    text = str(error).lower()
+    if code == 429 or "quota" in text or "resource_exhausted" in text:
+        return QUOTA
+    if code in (401, 403) or "api key not valid" in text or "api_key_invalid" in text:
+        return AUTH
+    if code == 404 and "cachedcontent" in text.replace(" ", ""):
+        return TRANSIENT  # Context cache đã bị xóa phía server: tạo lại rồi thử lại ngay
+    if code == 404:
+        return NOT_FOUND
+    if code == 504 or "deadline" in text:
+        return TIMEOUT
+    if code in (400, 413, 422):
+        return INVALID
+    # 5xx, lỗi kết nối, phản hồi rỗng... -> coi là tạm thời
+    return TRANSIENT
+
+
+def retry_after(error):
+    """Số giây server gợi ý chờ (RetryInfo.retryDelay hoặc header Retry-After), None nếu không có."""
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if headers:
+        value = headers.get("retry-after")
+        if value:
+            try:
+                return max(0.0, float(value))
+            except ValueError:
+                pass  # Dạng ngày giờ HTTP: bỏ qua, dùng backoff
+    for source in (getattr(error, "details", None), error):
+        match = _RETRY_DELAY.search(str(source)) if source is not None else None
+        if match:
+            return float(match.group(1))
+    return None
+
+
+@dataclass
+class RetryDecision:
+    kind: str
+    give_up: bool = False  # Dừng cả lượt gọi
+    drop_key: bool = False  # Bỏ mọi model của key này
+    retry_in: float = None  # Thử lại chính (key, model) sau số giây này (None = không thử lại)
+    hint: float = None  # Retry-After / retryDelay từ server
+
+
+class RetryPolicy:
+    def __init__(self, base_delay=0.5, max_delay=20.0, multiplier=2.0, max_retries_per_pair=2):
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.multiplier = multiplier
+        self.max_retries_per_pair = max_retries_per_pair
+
+    def backoff(self, retry_index, hint=None):
+        """Full jitter: ngẫu nhiên trong [0, base * multiplier^n], không quá max_delay; ưu tiên gợi ý của server."""
+        if hint is not None:
+            return min(hint, self.max_delay)
+        ceiling = min(self.max_delay, self.base_delay * self.multiplier ** retry_index)
+        return random.uniform(0, ceiling)
+
+    def decide(self, error, failures_on_pair):
+        """failures_on_pair: số lần (key, model) này đã lỗi trong lượt gọi hiện tại (kể cả lần này)."""
+        kind = classify_error(error)
+        hint = retry_after(error)
+        if kind == INVALID:
+            return RetryDecision(kind, give_up=True)
+        if kind == AUTH:
+            return RetryDecision(kind, drop_key=True)
+        if kind in (TRANSIENT, TIMEOUT) and failures_on_pair <= self.max_retries_per_pair:
+            return RetryDecision(kind, retry_in=self.backoff(failures_on_pair - 1, hint), hint=hint)
+        # quota / not_found / hết lượt thử lại: chuyển sang cặp (key, model) khác
+        return RetryDecision(kind, hint=hint)
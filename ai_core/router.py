@@ -0,0 +1,192 @@
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass, field
+
+from ai_core.metrics import percentile
+
+# ==========================================
+# ĐỊNH TUYẾN MODEL THEO ĐỘ TRỄ THỰC TẾ (ROLLING p95 + SLO THEO BƯỚC)
+# ==========================================
+# Mỗi cặp (model, key) giữ các lần gọi gần đây (trong window_seconds): độ trễ
+# của lần thành công và số lần lỗi. Khi lập kế hoạch gọi, model_priority của
+# request (nặng -> nhẹ) được sắp lại cho từng key:
+#   - model có p95 <= SLO của bước và tỷ lệ lỗi chấp nhận được: giữ thứ tự ưu tiên;
+#   - model đang chậm / lỗi nhiều: dời xuống cuối (vẫn là phương án cuối cùng).
+# Chưa đủ mẫu của riêng key thì dùng số liệu gộp mọi key của model đó; chưa có
+# gì thì coi là đạt. Mẫu cũ hết hạn theo cửa sổ thời gian nên model bị dời xuống
+# sẽ tự được thử lại khi hết giờ cao điểm.
+# Mỗi quyết định được ghi lại (decisions()) để xem vì sao model nào được chọn.
+
+# Thang model dùng chung cho mọi trang: chất lượng cao -> nhẹ/nhanh
+MODEL_TIERS = (
+    "gemini-2.5-pro",
+    "gemini-1.5-pro",
+    "gemini-2.5-flash",
+    "gemini-2.5-flash-lite",
+    "gemini-2.0-flash",
+    "gemini-1.5-flash",
+)
+
+# SLO p95 (giây) cho cả lệnh gọi, theo bước ("page/step" được ưu tiên hơn "step")
+DEFAULT_STEP_SLOS = {
+    "guide": 45.0,
+    "grading": 90.0,
+    "analysis": 60.0,
+}
+
+WINDOW_SECONDS = 10 * 60
+MIN_SAMPLES = 5
+MAX_ERROR_RATE = 0.5
+DECISION_LOG_SIZE = 200
+
+OK = "ok"
+SLOW = "slow"
+FAILING = "failing"
+UNKNOWN = "unknown"
+
+
+def model_ladder(preferred, tiers=MODEL_TIERS):
+    """model_priority bắt đầu từ model mong muốn rồi lùi dần về các model nhẹ hơn."""
+    if preferred not in tiers:
+        return [preferred, *tiers]
+    return list(tiers[tiers.index(preferred):])
+
+
+@dataclass
+class RouteDecision:
+    ts: float
+    page: str
+    step: str
+    slo: float
+    chosen: str  # Model của key đứng đầu kế hoạch
+    preferred: str
+    models: dict = field(default_factory=dict)  # model -> {verdict, p95, error_rate, samples}
+
+    @property
+    def degraded(self):
+        return self.chosen is not None and self.chosen != self.preferred
+
+
+class LatencyRouter:
+    def __init__(self, slos=None, window_seconds=WINDOW_SECONDS, min_samples=MIN_SAMPLES, max_error_rate=MAX_ERROR_RATE):
+        self.slos = {**DEFAULT_STEP_SLOS, **(slos or {})}
+        self.window_seconds = window_seconds
+        self.min_samples = min_samples
+        self.max_error_rate = max_error_rate
+        self._samples = {}  # (model, key) -> deque[(ts, latency | None)], None = lỗi
+        self._decisions = deque(maxlen=DECISION_LOG_SIZE)
+        self._lock = threading.Lock()
+
+    def slo_for(self, page, step):
+        return self.slos.get(f"{page}/{step}", self.slos.get(step))
+
+    # ---------- GHI NHẬN ----------
+    def record(self, api_key, model, latency=None, ok=True):
+        with self._lock:
+            samples = self._samples.get((model, api_key))
+            if samples is None:
+                samples = self._samples[(model, api_key)] = deque(maxlen=500)
+            samples.append((time.monotonic(), latency if ok else None))
+
+    def _recent(self, model, api_key=None):
+        cutoff = time.monotonic() - self.window_seconds
+        if api_key is not None:
+            pools = [self._samples.get((model, api_key), ())]
+        else:
+            pools = [samples for (m, _), samples in self._samples.items() if m == model]
+        return [value for samples in pools for ts, value in samples if ts >= cutoff]
+
+    def stats(self, model, api_key=None):
+        """(p95 độ trễ, tỷ lệ lỗi, số mẫu) trong cửa sổ gần đây."""
+        with self._lock:
+            recent = self._recent(model, api_key)
+        if not recent:
+            return None, None, 0
+        latencies = [value for value in recent if value is not None]
+        return percentile(latencies, 95), 1 - len(latencies) / len(recent), len(recent)
+
+    def verdict(self, model, slo, api_key=None):
+        p95, error_rate, samples = self.stats(model, api_key)
+        if api_key is not None and samples < self.min_samples:
+            # Key này chưa đủ mẫu -> dùng số liệu gộp mọi key
+            p95, error_rate, samples = self.stats(model)
+        if samples < self.min_samples:
+            return UNKNOWN, p95, error_rate, samples
+        if error_rate > self.max_error_rate:
+            return FAILING, p95, error_rate, samples
+        if p95 is not None and slo is not None and p95 > slo:
+            return SLOW, p95, error_rate, samples
+        return OK, p95, error_rate, samples
+
+    # ---------- ĐỊNH TUYẾN ----------
+    def order(self, api_key, models, slo):
+        """Sắp lại models của 1 key: đạt SLO (giữ thứ tự ưu tiên) trước, chậm/lỗi sau."""
+        if slo is None:
+            return list(models)
+        good, bad = [], []
+        for model in models:
+            verdict = self.verdict(model, slo, api_key)[0]
+            (good if verdict in (OK, UNKNOWN) else bad).append(model)
+        return good + bad
+
+    def route(self, request, per_key):
+        """per_key: {key: [model theo ưu tiên]} -> cùng dạng, đã sắp lại theo SLO của bước."""
+        slo = self.slo_for(request.page, request.step)
+        if slo is None:
+            return per_key
+        return {api_key: self.order(api_key, models, slo) for api_key, models in per_key.items()}
+
+    def log(self, request, plan):
+        slo = self.slo_for(request.page, request.step)
+        if slo is None:
+            return None
+        models = {}
+        for model in request.model_priority:
+            verdict, p95, error_rate, samples = self.verdict(model, slo)
+            models[model] = {
+                "verdict": verdict, "p95_s": None if p95 is None else round(p95, 2),
+                "error_rate": None if error_rate is None else round(error_rate, 2), "samples": samples,
+            }
+        decision = RouteDecision(
+            ts=time.time(), page=request.page, step=request.step, slo=slo,
+            chosen=plan[0][1] if plan else None, preferred=request.model_priority[0], models=models,
+        )
+        with self._lock:
+            self._decisions.append(decision)
+        return decision
+
+    # ---------- XEM LẠI ----------
+    def decisions(self, limit=50):
+        with self._lock:
+            recent = list(self._decisions)[-limit:]
+        return [
+            {"ts": time.strftime("%H:%M:%S", time.localtime(d.ts)), "page": d.page, "step": d.step, "slo_s": d.slo,
+             "preferred": d.preferred, "chosen": d.chosen, "degraded": d.degraded,
+             "verdicts": ", ".join(f"{m}={info['verdict']}" for m, info in d.models.items())}
+            for d in reversed(recent)
+        ]
+
+    def snapshot(self):
+        """p95 / tỷ lệ lỗi hiện tại của từng model (gộp mọi key)."""
+        with self._lock:
+            models = sorted({model for model, _ in self._samples})
+        rows = []
+        for model in models:
+            p95, error_rate, samples = self.stats(model)
+            if samples:
+                rows.append({"model": model, "p95_s": round(p95, 2) if p95 is not None else None,
+                             "error_rate": round(error_rate, 2), "samples": samples})
+        return rows
+
+
+_ROUTER = None
+_ROUTER_LOCK = threading.Lock()
+
+
+def get_latency_router(**settings):
+    global _ROUTER
+    with _ROUTER_LOCK:
+        if _ROUTER is None:
+            _ROUTER = LatencyRouter(**settings)
+    return _ROUTER
@@ -0,0 +1,157 @@
+import json
+from dataclasses import dataclass, field
+
+# ==========================================
+# CỨU JSON BỊ CẮT GIỮA CHỪNG (PARTIAL-JSON SALVAGE)
+# ==========================================
+# JSON chấm bài / phân tích bị cắt (hết token, đứt stream...) thì json.loads hỏng
+# cả khối, trang hiện 0 lỗi và điểm "-". Thay vào đó: quét 1 lượt, ghi lại các
+# điểm cắt an toàn (ngay sau 1 giá trị đã hoàn chỉnh), rồi cắt tại điểm muộn nhất
+# và tự đóng các ngoặc còn mở. Kết quả:
+#   - mọi object đã đủ trong mảng (errors, details_to_omit, grammar_spelling_errors...)
+#     được giữ; object đang viết dở ở cuối mảng bị bỏ (không hiện lỗi nửa vời);
+#   - các trường điểm đã ghi xong được giữ;
+#   - missing = các trường mong đợi chưa có -> chỉ cần xin lại đúng phần đó.
+
+_CLOSERS = {"{": "}", "[": "]"}
+
+
+@dataclass
+class SalvagedJSON:
+    data: dict = field(default_factory=dict)
+    missing: list = field(default_factory=list)  # Trường mong đợi (dạng "a.b") chưa có trong data
+    truncated: list = field(default_factory=list)  # Object/mảng bị đóng hộ (VD: "errors" mất phần cuối)
+    cut: bool = False  # Khối JSON bị cắt (thiếu ngoặc đóng), data là phần cứu được
+
+    @property
+    def complete(self):
+        return not self.missing and not self.cut
+
+
+def _has_path(data, path):
+    for key in path.split("."):
+        if not isinstance(data, dict) or key not in data:
+            return False
+        data = data[key]
+    return True
+
+
+def missing_fields(data, expected):
+    """Các trường trong expected (dạng "a.b") chưa có trong data."""
+    return [path for path in expected if not _has_path(data, path)]
+
+
+def _scan(text, start):
+    """Các điểm cắt an toàn: (vị trí, chuỗi ngoặc cần đóng, các đường dẫn đang mở). None = JSON đã đóng đủ."""
+    stack = []  # [ngoặc mở, đường dẫn, key vừa đọc]
+    cuts = []
+    in_string = escaped = False
+    string_start = None
+    expecting_key = False
+
+    def mark(pos):
+        # Không cắt bên trong 1 phần tử (object) của mảng: phần tử dở dang bị bỏ cả
+        if any(outer[0] == "[" and inner[0] == "{" for outer, inner in zip(stack, stack[1:])):
+            return
+        closers = "".join(_CLOSERS[entry[0]] for entry in reversed(stack))
+        cuts.append((pos, closers, [entry[1] for entry in stack[1:] if entry[1]]))
+
+    for pos in range(start, len(text)):
+        char = text[pos]
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == '"':
+                in_string = False
+                if stack and stack[-1][0] == "{" and expecting_key:
+                    stack[-1][2] = text[string_start + 1:pos]
+                elif stack:
+                    mark(pos + 1)
+            continue
+        if char == '"':
+            in_string, string_start = True, pos
+        elif char in "{[":
+            parent = stack[-1] if stack else None
+            if parent is None:
+                path = ""
+            elif parent[0] == "{":
+                path = f"{parent[1]}.{parent[2]}" if parent[1] else parent[2]
+            else:
+                path = parent[1]
+            stack.append([char, path, None])
+            expecting_key = char == "{"
+            mark(pos + 1)
+        elif char in "}]":
+            if not stack:
+                break
+            stack.pop()
+            if not stack:
+                return None
+            expecting_key = False
+            mark(pos + 1)
+        elif char == ":":
+            expecting_key = False
+        elif char == ",":
+            expecting_key = bool(stack) and stack[-1][0] == "{"
+            mark(pos)
+        elif char in "0123456789elun" and stack:
+            # Số / true / false / null đã ghi xong khi ký tự kế tiếp là dấu phân cách
+            following = text[pos + 1:pos + 2]
+            if following and following in ",}] \n\r\t":
+                mark(pos + 1)
+    return cuts
+
+
+def salvage_json(text, expected=()):
+    """Parse khối JSON đầu tiên trong text; bị cắt thì giữ mọi phần đã hoàn chỉnh.
+
+    expected: các trường cần có (lồng nhau viết "original_score.overall") để báo missing.
+    """
+    start = (text or "").find("{")
+    result = SalvagedJSON()
+    if start < 0:
+        result.missing = list(expected)
+        return result
+    cuts = _scan(text, start)
+    if cuts is None:
+        # Đã đóng đủ ngoặc: parse bình thường (lỗi cú pháp khác thì để bên gọi tự xử lý)
+        end = text.rfind("}")
+        try:
+            result.data = json.loads(text[start:end + 1], strict=False)
+        except json.JSONDecodeError:
+            result.data = {}
+    else:
+        result.cut = True
+        for pos, closers, open_paths in reversed(cuts):
+            try:
+                result.data = json.loads(text[start:pos].rstrip().rstrip(",") + closers, strict=False)
+            except json.JSONDecodeError:
+                continue
+            result.truncated = open_paths
+            break
+    if not isinstance(result.data, dict):
+        result.data = {}
+    result.missing = missing_fields(result.data, expected)
+    return result
+
+
+def missing_fields_prompt(missing):
+    """Câu lệnh xin lại đúng các trường còn thiếu (nối sau prompt gốc)."""
+    return (
+        "\n\nIMPORTANT: A previous answer was cut off. Return ONLY a JSON object containing these fields "
+        "(dotted names are nested fields, e.g. original_score.overall -> {\"original_score\": {\"overall\": ...}}), "
+        "following exactly the format described above, with no other text: " + ", ".join(missing)
+    )
+
+
+def merge_json(base, extra):
+    """Gộp phần xin bổ sung vào kết quả đã cứu (object lồng nhau được gộp từng trường)."""
+    merged = dict(base)
+    for key, value in (extra or {}).items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = merge_json(merged[key], value)
+        elif key not in merged:
+            merged[key] = value
+    return merged
@@ -0,0 +1,128 @@
+import asyncio
+import itertools
+import threading
+import time
+
+# ==========================================
+# XẾP HÀNG CÔNG BẰNG THEO SESSION (WEIGHTED FAIR QUEUING)
+# ==========================================
+# Trước gateway: mỗi lệnh gọi phải được "cho vào" trước khi chạy.
+#   - Tối đa capacity lệnh gọi chạy cùng lúc trên toàn server.
+#   - Mỗi session chạy tối đa per_session lệnh gọi cùng lúc; bấm thêm thì phải xếp hàng
+#     sau chính mình, không chiếm chỗ của học sinh khác.
+#   - Hàng chờ xếp theo nhãn thời gian ảo (WFQ): lệnh gọi mới của session nhận nhãn
+#     max(thời gian ảo hiện tại, nhãn cuối của session) + 1 / weight. Session gửi dồn dập
+#     thì nhãn tăng nhanh -> bị xếp sau các session khác, dù gửi trước.
+# Việc nền không gắn session (chấm cả lớp) chung 1 hàng chờ WFQ nhưng KHÔNG bị giới hạn
+# per_session: mỗi BatchJob đã tự giới hạn số bài chạy cùng lúc (BATCH_CONCURRENCY).
+# Trang hỏi position(session) để hiện vị trí trong hàng + thời gian chờ ước tính.
+
+PER_SESSION_IN_FLIGHT = 2
+SERVICE_EWMA_ALPHA = 0.2
+DEFAULT_SERVICE_SECONDS = 20.0  # Ước lượng thời gian 1 lệnh gọi khi chưa có số liệu
+
+
+class _Ticket:
+    def __init__(self, session, start, tag, seq, future):
+        self.session = session
+        self.start = start  # Nhãn bắt đầu (thời gian ảo lúc vào hàng)
+        self.tag = tag  # Nhãn kết thúc = start + 1 / weight, hàng chờ xếp theo nhãn này
+        self.seq = seq
+        self.future = future
+        self.enqueued = time.monotonic()
+        self.started = None
+
+
+class FairScheduler:
+    def __init__(self, capacity, per_session=PER_SESSION_IN_FLIGHT):
+        self.capacity = capacity
+        self.per_session = per_session
+        self.admitted = 0
+        self.max_queued = 0
+        self._vtime = 0.0
+        self._last_tag = {}  # session -> nhãn của lệnh gọi gần nhất
+        self._waiting = []  # _Ticket đang chờ
+        self._running = {}  # session -> số lệnh gọi đang chạy
+        self._service = None  # EWMA thời gian chạy 1 lệnh gọi (giây)
+        self._seq = itertools.count()
+        self._lock = threading.Lock()  # position() được gọi từ luồng của trang
+
+    # ---------- VÀO / RA (TRÊN EVENT LOOP CỦA GATEWAY) ----------
+    async def acquire(self, session, weight=1.0):
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            start = max(self._vtime, self._last_tag.get(session, 0.0))
+            ticket = _Ticket(session, start, start + 1.0 / weight, next(self._seq), loop.create_future())
+            self._last_tag[session] = ticket.tag
+            self._waiting.append(ticket)
+            self.max_queued = max(self.max_queued, len(self._waiting))
+            self._dispatch()
+        try:
+            await ticket.future
+        except asyncio.CancelledError:
+            with self._lock:
+                if ticket in self._waiting:
+                    self._waiting.remove(ticket)
+                    self._forget(session)
+                    raise
+            self.release(ticket)  # Vừa được cho vào đúng lúc bị hủy -> trả chỗ
+            raise
+        return ticket
+
+    def release(self, ticket):
+        with self._lock:
+            self._running[ticket.session] -= 1
+            if not self._running[ticket.session]:
+                del self._running[ticket.session]
+            elapsed = time.monotonic() - ticket.started
+            self._service = elapsed if self._service is None else self._service + SERVICE_EWMA_ALPHA * (elapsed - self._service)
+            self._forget(ticket.session)
+            if not self._running and not self._waiting:
+                self._last_tag.clear()  # Hết tải: không còn ai để so lượt, xóa "nợ" của mọi session
+            self._dispatch()
+
+    def _eligible(self, ticket):
+        if ticket.session is None:
+            return True  # Việc nền: giới hạn nằm ở BatchJob, không ở đây
+        return self._running.get(ticket.session, 0) < self.per_session
+
+    def _dispatch(self):
+        while sum(self._running.values()) < self.capacity:
+            ready = [t for t in self._waiting if self._eligible(t)]
+            if not ready:
+                return
+            ticket = min(ready, key=lambda t: (t.tag, t.seq))
+            self._waiting.remove(ticket)
+            self._running[ticket.session] = self._running.get(ticket.session, 0) + 1
+            self._vtime = max(self._vtime, ticket.start)
+            self.admitted += 1
+            ticket.started = time.monotonic()
+            ticket.future.set_result(None)
+
+    def _forget(self, session):
+        # Session không còn gì chạy / chờ và nhãn đã bị thời gian ảo vượt qua -> bỏ để dict không phình
+        if session in self._running or any(t.session == session for t in self._waiting):
+            return
+        if self._last_tag.get(session, 0.0) <= self._vtime:
+            self._last_tag.pop(session, None)
+
+    # ---------- XEM HÀNG CHỜ (TỪ LUỒNG CỦA TRANG) ----------
+    def position(self, session):
+        """(vị trí trong hàng của lệnh gọi sớm nhất của session, số giây chờ ước tính); None = không phải chờ."""
+        with self._lock:
+            ordered = sorted(self._waiting, key=lambda t: (t.tag, t.seq))
+            service = self._service if self._service is not None else DEFAULT_SERVICE_SECONDS
+            for index, ticket in enumerate(ordered):
+                if ticket.session == session:
+                    # Mỗi "lượt" giải phóng capacity chỗ sau khoảng 1 lần chạy trung bình
+                    return index + 1, round(service * (index // self.capacity + 1))
+        return None
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "running": sum(self._running.values()), "queued": len(self._waiting), "capacity": self.capacity,
+                "per_session": self.per_session, "sessions_running": len(self._running),
+                "admitted": self.admitted, "max_queued": self.max_queued,
+                "avg_service_s": None if self._service is None else round(self._service, 1),
+            }
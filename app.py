@@ -1,5 +1,6 @@
 import streamlit as st
 import streamlit as st
+from ai_core.gateway import release_session
 
 st.markdown("""
     <style>
@@ -11,6 +12,9 @@ st.markdown("""
 # 1. Cấu hình trang
 st.set_page_config(page_title="AUVIET CENTER", layout="wide", page_icon="🎓")
 
+# Rời trang luyện tập sang đây -> hủy lệnh gọi AI còn chạy của session (hướng dẫn / chấm bài)
+release_session(st.session_state.get("session_id"))
+
 # ----------------------------------------------------------------
 # CSS: GIAO DIỆN CHUYÊN NGHIỆP & CĂN CHỈNH
 # ----------------------------------------------------------------
@@ -1,10 +1,13 @@
 import streamlit as st
-from google import genai
 from google.genai import types
+from ai_core import FAKE_API_KEYS, DeadlineExceeded, GenerationRequest, get_client_pool, get_gateway, get_latency_router, get_metrics_store, get_model_catalog, get_rate_limiter, get_response_cache, is_complete_json, merge_json, metrics_path, missing_fields, missing_fields_prompt, model_ladder, PromptLayout, response_cache_dir, salvage_json
+from ai_core.gateway import DEFAULT_MAX_CONCURRENCY
+from ai_core.scheduler import PER_SESSION_IN_FLIGHT
 import json
 import re
 import time
-import random
+import uuid
+from concurrent.futures import wait
 from PIL import Image
 
 # ==========================================
@@ -43,14 +46,43 @@ st.markdown("""
 # ==========================================
 # 2. LOGIC AI & XỬ LÝ DỮ LIỆU
 # ==========================================
+# Backend AI: "gemini" (thật) hoặc "fake" (giả lập cục bộ, không cần key - để đo hiệu năng app)
+LLM_BACKEND = st.secrets.get("LLM_BACKEND", "gemini")
 try:
-    ALL_KEYS = st.secrets["GEMINI_API_KEYS"]
+    ALL_KEYS = st.secrets.get("GEMINI_API_KEYS", FAKE_API_KEYS) if LLM_BACKEND == "fake" else st.secrets["GEMINI_API_KEYS"]
 except Exception:
     st.error("⚠️ Thầy/Cô chưa cấu hình secrets.toml chứa GEMINI_API_KEYS!")
     st.stop()
 
+# Client theo key: genai.Client thật hoặc bản giả lập ([FAKE_BACKEND] trong secrets.toml)
+get_client_pool(LLM_BACKEND, **st.secrets.get("FAKE_BACKEND", {}))
+# Cache kết quả AI theo nội dung (RAM + ổ đĩa): cùng đề + cùng ảnh -> trả về ngay, không tốn quota
+get_response_cache(directory=response_cache_dir(LLM_BACKEND), ttl=float(st.secrets.get("RESPONSE_CACHE_TTL_HOURS", 168)) * 3600)
+# Số liệu token/độ trễ của từng lệnh gọi AI (sqlite cục bộ, tổng hợp theo trang + bước)
+get_metrics_store(path=metrics_path(LLM_BACKEND))
+# Chọn model theo độ trễ thực tế: SLO p95 (giây) theo bước, ghi đè bằng [LATENCY_SLOS] trong secrets.toml
+get_latency_router(slos={step: float(slo) for step, slo in st.secrets.get("LATENCY_SLOS", {}).items()})
+# Gateway AI dùng chung toàn server (event loop riêng + giới hạn số lệnh gọi đồng thời)
+GATEWAY = get_gateway(
+    ALL_KEYS, max_concurrency=int(st.secrets.get("LLM_MAX_CONCURRENCY", DEFAULT_MAX_CONCURRENCY)),
+    max_per_session=int(st.secrets.get("LLM_MAX_PER_SESSION", PER_SESSION_IN_FLIGHT)),  # Số lệnh gọi chạy cùng lúc của 1 học sinh
+)
+get_model_catalog().prefetch(ALL_KEYS)
+# Hạn mức RPM/TPM theo (key, model): mặc định free tier, ghi đè bằng [RATE_LIMITS."<model>"] trong secrets.toml
+get_rate_limiter({model: dict(limit) for model, limit in st.secrets.get("RATE_LIMITS", {}).items()})
+# Ngân sách thời gian (giây) theo bước, ghi đè bằng [STEP_DEADLINES] trong secrets.toml
+STEP_DEADLINES = {step: float(budget) for step, budget in st.secrets.get("STEP_DEADLINES", {}).items()}
+# Bước nào được phép có lệnh gọi AI đang chạy: đổi bước / reset / sang trang khác -> gateway hủy phần còn lại
+STEP_CALLS = {1: {"analysis"}, 4: {"grading"}}
+WAIT_TICK_SECONDS = 0.5
+
 def clean_and_parse_json(text):
     if not text: return {}
+
+    # 0. JSON bị cắt giữa chừng (thiếu ngoặc đóng): giữ mọi object / trường đã viết xong
+    salvaged = salvage_json(text)
+    if salvaged.cut:
+        return salvaged.data
     
     # 1. Trích xuất khối {...} ra khỏi các đoạn văn bản rườm rà
     match = re.search(r'(\{[\s\S]*\})', text)
@@ -90,79 +122,91 @@ def clean_and_parse_json(text):
                 break
     return {}
 
-def generate_content_with_failover(prompt, image=None, json_mode=False):
-    keys_to_try = list(ALL_KEYS)
-    random.shuffle(keys_to_try) 
-    model_priority = [
-        "gemini-2.5-pro",
-        "gemini-1.5-pro",
-        "gemini-2.5-flash",        
-        "gemini-2.5-flash-lite",
-        "gemini-2.0-flash",
-        "gemini-1.5-flash"
-    ]
-    
+# Các trường JSON trang cần; bị cắt mất trường nào thì chỉ xin lại trường đó (không gọi lại từ đầu)
+ANALYSIS_FIELDS = (
+    "extracted_text", "step1_skimming", "thesis_actual", "step1_paragraph_analysis", "step1_reference_result",
+    "step2_outline", "details_to_omit_guide", "details_to_omit",
+    "step3_drafting_reference.intro", "step3_drafting_reference.body", "step3_drafting_reference.concl",
+)
+GRADING_FIELDS = (
+    "total_score", "score_ideas", "feedback_ideas", "score_wording", "feedback_wording",
+    "model_summary", "detailed_comparison", "grammar_spelling_errors",
+)
+
+def complete_missing_fields(data, layout, values, fields, image=None, step=None):
+    """data bị thiếu trường (JSON bị cắt) -> xin lại riêng các trường đó rồi gộp vào."""
+    missing = missing_fields(data, fields)
+    if not data or not missing:
+        return data
+    extra = generate_content_with_failover(layout, values, image=image, json_mode=True, step=step, suffix=missing_fields_prompt(missing))
+    return merge_json(data, clean_and_parse_json(extra)) if extra else data
+
+# Ưu tiên model mạnh nhất, router tự lùi về model nhẹ hơn khi model này chậm quá SLO
+MODEL_PRIORITY = model_ladder("gemini-2.5-pro")
+
+def build_generation_config(sel_model, json_mode=False):
+    config_args = {"temperature": 0.2, "max_output_tokens": 8000}
+    if json_mode and "thinking" not in sel_model.lower():
+        config_args["response_mime_type"] = "application/json"
+    return types.GenerateContentConfig(**config_args)
+
+def generate_content_with_failover(layout, values, image=None, json_mode=False, step=None, suffix=""):
     status_msg = st.empty() 
+    status_msg.info("🚀 Cố vấn AI đang đọc dữ liệu...")
+
+    # Trên mỗi key: thử lần lượt các model (VD: từ 2.5 lùi xuống 1.5) rồi mới đổi key.
+    # Khối hướng dẫn tĩnh đứng đầu (giống hệt nhau mọi lần -> prefix cache), dữ liệu + ảnh ở cuối
+    static_prefix, contents = layout.render(values, image, suffix)
+    request = GenerationRequest(
+        contents=contents,
+        static_prefix=static_prefix,
+        model_priority=MODEL_PRIORITY,
+        build_config=lambda sel_model: build_generation_config(sel_model, json_mode),
+        cache_if=is_complete_json if json_mode else None,  # Không cache bản JSON bị đứt gãy
+        complete_if=is_complete_json if json_mode else None,  # Bị cắt ở MAX_TOKENS -> gateway viết tiếp tới khi JSON đủ
+        page="summary",
+        step=step,  # Nhãn để tổng hợp số liệu token/độ trễ theo bước
+        affinity=values.get("ORIGINAL"),  # Cùng bài gốc -> cùng key (cache phía server của key đó trúng)
+        deadline=STEP_DEADLINES.get(step),  # None = mặc định của gateway theo bước
+        session=st.session_state.session_id,
+    )
+    future = GATEWAY.submit(request)
+    try:
+        # Chờ từng nhịp ngắn và ghi ra trang mỗi nhịp: học sinh bấm nút khác / rời trang thì
+        # Streamlit dừng script ngay tại đây và lệnh gọi bị hủy (không chạy tiếp vô ích)
+        started = time.monotonic()
+        while not wait([future], timeout=WAIT_TICK_SECONDS).done:
+            GATEWAY.heartbeat(st.session_state.session_id)  # Mỗi nhịp chờ: session còn đây, không hủy lệnh gọi
+            queued = GATEWAY.queue_position(st.session_state.session_id)
+            if queued:
+                # Giờ cao điểm: hiện vị trí trong hàng chờ thay vì chỉ quay vòng
+                status_msg.info(f"⏳ Đang xếp hàng: vị trí #{queued[0]}, ước tính chờ ~{queued[1]} giây")
+            else:
+                status_msg.info(f"🚀 Cố vấn AI đang đọc dữ liệu... ({int(time.monotonic() - started)}s)")
+        result = future.result()
+    except DeadlineExceeded:
+        # Quá ngân sách thời gian của bước: báo rõ để học sinh bấm lại, không quay mãi
+        status_msg.warning("⏳ Hệ thống đang quá tải nên chưa xử lý kịp. Vui lòng bấm lại sau ít phút – bài làm của bạn vẫn được giữ nguyên.")
+        return None
+    finally:
+        if not future.done():
+            future.cancel()
+    status_msg.empty()
 
-    # --- VÒNG LẶP 1: DUYỆT QUA TỪNG API KEY ---
-    for key_idx, current_key in enumerate(keys_to_try):
-        try:
-            if key_idx > 0:
-                status_msg.warning(f"⏳ Cụm Server #{key_idx} quá tải. Đang đổi sang Server #{key_idx + 1}...")
-                time.sleep(1) 
-            
-            client = genai.Client(api_key=current_key)
-            raw_models = list(client.models.list())
-            available_models = [m.name.replace("models/", "") for m in raw_models]
-            
-            # Lọc ra danh sách các model CÓ SẴN theo đúng thứ tự ưu tiên
-            models_to_try = [m for m in model_priority if m in available_models]
-            if not models_to_try: 
-                models_to_try = ["gemini-1.5-flash"]
-
-            masked_key = f"****{current_key[-4:]}"
-            
-            # --- VÒNG LẶP 2: DUYỆT TỪNG MODEL TRÊN CÙNG 1 KEY ---
-            for model_idx, sel_model in enumerate(models_to_try):
-                try:
-                    # Báo cáo UI đang thử model nào
-                    if model_idx > 0:
-                        status_msg.info(f"🔄 Hạ cấp Model: Đang thử nghiệm với {sel_model}...")
-                    else:
-                        status_msg.info(f"🚀 Cố vấn AI ({sel_model}) đang đọc dữ liệu...")
-                        
-                    st.toast(f"⚡ Đang thử kết nối: {sel_model}", icon="🔄")
-                    
-                    content_parts = [image, prompt] if image else [prompt]
-                    config_args = {"temperature": 0.2, "max_output_tokens": 8000}
-                    if json_mode and "thinking" not in sel_model.lower():
-                        config_args["response_mime_type"] = "application/json"
-
-                    # Thực hiện gọi AI
-                    response = client.models.generate_content(
-                        model=sel_model, contents=content_parts, config=types.GenerateContentConfig(**config_args)
-                    )
-                    
-                    # NẾU THÀNH CÔNG -> Lưu thông tin và Thoát luôn
-                    if response:
-                        with st.expander(f"✅ Kết nối Thành công (Key #{key_idx + 1})", expanded=False):
-                            st.write(f"**Model đã dùng:** `{sel_model}`")
-                            st.write(f"**API Key:** `{masked_key}`")
-                        
-                        status_msg.empty()
-                        return response.text
-                        
-                except Exception as model_error:
-                    # NẾU MODEL NÀY BỊ LỖI QUOTA/QUYỀN -> Bỏ qua, vòng lặp sẽ tự chạy model tiếp theo (VD: từ 2.5 lùi xuống 1.5)
-                    continue 
-            
-            # Nếu chạy hết vòng lặp Model mà vẫn không được -> Nghĩa là Key này đã "cháy", vòng lặp 1 sẽ nhảy sang Key tiếp theo.
-                    
-        except Exception as key_error:
-            # Lỗi không khởi tạo được Client
-            continue
+    # NẾU THÀNH CÔNG -> Lưu thông tin và Thoát luôn
+    if result:
+        if result.cached:
+            st.toast(f"♻️ Dùng lại kết quả đã phân tích ({result.model})", icon="⚡")
+        elif result.coalesced:
+            st.toast(f"🤝 Dùng chung kết quả với bạn cùng lớp ({result.model})", icon="⚡")
+        else:
+            st.toast(f"⚡ Đã kết nối: {result.model}", icon="🔄")
+        with st.expander(f"✅ Kết nối Thành công ({'Cache' if result.cached else f'Lần thử #{result.attempts}'})", expanded=False):
+            st.write(f"**Model đã dùng:** `{result.model}`")
+            if not result.cached:
+                st.write(f"**API Key:** `{result.masked_key}`")
+        return result.text
             
-    status_msg.empty()
     st.error(f"❌ Tất cả luồng kết nối đều thất bại. Vui lòng kiểm tra lại cấu hình API Keys hoặc kết nối mạng.")
     return None
 
@@ -282,7 +326,7 @@ Hệ thống chấm điểm tổng là 1.0 ĐIỂM, được chia thành 3 tiêu
 
 1. Main Ideas (0.4 pt): Tóm tắt có bám sát các ý chính và thông điệp cốt lõi của bài gốc không? Đủ ý trọn 0.4, thiếu ý trừ dần.
 2. Own wording (0.4 pt): Học sinh có dùng từ ngữ của riêng mình (paraphrase) không? Nếu copy y nguyên cả câu từ bài gốc -> 0 điểm phần này. Nếu có đổi cấu trúc, đổi từ vựng -> 0.4 điểm.
-3. Word limit (0.2 pt): Yêu cầu là "khoảng 100 - 120 từ". HỆ THỐNG ĐÃ ĐẾM CHÍNH XÁC BÀI NÀY CÓ {{WORD_COUNT}} TỪ. Đừng tự đếm lại. Nếu số từ {{WORD_COUNT}} nằm trong biên độ 90 đến 130 từ, hãy cho trọn vẹn 0.2 pt.
+3. Word limit (0.2 pt): Yêu cầu là "khoảng 100 - 120 từ". HỆ THỐNG ĐÃ ĐẾM CHÍNH XÁC SỐ TỪ CỦA BÀI NÀY (mục "Số từ" ở cuối prompt). Đừng tự đếm lại. Nếu số từ đó nằm trong biên độ 90 đến 130 từ, hãy cho trọn vẹn 0.2 pt.
 
 ⚠️ YÊU CẦU ĐẶC BIỆT VỀ "BẢN NÂNG CẤP" & "ĐỐI CHIẾU" (BẮT BUỘC TUÂN THỦ):
 1. Mục "model_summary" KHÔNG ĐƯỢC viết mới hoàn toàn. Giữ lại tối đa cấu trúc của học sinh, chỉ sửa/thêm những chỗ chưa tốt.
@@ -299,7 +343,7 @@ Trả về BẮT BUỘC định dạng JSON sau:
     "score_wording": "0.3/0.4",
     "feedback_wording": "Nhận xét về paraphrase...",
     "score_word_limit": "0.2/0.2",
-    "feedback_word_limit": "Số lượng từ là {{WORD_COUNT}} từ, nằm trong/ngoài khoảng cho phép...",
+    "feedback_word_limit": "Số lượng từ là [Số từ] từ, nằm trong/ngoài khoảng cho phép...",
     "model_summary": "PHIÊN BẢN NÂNG CẤP: Viết lại dựa trên chính bài của học sinh. Đảm bảo 100 - 120 từ.",
     "detailed_comparison": [
         {
@@ -323,9 +367,15 @@ Trả về BẮT BUỘC định dạng JSON sau:
         }
     ]
 }
-Bài gốc: {{ORIGINAL}}
+"""
+# Prefix cache: prompt hướng dẫn giữ nguyên từng byte ở đầu, chỉ dữ liệu của học sinh (và ảnh) ở cuối
+# Bài gốc đứng trước số từ: cả lớp chung 1 bài gốc -> phần trùng kéo dài qua cả bài gốc
+GRADING_INFO_BLOCK = """Bài gốc: {{ORIGINAL}}
+Số từ của bản tóm tắt (hệ thống đã đếm): {{WORD_COUNT}}
 Bản tóm tắt của học sinh: {{STUDENT}}
 """
+ANALYSIS_LAYOUT = PromptLayout(ANALYSIS_PROMPT, "{{USER_TEXT}}")
+GRADING_LAYOUT = PromptLayout(GRADING_PROMPT, GRADING_INFO_BLOCK)
 # ==========================================
 # 4. QUẢN LÝ TRẠNG THÁI (SESSION STATE)
 # ==========================================
@@ -340,8 +390,13 @@ if "ai_grading" not in st.session_state: st.session_state.ai_grading = None
 if "user_draft_intro" not in st.session_state: st.session_state.user_draft_intro = ""
 if "user_draft_body" not in st.session_state: st.session_state.user_draft_body = ""
 if "user_draft_concl" not in st.session_state: st.session_state.user_draft_concl = ""
+if "session_id" not in st.session_state: st.session_state.session_id = uuid.uuid4().hex
+
+# Chỉ giữ lệnh gọi AI của bước hiện tại; lần chạy này cũng báo gateway session vẫn còn mở
+GATEWAY.retain(st.session_state.session_id, "summary", STEP_CALLS.get(st.session_state.app_step, set()))
     
 def reset_app():
+    GATEWAY.cancel_session(st.session_state.session_id)
     for key in st.session_state.keys(): del st.session_state[key]
     st.rerun()
 
@@ -399,15 +454,17 @@ if st.session_state.app_step == 1:
             st.warning("⚠️ Vui lòng tải hình ảnh HOẶC dán văn bản để bắt đầu.")
         else:
             with st.spinner("Giáo sư AI đang đọc tài liệu và thiết kế giáo án riêng cho bạn..."):
-                final_prompt = ANALYSIS_PROMPT + (f"\n\nText từ người dùng:\n{input_text}" if input_text else "")
-                res = generate_content_with_failover(final_prompt, image=img_data, json_mode=True)
+                analysis_values = {"USER_TEXT": f"\n\nText từ người dùng:\n{input_text}" if input_text else ""}
+                res = generate_content_with_failover(ANALYSIS_LAYOUT, analysis_values, image=img_data, json_mode=True, step="analysis")
                 
                 if res:
                     # Gọi hàm tự chữa lành
                     ai_data = clean_and_parse_json(res)
+                    ai_data = complete_missing_fields(ai_data, ANALYSIS_LAYOUT, analysis_values, ANALYSIS_FIELDS, image=img_data, step="analysis")
                     
                     # CỔNG KIỂM SOÁT AN NINH: Nếu AI trả về rỗng (do gãy JSON)
                     if not ai_data:
+                        # Gateway đã tự viết tiếp phần bị cắt (MAX_TOKENS); tới đây là vẫn hỏng sau số vòng cho phép
                         st.error("❌ AI đã viết quá dài dẫn đến đứt gãy cấu trúc dữ liệu. Em vui lòng bấm nút [Phân tích & Bắt đầu bài học] lại 1 lần nữa nhé!")
                         with st.expander("🛠️ Dành cho Dev: Xem dữ liệu thô (Raw Output) bị lỗi của AI để sửa Prompt"):
                             st.text(res) # In ra màn hình để biết AI gõ sai chỗ nào
@@ -734,11 +791,12 @@ elif st.session_state.app_step == 4:
                             word_feedback = "Nằm ngoài khoảng cho phép (90-130 từ). Cần chú ý độ dài bài viết."
                             
                         # TRUYỀN SẴN ĐIỂM VÀO PROMPT
-                        grade_prompt = GRADING_PROMPT.replace("{{ORIGINAL}}", st.session_state.original_text).replace("{{STUDENT}}", draft_input).replace("{{WORD_COUNT}}", str(wc)).replace("{{WORD_SCORE}}", word_score).replace("{{WORD_FEEDBACK}}", word_feedback)
+                        grade_values = {"ORIGINAL": st.session_state.original_text, "STUDENT": draft_input, "WORD_COUNT": wc}
                         
-                        res = generate_content_with_failover(grade_prompt, json_mode=True)
+                        res = generate_content_with_failover(GRADING_LAYOUT, grade_values, json_mode=True, step="grading")
                         if res:
                             ai_grade_data = clean_and_parse_json(res)
+                            ai_grade_data = complete_missing_fields(ai_grade_data, GRADING_LAYOUT, grade_values, GRADING_FIELDS, step="grading")
                             
                             # CỔNG KIỂM SOÁT TẠI BƯỚC CHẤM ĐIỂM
                             if not ai_grade_data:
@@ -1,16 +1,24 @@
 import streamlit as st
-from google import genai
 from google.genai import types
+from ai_core import FAKE_API_KEYS, Cascade, DeadlineExceeded, GenerationRequest, get_client_pool, get_context_cache_manager, get_gateway, get_latency_router, get_job_manager, get_metrics_store, get_model_catalog, get_offline_batches, get_prefix_stats, get_rate_limiter, get_response_cache, batches_path, is_complete_json, merge_json, metrics_path, missing_fields, missing_fields_prompt, model_ladder, PromptLayout, response_cache_dir, salvage_json
+from ai_core.gateway import DEFAULT_MAX_CONCURRENCY
+from ai_core.hedging import DEFAULT_HEDGE_DELAY_SECONDS, get_hedge_metrics
+from ai_core.jobs import CANCELLED
+from ai_core.scheduler import PER_SESSION_IN_FLIGHT
 import json
 import re
 import time
-import random
+import csv
+import uuid
+import zipfile
 import textwrap
 import html
+import hmac
 import os
 import requests
+from concurrent.futures import CancelledError, wait
 from PIL import Image
-from io import BytesIO
+from io import BytesIO, StringIO
 
 # Thư viện Word
 from docx import Document
@@ -165,19 +173,19 @@ st.markdown("""
 # ==========================================
 # 2. LOGIC AI (FAILOVER)
 # ==========================================
+# Backend AI: "gemini" (thật) hoặc "fake" (giả lập cục bộ, không cần key - để đo hiệu năng app)
+LLM_BACKEND = st.secrets.get("LLM_BACKEND", "gemini")
 try:
-    ALL_KEYS = st.secrets["GEMINI_API_KEYS"]
+    ALL_KEYS = st.secrets.get("GEMINI_API_KEYS", FAKE_API_KEYS) if LLM_BACKEND == "fake" else st.secrets["GEMINI_API_KEYS"]
 except Exception:
     st.error("⚠️ Chưa cấu hình secrets.toml chứa GEMINI_API_KEYS!")
     st.stop()
 
 import streamlit as st
-from google import genai
 from google.genai import types
 import json
 import re
 import time
-import random
 import textwrap
 import html
 import os
@@ -338,99 +346,375 @@ st.markdown("""
 # ==========================================
 # 2. LOGIC AI (FAILOVER)
 # ==========================================
-ALL_KEYS = st.secrets["GEMINI_API_KEYS"]
-
-def generate_content_with_failover(prompt, image=None, json_mode=False):
-    import time  # Đảm bảo đã import time
-    
-    keys_to_try = list(ALL_KEYS)
-    random.shuffle(keys_to_try) 
-    
-    model_priority = [
-        #"gemini-3-flash-preview",        
-        "gemini-2.5-flash",
-        "gemini-2.5-flash-lite",
-        "gemini-2.0-flash",
-        "gemini-1.5-pro", 
-        "gemini-1.5-flash"
-    ]
+# Client theo key: genai.Client thật hoặc bản giả lập ([FAKE_BACKEND] trong secrets.toml)
+get_client_pool(LLM_BACKEND, **st.secrets.get("FAKE_BACKEND", {}))
+# Cache kết quả AI theo nội dung (RAM + ổ đĩa): cùng đề + cùng ảnh -> trả về ngay, không tốn quota
+get_response_cache(directory=response_cache_dir(LLM_BACKEND), ttl=float(st.secrets.get("RESPONSE_CACHE_TTL_HOURS", 168)) * 3600)
+# Số liệu token/độ trễ của từng lệnh gọi AI (sqlite cục bộ, tổng hợp theo trang + bước)
+get_metrics_store(path=metrics_path(LLM_BACKEND))
+# Context cache cho prompt tĩnh (GRADING_STATIC_PROMPT, prompt_guide): TTL tính theo phút
+get_context_cache_manager(ttl_seconds=int(float(st.secrets.get("CONTEXT_CACHE_TTL_MINUTES", 60)) * 60))
+# Chọn model theo độ trễ thực tế: SLO p95 (giây) theo bước, ghi đè bằng [LATENCY_SLOS] trong secrets.toml
+get_latency_router(slos={step: float(slo) for step, slo in st.secrets.get("LATENCY_SLOS", {}).items()})
+# Gateway AI dùng chung toàn server (event loop riêng + giới hạn số lệnh gọi đồng thời).
+# Bên dưới: pool Client "ấm" theo key, danh mục model có TTL, bảng sức khỏe key/model.
+GATEWAY = get_gateway(
+    ALL_KEYS, max_concurrency=int(st.secrets.get("LLM_MAX_CONCURRENCY", DEFAULT_MAX_CONCURRENCY)),
+    max_per_session=int(st.secrets.get("LLM_MAX_PER_SESSION", PER_SESSION_IN_FLIGHT)),  # Số lệnh gọi chạy cùng lúc của 1 học sinh
+)
+get_model_catalog().prefetch(ALL_KEYS)
+# Hạn mức RPM/TPM theo (key, model): mặc định free tier, ghi đè bằng [RATE_LIMITS."<model>"] trong secrets.toml
+get_rate_limiter({model: dict(limit) for model, limit in st.secrets.get("RATE_LIMITS", {}).items()})
+# Ngân sách thời gian (giây) theo bước (mặc định: guide 60s, grading 120s), ghi đè bằng [STEP_DEADLINES] trong secrets.toml
+STEP_DEADLINES = {step: float(budget) for step, budget in st.secrets.get("STEP_DEADLINES", {}).items()}
+OVERLOADED_MSG = "⏳ Hệ thống đang quá tải nên chưa xử lý kịp trong thời gian cho phép. Vui lòng bấm lại sau ít phút – bài làm của bạn vẫn được giữ nguyên."
+
+# Hedging cho lệnh chấm điểm (bật trong secrets.toml: HEDGE_GRADING = true)
+HEDGE_GRADING = bool(st.secrets.get("HEDGE_GRADING", False))
+HEDGE_DELAY_SECONDS = float(st.secrets.get("HEDGE_DELAY_SECONDS", DEFAULT_HEDGE_DELAY_SECONDS))
+# Job nền cho lệnh chấm bài / hướng dẫn (dùng chung toàn server, không phụ thuộc session)
+JOBS = get_job_manager()
+GRADING_POLL_SECONDS = 0.2
+WAIT_TICK_SECONDS = 0.5  # Nhịp chờ của lệnh gọi không stream (heartbeat + vị trí trong hàng)
+# Bước nào được phép có lệnh gọi AI đang chạy: đổi bước / reset / sang trang khác -> gateway hủy phần còn lại
+STEP_CALLS = {1: {"guide"}, 2: set(), 3: {"grading"}}
+# Chấm cả lớp (giáo viên): số bài chấm cùng lúc - mặc định chừa một nửa gateway cho học sinh đang dùng trang
+BATCH_CONCURRENCY = int(st.secrets.get("BATCH_CONCURRENCY", max(1, GATEWAY.max_concurrency // 2)))
+BATCH_POLL_SECONDS = 1.0
+# Chế độ giáo viên chỉ hiện khi secrets.toml có TEACHER_CODE (nhập đúng mã mới mở); mỗi lần chấm tối đa MAX_CLASS_ESSAYS bài
+TEACHER_CODE = st.secrets.get("TEACHER_CODE")
+MAX_CLASS_ESSAYS = int(st.secrets.get("MAX_CLASS_ESSAYS", 40))
+# Chấm qua đêm (Gemini Batch API): sổ theo dõi sqlite + luồng nền hỏi trạng thái định kỳ
+OFFLINE_BATCHES = get_offline_batches(path=batches_path(LLM_BACKEND))
+OFFLINE_BATCHES.start_poller()
+# Bảng số liệu token/độ trễ (ghi ở .cache/llm_metrics.sqlite3) - bật: SHOW_LLM_METRICS = true
+SHOW_LLM_METRICS = bool(st.secrets.get("SHOW_LLM_METRICS", False))
+
+# Thang model dùng chung với trang summary (ai_core.router.MODEL_TIERS), bắt đầu từ gemini-2.5-flash;
+# router tự lùi về model nhẹ hơn khi model ưu tiên chậm quá SLO của bước
+MODEL_PRIORITY = model_ladder("gemini-2.5-flash")
+# Cascade chấm bài: model nhẹ chấm trước, chỉ chuyển lên MODEL_PRIORITY khi bài dài, điểm sát ngưỡng làm tròn band,
+# JSON hỏng hoặc model tự báo không chắc chắn. Mặc định TẮT: lượt nhẹ không stream nên học sinh không thấy chữ nào
+# cho tới khi nó xong (leo thang thì bài chấm stream lại từ đầu) - bật khi tiết kiệm quota quan trọng hơn
+# thời gian thấy phản hồi đầu tiên (secrets.toml: CASCADE_GRADING = true)
+CASCADE_GRADING = bool(st.secrets.get("CASCADE_GRADING", False))
+CASCADE_MODELS = model_ladder("gemini-2.5-flash-lite")
+CASCADE_MAX_WORDS = int(st.secrets.get("CASCADE_MAX_WORDS", 200))  # Bài dài hơn -> đi thẳng model mạnh
+CASCADE_MIN_CONFIDENCE = float(st.secrets.get("CASCADE_MIN_CONFIDENCE", 0.7))
+CASCADE_BAND_MARGIN = 0.125  # Trung bình cách ngưỡng làm tròn band tổng không quá mức này -> model mạnh chấm
+
+def build_generation_config(sel_model, json_mode=False):
+    config_args = {
+        "temperature": 0.3,
+        "top_p": 0.95,
+        "top_k": 64,
+        "max_output_tokens": 32000,
+    }
     
-    last_error = ""
-    # 💡 BỔ SUNG: Khởi tạo vùng thông báo để không bị lỗi NameError
+    if json_mode and "thinking" not in sel_model.lower():
+        config_args["response_mime_type"] = "application/json"
+
+    if "thinking" in sel_model.lower():
+        config_args["thinking_config"] = {"include_thoughts": True, "thinking_budget": 32000}
+    return types.GenerateContentConfig(**config_args)
+
+def build_request(layout, values, image=None, json_mode=False, hedge=False, step=None, background=False, suffix=""):
+    # Mỗi key chỉ thử model tốt nhất của nó, lỗi thì chuyển sang key kế tiếp.
+    # layout: khối hướng dẫn tĩnh đứng đầu (prefix cache + context cache của Gemini),
+    # dữ liệu động (values, suffix) rồi tới ảnh ở cuối
+    # background: việc của giáo viên (chấm cả lớp) -> không gắn session, chỉ dừng khi bấm hủy
+    static_prefix, contents = layout.render(values, image, suffix)
+    return GenerationRequest(
+        contents=contents,
+        static_prefix=static_prefix,
+        model_priority=MODEL_PRIORITY,
+        build_config=lambda sel_model: build_generation_config(sel_model, json_mode),
+        models_per_key=1,
+        hedge_delay=HEDGE_DELAY_SECONDS if hedge and HEDGE_GRADING else None,
+        cache_if=is_complete_json,  # Không cache bản JSON bị đứt gãy
+        complete_if=is_complete_json,  # Bị cắt ở MAX_TOKENS -> gateway viết tiếp tới khi JSON đủ
+        page="thuchanh",
+        step=step,  # Nhãn để tổng hợp số liệu token/độ trễ theo bước
+        affinity=values.get("TOPIC"),  # Cùng đề -> cùng key (cache phía server của key đó trúng)
+        deadline=STEP_DEADLINES.get(step),  # None = mặc định của gateway theo bước
+        session=None if background else st.session_state.session_id,
+    )
+
+def show_queue_position(slot):
+    """Lệnh gọi của học sinh đang xếp hàng -> hiện vị trí + thời gian chờ ước tính, không thì xóa slot."""
+    GATEWAY.heartbeat(st.session_state.session_id)  # Mỗi nhịp chờ: session còn đây, không hủy lệnh gọi
+    queued = GATEWAY.queue_position(st.session_state.session_id)
+    if queued:
+        slot.info(f"⏳ Đang xếp hàng: vị trí #{queued[0]}, ước tính chờ ~{queued[1]} giây")
+    else:
+        slot.empty()
+
+def show_connection_details(result):
+    if result.cached:
+        st.toast(f"♻️ Cached result: {result.model}", icon="⚡")
+    elif result.coalesced:
+        st.toast(f"🤝 Shared result (same request in progress): {result.model}", icon="⚡")
+    else:
+        st.toast(f"⚡ Connected: {result.model}", icon="🤖")
+    with st.expander(f"🔌 Connection Details ({'Cache hit' if result.cached else f'Attempt #{result.attempts}'})", expanded=False):
+        st.write(f"**Active Model:** `{result.model}`")
+        if not result.cached:
+            st.write(f"**Active API Key:** `{result.masked_key}`")
+
+def generate_content_with_failover(layout, values, image=None, json_mode=False, step=None, suffix=""):
     status_msg = st.empty() 
+    status_msg.info(f"🚀 Processing data via AI Gateway ({len(ALL_KEYS)} streams)...")
 
-    for index, current_key in enumerate(keys_to_try):
-        try:
-            # --- BƯỚC 1: Khởi tạo kết nối & Né chặn IP ---
-            if index > 0:
-                status_msg.warning(f"⏳ Luồng #{index} bận. Đang tối ưu kết nối, vui lòng đợi 3 giây...")
-                time.sleep(3) 
-            
-            client = genai.Client(api_key=current_key)
-            
-            # --- BƯỚC 2: Lấy danh sách model ---
-            raw_models = list(client.models.list())
-            available_models = [m.name.replace("models/", "") for m in raw_models]
-            
-            # --- BƯỚC 3: Tìm model tốt nhất ---
-            sel_model = None
-            for target in model_priority:
-                if target in available_models:
-                    sel_model = target
-                    break
-            
-            if not sel_model:
-                sel_model = "gemini-1.5-flash" 
+    # Gửi vào gateway (chạy trên event loop riêng), trang chờ Future từng nhịp ngắn:
+    # mỗi nhịp heartbeat (không bị reaper hủy) và hiện vị trí trong hàng chờ
+    future = GATEWAY.submit(build_request(layout, values, image, json_mode, step=step, suffix=suffix))
+    try:
+        started = time.monotonic()
+        while not wait([future], timeout=WAIT_TICK_SECONDS).done:
+            GATEWAY.heartbeat(st.session_state.session_id)
+            queued = GATEWAY.queue_position(st.session_state.session_id)
+            if queued:
+                status_msg.info(f"⏳ Đang xếp hàng: vị trí #{queued[0]}, ước tính chờ ~{queued[1]} giây")
+            else:
+                status_msg.info(f"🚀 Processing data via AI Gateway... ({int(time.monotonic() - started)}s)")
+        result = future.result()
+    except (DeadlineExceeded, CancelledError):
+        # Quá ngân sách thời gian, hoặc lệnh gọi đã bị hủy (reset / session bị coi là đã rời đi): báo để bấm lại
+        status_msg.warning(OVERLOADED_MSG)
+        return None, None
+    finally:
+        if not future.done():
+            future.cancel()
+    status_msg.empty()
 
-            # --- BƯỚC 4: Hiển thị thông tin Debug ---
-            masked_key = f"****{current_key[-4:]}"
-            st.toast(f"⚡ Connected: {sel_model}", icon="🤖")
-            
-            with st.expander(f"🔌 Connection Details (Key #{index + 1})", expanded=False):
-                st.write(f"**Active Model:** `{sel_model}`")
-                st.write(f"**Active API Key:** `{masked_key}`")
-            
-            # --- BƯỚC 5: Chuẩn bị nội dung ---
-            content_parts = [image, prompt] if image else [prompt]
-                
-            # --- BƯỚC 6: Cấu hình ---
-            config_args = {
-                "temperature": 0.3,
-                "top_p": 0.95,
-                "top_k": 64,
-                "max_output_tokens": 32000,
-            }
-            
-            if json_mode and "thinking" not in sel_model.lower():
-                config_args["response_mime_type"] = "application/json"
+    if result:
+        show_connection_details(result)
+        return result, result.model
 
-            if "thinking" in sel_model.lower():
-                config_args["thinking_config"] = {"include_thoughts": True, "thinking_budget": 32000}
+    st.error(f"❌ Tất cả {len(ALL_KEYS)} luồng kết nối đều thất bại. Vui lòng thử lại sau 1 phút.")
+    return None, None
 
-            # --- BƯỚC 7: Thực hiện gọi API ---
-            # Xóa thông báo chờ trước khi gọi AI
-            status_msg.info(f"🚀 Processing data via Stream #{index + 1}...")
-            
-            response = client.models.generate_content(
-                model=sel_model,
-                contents=content_parts,
-                config=types.GenerateContentConfig(**config_args)
-            )
-            
-            status_msg.empty() # Thành công thì xóa thông báo
-            return response, sel_model 
-            
-        except Exception as e:
-            last_error = str(e)
-            if "429" in last_error or "quota" in last_error.lower():
-                continue 
-            else:
-                st.warning(f"⚠️ Luồng #{index+1} gặp sự cố kỹ thuật. Đang chuyển luồng...")
+# --- JOB NỀN: lệnh gọi chạy tiếp dù script rerun / mất kết nối; trang chỉ giữ job_id ---
+def submit_job(kind, request, stream=False, **meta):
+    job_id = JOBS.submit(request, kind, stream=stream, **meta)
+    st.session_state[f"{kind}_job"] = job_id
+    st.query_params["job"] = job_id  # Mở lại trang (session mới) vẫn nhận được kết quả
+    return job_id
+
+def finish_job(kind):
+    st.session_state[f"{kind}_job"] = None
+    if "job" in st.query_params:
+        del st.query_params["job"]
+
+def grading_values(pending, image):
+    return {"TOPIC": pending["topic"], "ESSAY": pending["essay"], "IMAGE_NOTE": "ảnh đính kèm ở cuối" if image else "không có"}
+
+def grading_request(pending, image, hedge=True, step="grading", background=False):
+    """Lệnh chấm bài (stream). HEDGE_GRADING: chưa có token đầu sau HEDGE_DELAY_SECONDS -> gửi dự phòng sang key khác."""
+    request = build_request(GRADING_LAYOUT, grading_values(pending, image), image, json_mode=False, hedge=hedge, step=step, background=background)
+    if CASCADE_GRADING and len(pending["essay"].split()) <= CASCADE_MAX_WORDS:
+        request.cascade = GRADING_CASCADE
+    return request
+
+def request_missing_grading(pending, image, missing):
+    """JSON chấm bài bị cắt: chỉ xin lại các trường còn thiếu (không chấm lại từ đầu)."""
+    result, _ = generate_content_with_failover(
+        GRADING_LAYOUT, grading_values(pending, image), image, json_mode=True, step="grading",
+        suffix=missing_fields_prompt(missing),
+    )
+    return salvage_json(result.text).data if result else None
+
+# --- CHẤM CẢ LỚP: 1 đề + 1 ảnh, nhiều bài làm (CSV hoặc ZIP) ---
+def load_class_essays(uploaded_file):
+    """[(tên học sinh, bài làm)] từ CSV (cột tên + cột bài làm) hoặc ZIP các file .txt / .docx."""
+    essays = []
+    raw = uploaded_file.getvalue()
+    if uploaded_file.name.lower().endswith(".zip"):
+        with zipfile.ZipFile(BytesIO(raw)) as archive:
+            for entry in sorted(archive.namelist()):
+                name, ext = os.path.splitext(os.path.basename(entry))
+                if not name or name.startswith(".") or entry.startswith("__MACOSX"):
+                    continue
+                if ext.lower() == ".txt":
+                    essay = archive.read(entry).decode("utf-8-sig", errors="replace")
+                elif ext.lower() == ".docx":
+                    essay = "\n".join(p.text for p in Document(BytesIO(archive.read(entry))).paragraphs)
+                else:
+                    continue
+                essays.append((name, essay.strip()))
+    else:
+        rows = list(csv.reader(StringIO(raw.decode("utf-8-sig", errors="replace"))))
+        header = [h.strip().lower() for h in rows[0]] if rows else []
+        name_col = next((i for i, h in enumerate(header) if h in ("name", "student", "student_name", "họ tên", "ho_ten", "tên")), None)
+        essay_col = next((i for i, h in enumerate(header) if h in ("essay", "text", "bài làm", "bai_lam", "answer")), None)
+        if essay_col is None:
+            # Không có tiêu đề nhận ra được: cột 1 = tên, cột 2 = bài làm
+            name_col, essay_col = 0, 1
+        else:
+            rows = rows[1:]
+        for i, row in enumerate(rows, 1):
+            if len(row) <= essay_col:
                 continue
-                
-    status_msg.empty()
-    st.error(f"❌ Tất cả {len(keys_to_try)} luồng kết nối đều thất bại. Vui lòng thử lại sau 1 phút.")
-    return None, None
+            name = row[name_col].strip() if name_col is not None and name_col < len(row) else ""
+            essays.append((name or f"Student {i}", row[essay_col].strip()))
+    return [(name, essay) for name, essay in essays if essay]
+
+def submit_class_grading(topic, image, essays):
+    # Không hedging: chấm cả lớp cần thông lượng, không cần token đầu thật nhanh
+    items = [
+        (name, grading_request({"topic": topic, "essay": essay}, image, hedge=False, step="batch_grading", background=True), {"essay": essay})
+        for name, essay in essays
+    ]
+    job_id = JOBS.submit_batch("batch", items, BATCH_CONCURRENCY, topic=topic, image=image)
+    st.session_state.batch_job = job_id
+    st.query_params["job"] = job_id
+    return job_id
+
+def submit_overnight_grading(topic, image, essays):
+    # Batch API: rẻ hơn, hạn mức riêng, kết quả có trong vòng 24h -> không cần cache / gộp lệnh.
+    # Lớp đông / ảnh nặng -> chia thành nhiều batch (trả về danh sách id); 1 bài quá lớn -> ValueError
+    items = [
+        (name, grading_request({"topic": topic, "essay": essay}, image, hedge=False, step="overnight_grading", background=True), {"essay": essay})
+        for name, essay in essays
+    ]
+    return OFFLINE_BATCHES.submit("class_grading", items, topic=topic)
+
+def class_grading_rows(batch):
+    rows = []
+    for item in batch.items:
+        scores = process_grading_response(item.result.text)[1].get("originalScore", {}) if item.result else {}
+        rows.append({
+            "Học sinh": item.name, "Trạng thái": item.status, "Lần thử": item.tries,
+            "Overall": scores.get("overall", "-"), "TA": scores.get("task_achievement", "-"),
+            "CC": scores.get("cohesion_coherence", "-"), "LR": scores.get("lexical_resource", "-"),
+            "GRA": scores.get("grammatical_range", "-"),
+        })
+    return rows
+
+def class_reports_zip(batch):
+    """ZIP gồm bảng điểm cả lớp (CSV) + báo cáo .docx của từng học sinh đã chấm xong."""
+    buffer = BytesIO()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as archive:
+        rows = class_grading_rows(batch)
+        table = StringIO()
+        if rows:
+            writer = csv.DictWriter(table, fieldnames=list(rows[0]))
+            writer.writeheader()
+            writer.writerows(rows)
+        archive.writestr("bang_diem.csv", "\ufeff" + table.getvalue())  # BOM: Excel đọc đúng tiếng Việt
+        for i, item in enumerate(batch.items, 1):
+            if item.result is None:
+                continue
+            markdown, data = process_grading_response(item.result.text)
+            report = create_docx(data, batch.meta.get("topic", ""), item.meta.get("essay", ""), markdown)
+            safe_name = re.sub(r'[^\w\- ]+', '_', item.name).strip() or f"student_{i}"
+            archive.writestr(f"{i:02d}_{safe_name}.docx", report.getvalue())
+    buffer.seek(0)
+    return buffer
+
+def teacher_unlocked():
+    """Đã nhập đúng TEACHER_CODE trong session này chưa (chưa thì hiện ô nhập mã)."""
+    if st.session_state.get("teacher_unlocked"):
+        return True
+    code = st.text_input("Mã giáo viên", type="password", key="teacher_code_input")
+    if code and hmac.compare_digest(code.encode("utf-8"), str(TEACHER_CODE).encode("utf-8")):
+        st.session_state.teacher_unlocked = True
+        return True
+    if code:
+        st.error("❌ Mã giáo viên không đúng.")
+    return False
+
+def show_class_batch_progress(batch):
+    progress = batch.progress()
+    finished_items = progress["done"] + progress["failed"] + progress["cancelled"]
+    st.progress(finished_items / max(1, progress["total"]))
+    st.write(
+        f"✅ {progress['done']} xong · ⏳ {progress['running']} đang chấm · 🕒 {progress['queued']} chờ"
+        f" · ❌ {progress['failed']} lỗi · 🔁 {progress['retries']} lần thử lại"
+    )
+    st.dataframe(class_grading_rows(batch), use_container_width=True, hide_index=True)
+
+@st.fragment(run_every=BATCH_POLL_SECONDS)
+def watch_class_batch(batch_id):
+    """Chỉ phần tiến độ chạy lại mỗi BATCH_POLL_SECONDS (không chặn phần còn lại của trang)."""
+    batch = JOBS.get(batch_id)
+    if batch is None:
+        return
+    show_class_batch_progress(batch)
+    if batch.done:
+        st.rerun()  # Xong -> chạy lại cả trang: hết poll, hiện nút tải báo cáo
+
+def render_teacher_mode(question_input, img_data):
+    """Chấm cả lớp với cùng đề bài + ảnh: chấm ngay (job nền) hoặc chấm qua đêm (Batch API)."""
+    st.caption(f"CSV: cột tên học sinh + cột bài làm (name, essay). ZIP: mỗi bài 1 file .txt hoặc .docx (tên file = tên học sinh). Tối đa {MAX_CLASS_ESSAYS} bài mỗi lần chấm.")
+    class_file = st.file_uploader("Class essays", type=["csv", "zip"], key="class_input", label_visibility="collapsed")
+    class_essays = load_class_essays(class_file) if class_file else []
+    too_many = len(class_essays) > MAX_CLASS_ESSAYS
+    if class_file:
+        st.write(f"📚 {len(class_essays)} bài làm")
+    if too_many:
+        st.warning(f"⚠️ Mỗi lần chỉ chấm tối đa {MAX_CLASS_ESSAYS} bài – vui lòng chia lớp thành nhiều file.")
+    if st.button(f"📝 Chấm cả lớp ({len(class_essays)} bài)", disabled=not class_essays or too_many or bool(st.session_state.batch_job), width="stretch"):
+        if not question_input or not img_data:
+            st.warning("⚠️ Vui lòng nhập đầy đủ Đề bài và tải Ảnh lên để bắt đầu.")
+        else:
+            submit_class_grading(question_input, img_data, class_essays)
+    if st.button(f"🌙 Chấm qua đêm – Batch API ({len(class_essays)} bài)", disabled=not class_essays or too_many, width="stretch"):
+        if not question_input or not img_data:
+            st.warning("⚠️ Vui lòng nhập đầy đủ Đề bài và tải Ảnh lên để bắt đầu.")
+        else:
+            try:
+                batch_ids = submit_overnight_grading(question_input, img_data, class_essays)
+            except ValueError as e:
+                st.error(f"❌ Không tạo được batch: {e}")
+                batch_ids = []
+            failed = [overnight for overnight in map(OFFLINE_BATCHES.get, batch_ids) if overnight.error]
+            for overnight in failed:
+                st.error(f"❌ Không tạo được batch {overnight.meta.get('part', '')}: {overnight.error}")
+            if len(failed) < len(batch_ids):
+                parts = f" ({len(batch_ids)} phần)" if len(batch_ids) > 1 else ""
+                st.success(f"✅ Đã gửi batch{parts}. Kết quả thường có trong vòng vài giờ (tối đa 24h) – mở lại mục này để tải báo cáo.")
+
+    batch = JOBS.get(st.session_state.batch_job)
+    if st.session_state.batch_job and batch is None:
+        finish_job("batch")  # Server đã khởi động lại -> job không còn
+    if batch is not None:
+        st.info(f"📌 {batch.meta.get('topic', '')[:200]}")
+        if batch.done:
+            show_class_batch_progress(batch)
+            b1, b2 = st.columns(2)
+            b1.download_button("📥 Tải báo cáo cả lớp (.zip)", class_reports_zip(batch), "IELTS_Class_Reports.zip", mime="application/zip", width="stretch")
+            if b2.button("🧹 Xóa kết quả chấm lớp", width="stretch"):
+                JOBS.cancel(batch.id)
+                finish_job("batch")
+                st.rerun()
+        else:
+            if st.button("⛔ Dừng chấm lớp", key="cancel_class_batch", width="stretch"):
+                JOBS.cancel(batch.id)  # Bài đã chấm xong vẫn giữ, bài đang chờ / đang chấm bị hủy
+                st.rerun()
+            # Tiến độ tự cập nhật trong fragment; rời trang / rerun không làm dừng việc chấm
+            watch_class_batch(batch.id)
+
+    # Các batch chấm qua đêm gần đây (lưu trong sqlite, còn nguyên sau khi server khởi động lại)
+    overnight_batches = OFFLINE_BATCHES.list("class_grading", limit=10)
+    if overnight_batches:
+        st.markdown("**🌙 Batch chấm qua đêm**")
+        if st.button("🔄 Kiểm tra trạng thái"):
+            OFFLINE_BATCHES.refresh(force=True)
+            st.rerun()
+        for overnight in overnight_batches:
+            progress = overnight.progress()
+            created = time.strftime("%d/%m %H:%M", time.localtime(overnight.created))
+            part = f" · phần {overnight.meta['part']}" if overnight.meta.get("part") else ""
+            st.write(f"`{created}` · {overnight.meta.get('topic', '')[:60]}{part} · **{overnight.state.replace('JOB_STATE_', '')}** · {progress['done']}/{progress['total']} bài")
+            if overnight.done and progress["done"]:
+                st.download_button(
+                    "📥 Tải báo cáo (.zip)", class_reports_zip(overnight), f"IELTS_Overnight_{overnight.id}.zip",
+                    mime="application/zip", key=f"overnight_{overnight.id}",
+                )
+            elif not overnight.done and st.button("⛔ Hủy batch", key=f"cancel_{overnight.id}"):
+                OFFLINE_BATCHES.cancel(overnight.id)
+                st.rerun()
 
 # ==========================================
 # 3. PROMPT KHỦNG (NGUYÊN BẢN TỪ APP CHẤM ĐIỂM)
@@ -812,6 +1096,20 @@ Cấu trúc JSON:
 ```
 """
 
+# Context caching: phần hướng dẫn tĩnh phải là TIỀN TỐ của prompt thì mới cache được,
+# nên khối "Thông tin bài làm" (đổi theo từng bài) được dời xuống cuối prompt.
+GRADING_INFO_BLOCK = """Thông tin bài làm:
+a/ Đề bài (Task 1 question): {{TOPIC}}
+b/ Mô tả hình ảnh (Picture/Graph/Chart): {{IMAGE_NOTE}}
+c/ Bài làm của thí sinh (Written report): {{ESSAY}}
+"""
+GRADING_STATIC_PROMPT = GRADING_PROMPT_TEMPLATE.replace(
+    GRADING_INFO_BLOCK,
+    "Thông tin bài làm: xem mục **THÔNG TIN BÀI LÀM** ở cuối prompt (đề bài, hình ảnh đính kèm, bài làm của thí sinh).\n",
+)
+# Khối tĩnh đứng đầu (giống hệt nhau cho mọi bài), thông tin bài làm + ảnh ở cuối
+GRADING_LAYOUT = PromptLayout(GRADING_STATIC_PROMPT, "THÔNG TIN BÀI LÀM\n" + GRADING_INFO_BLOCK)
+
 # ==========================================
 # 3. HELPER FUNCTIONS
 # ==========================================
@@ -841,15 +1139,22 @@ def parse_guide_response(text):
             "body2_guide": "Mô tả chi tiết nhóm số liệu 2."
         }
 
-def process_grading_response(full_text):
+# Các trường JSON bài chấm phải có; thiếu trường nào (bị cắt) thì chỉ xin lại trường đó
+GRADING_FIELDS = (
+    "original_score.task_achievement", "original_score.cohesion_coherence", "original_score.lexical_resource",
+    "original_score.grammatical_range", "original_score.overall",
+    "errors", "annotated_essay", "revised_score.overall",
+)
+
+def process_grading_response(full_text, extra=None):
     """
     Hàm xử lý kết quả chấm điểm (CHUẨN TỪ APP CHẤM ĐIỂM).
     Tách biệt:
     1. Markdown Text (Phân tích chi tiết ở đầu).
-    2. JSON Data (Điểm số và lỗi ở cuối).
+    2. JSON Data (Điểm số và lỗi ở cuối). JSON bị cắt giữa chừng vẫn giữ mọi lỗi / điểm
+       đã ghi xong; data["missing"] = các trường còn thiếu.
+    extra: JSON xin bổ sung cho các trường thiếu (request_missing_grading), gộp vào trước khi tách.
     """
-    json_str = clean_json(full_text)
-    
     # Mặc định
     markdown_part = full_text
     data = {
@@ -859,10 +1164,11 @@ def process_grading_response(full_text):
         "originalScore": {
             "task_achievement": "-", "cohesion_coherence": "-", 
             "lexical_resource": "-", "grammatical_range": "-", "overall": "-"
-        }
+        },
+        "missing": list(GRADING_FIELDS),
     }
     
-    if json_str:
+    if "{" in full_text:
         # Tách phần Markdown (trước JSON)
         markdown_part = full_text.split("```json")[0].strip()
         # Nếu AI không dùng code block, thử split bằng ký tự '{' đầu tiên của JSON
@@ -870,17 +1176,79 @@ def process_grading_response(full_text):
              parts = full_text.split("{", 1)
              markdown_part = parts[0].strip()
 
-        try:
-            parsed = json.loads(json_str)
-            data["errors"] = parsed.get("errors", [])
-            data["annotatedEssay"] = parsed.get("annotated_essay")
-            data["revisedScore"] = parsed.get("revised_score")
-            data["originalScore"] = parsed.get("original_score", {})
-        except json.JSONDecodeError:
-            pass
+        # Cắt giữa mảng errors (hết token, đứt stream...) -> vẫn giữ các lỗi đã đủ + điểm đã ghi
+        parsed = salvage_json(full_text.split("```json", 1)[-1]).data
+        if extra:
+            parsed = merge_json(parsed, extra)
+        data["errors"] = parsed.get("errors", [])
+        data["annotatedEssay"] = parsed.get("annotated_essay")
+        data["revisedScore"] = parsed.get("revised_score")
+        data["originalScore"] = {**data["originalScore"], **parsed.get("original_score", {})}
+        data["missing"] = missing_fields(parsed, GRADING_FIELDS)
 
     return markdown_part, data
 
+# --- CASCADE: khi nào kết quả của model nhẹ chưa đủ tin cậy ---
+CRITERIA = ("task_achievement", "cohesion_coherence", "lexical_resource", "grammatical_range")
+CONFIDENCE_PROMPT = (
+    "\n\nIn the JSON block, also include a top-level field \"confidence\": a number from 0 to 1 "
+    "saying how certain you are that the band scores are correct."
+)
+
+def lite_grading_escalation(full_text):
+    """None = giữ kết quả của model nhẹ; chuỗi = lý do chuyển sang model mạnh."""
+    salvaged = salvage_json(full_text.split("```json", 1)[-1], GRADING_FIELDS)
+    if not salvaged.complete:
+        return "invalid"
+    try:
+        bands = [float(salvaged.data["original_score"][name]) for name in CRITERIA]
+    except (TypeError, ValueError):
+        return "invalid"
+    if not all(0 <= band <= 9 for band in bands):
+        return "invalid"
+    # Band tổng = trung bình 4 tiêu chí làm tròn 0.5 (.25 -> .5, .75 -> lên 1): trung bình nằm sát
+    # ngưỡng làm tròn thì lệch nửa band ở 1 tiêu chí cũng đổi band tổng -> để model mạnh chấm
+    # (so khoảng cách có dung sai, không so == trên số thực)
+    if abs((sum(bands) / len(bands)) % 0.5 - 0.25) <= CASCADE_BAND_MARGIN + 1e-9:
+        return "band_boundary"
+    try:
+        confidence = float(salvaged.data.get("confidence"))
+    except (TypeError, ValueError):
+        return "low_confidence"
+    return "low_confidence" if confidence < CASCADE_MIN_CONFIDENCE else None
+
+GRADING_CASCADE = Cascade(CASCADE_MODELS, lite_grading_escalation, suffix=CONFIDENCE_PROMPT)
+
+class GradingStreamSplitter:
+    """
+    Tách stream chấm điểm theo thời gian thực:
+    1. Phần Markdown (phân tích) -> hiển thị dần cho học sinh.
+    2. Khối JSON ở cuối -> chỉ gom lại, parse 1 lần khi stream kết thúc.
+    """
+    JSON_START = re.compile(r'```json|\{\s*"original_score"')
+    HOLD_BACK = 24  # Giữ lại đuôi ngắn phòng khi dấu hiệu JSON bị cắt giữa 2 chunk
+
+    def __init__(self):
+        self.buffer = ""
+        self.json_start = None
+
+    def feed(self, chunk):
+        self.buffer += chunk
+        if self.json_start is None:
+            match = self.JSON_START.search(self.buffer, max(0, len(self.buffer) - len(chunk) - self.HOLD_BACK))
+            if match:
+                self.json_start = match.start()
+        return self.markdown()
+
+    def markdown(self):
+        if self.json_start is not None:
+            return self.buffer[:self.json_start].rstrip()
+        tail = self.buffer[-self.HOLD_BACK:]
+        cut = min([i for i in (tail.find("`"), tail.find("{")) if i >= 0], default=-1)
+        if cut >= 0:
+            return self.buffer[:len(self.buffer) - len(tail) + cut]
+        return self.buffer
+
 # --- FILE EXPORT ---
 def register_vietnamese_font():
     try:
@@ -942,6 +1310,29 @@ if "guide_data" not in st.session_state: st.session_state.guide_data = None
 if "grading_result" not in st.session_state: st.session_state.grading_result = None
 if "saved_topic" not in st.session_state: st.session_state.saved_topic = ""
 if "saved_img" not in st.session_state: st.session_state.saved_img = None
+if "grading_pending" not in st.session_state: st.session_state.grading_pending = None
+if "guide_job" not in st.session_state: st.session_state.guide_job = None
+if "grading_job" not in st.session_state: st.session_state.grading_job = None
+if "batch_job" not in st.session_state: st.session_state.batch_job = None
+if "session_id" not in st.session_state: st.session_state.session_id = uuid.uuid4().hex
+
+# Session mới (VD: điện thoại ngủ, mất session) nhưng URL còn job_id -> gắn lại job đang chạy / đã xong
+if "job" in st.query_params and not (st.session_state.guide_job or st.session_state.grading_job or st.session_state.batch_job):
+    restored = JOBS.get(st.query_params["job"])
+    if restored is None:
+        del st.query_params["job"]
+    else:
+        st.session_state.saved_topic = restored.meta.get("topic", "")
+        st.session_state.saved_img = restored.meta.get("image")
+        st.session_state[f"{restored.kind}_job"] = restored.id
+        if restored.kind == "grading":
+            st.session_state.grading_pending = {"essay": restored.meta.get("essay", ""), "topic": restored.meta.get("topic", "")}
+            st.session_state.step = 3
+        if getattr(restored, "future", None) is not None:
+            GATEWAY.reassign(restored.future, st.session_state.session_id)
+
+# Chỉ giữ lệnh gọi AI của bước hiện tại; lần chạy này cũng báo gateway session vẫn còn mở
+GATEWAY.retain(st.session_state.session_id, "thuchanh", STEP_CALLS.get(st.session_state.step, set()))
 
 # ==========================================
 # 5. GIAO DIỆN CHÍNH (THEO YÊU CẦU MỚI)
@@ -2422,17 +2813,47 @@ if st.session_state.step == 1:
                     }
                     """
                     
-                    # Gọi AI
-                    res, _ = generate_content_with_failover(prompt_guide + "\nĐề bài: " + question_input, img_data, json_mode=True)
-                    if res:
-                        data = parse_guide_response(res.text)
-                    # Dù AI trả về gì, ta cũng phải gán guide_data để App không bị kẹt ở Step 1
-                        st.session_state.guide_data = data if data else {
-                            "task_type": "Task 1", "intro_guide": "AI Error - Please try again", 
-                            "overview_guide": "", "body1_guide": "", "body2_guide": ""
-                    }
-                    st.session_state.step = 2
-                    st.rerun() # Buộc Streamlit vẽ lại giao diện Phase 2 ngay lập tức
+                    # Gọi AI (job nền): prompt_guide cố định -> gửi làm static_prefix (context cache),
+                    # chỉ đề bài + ảnh là phần động
+                    submit_job(
+                        "guide",
+                        build_request(PromptLayout(prompt_guide, "Đề bài: {{TOPIC}}"), {"TOPIC": question_input}, img_data, json_mode=True, step="guide"),
+                        topic=question_input, image=img_data,
+                    )
+
+    # Chờ job hướng dẫn (kể cả job đã gửi ở lần chạy trước bị rerun / mất kết nối)
+    if st.session_state.guide_job:
+        with st.spinner("🧠 The examiner is analysing the visual data and providing step-by-step guidance on how to write the answer..."):
+            # Chờ từng nhịp ngắn: mỗi nhịp ghi ra trang để Streamlit kịp dừng script khi học sinh rời trang
+            tick = st.empty()
+            guide_job = JOBS.wait(st.session_state.guide_job, timeout=GRADING_POLL_SECONDS)
+            while guide_job is not None and not guide_job.done:
+                show_queue_position(tick)
+                guide_job = JOBS.wait(st.session_state.guide_job, timeout=GRADING_POLL_SECONDS)
+            tick.empty()
+        finish_job("guide")
+        if guide_job and guide_job.result:
+            show_connection_details(guide_job.result)
+            data = parse_guide_response(guide_job.result.text)
+            # Dù AI trả về gì, ta cũng phải gán guide_data để App không bị kẹt ở Step 1
+            st.session_state.guide_data = data if data else {
+                "task_type": "Task 1", "intro_guide": "AI Error - Please try again", 
+                "overview_guide": "", "body1_guide": "", "body2_guide": ""
+            }
+            st.session_state.step = 2
+            st.rerun() # Buộc Streamlit vẽ lại giao diện Phase 2 ngay lập tức
+        elif guide_job and isinstance(guide_job.error, DeadlineExceeded):
+            st.warning(OVERLOADED_MSG)
+        elif guide_job and guide_job.status == CANCELLED:
+            st.info("⏹️ Yêu cầu trước đã bị hủy (trang bị đóng quá lâu). Vui lòng bấm lại.")
+        else:
+            st.error(f"❌ Tất cả {len(ALL_KEYS)} luồng kết nối đều thất bại. Vui lòng thử lại sau 1 phút.")
+
+    # --- CHẾ ĐỘ GIÁO VIÊN: chấm cả lớp với cùng đề bài + ảnh ở trên (chỉ khi secrets.toml có TEACHER_CODE) ---
+    if TEACHER_CODE:
+        with st.expander("👩‍🏫 Teacher mode – Grade a whole class", expanded=bool(st.session_state.batch_job)):
+            if teacher_unlocked():
+                render_teacher_mode(question_input, img_data)
 
 # ==========================================
 # 6. UI: PHASE 2 - WRITING PRACTICE (ULTIMATE STICKY)
@@ -2562,30 +2983,17 @@ if st.session_state.step == 2 and st.session_state.guide_data:
             if total_wc < 30:
                 st.warning("⚠️ Bài viết quá ngắn, AI không thể chấm điểm chính xác.")
             else:
-                with st.status("👨‍🏫 Giám khảo đang chấm bài...") as status:
-                    total_essay = f"{intro_text}\n\n{overview_text}\n\n{body1_text}\n\n{body2_text}".strip()
-                    # Sử dụng biến saved_topic để tránh lỗi NameError
-                    prompt_grade = GRADING_PROMPT_TEMPLATE.replace('{{TOPIC}}', st.session_state.saved_topic).replace('{{ESSAY}}', total_essay)
-                    
-                    res_grade, _ = generate_content_with_failover(prompt_grade, st.session_state.saved_img, json_mode=False)
-                    
-                    if res_grade:
-                        # process_grading_response là hàm bóc tách Text và JSON bạn đã có
-                        mk_text, p_data = process_grading_response(res_grade.text)
-                        st.session_state.grading_result = {
-                            "data": p_data, "markdown": mk_text,
-                            "essay": total_essay, "topic": st.session_state.saved_topic
-                        }
-                        st.session_state.step = 3
-                        status.update(label="✅ Đã chấm xong!", state="complete", expanded=False)
-                        st.rerun()
-                    else:
-                        status.update(label="❌ Lỗi kết nối AI", state="error")
+                total_essay = f"{intro_text}\n\n{overview_text}\n\n{body1_text}\n\n{body2_text}".strip()
+                # Chuyển ngay sang Phase 3: bài chấm được stream dần vào tab "Phân tích chuyên sâu"
+                st.session_state.grading_pending = {"essay": total_essay, "topic": st.session_state.saved_topic}
+                st.session_state.grading_result = None
+                st.session_state.step = 3
+                st.rerun()
 
 # ==========================================
 # 7. UI: PHASE 3 - GRADING RESULT (FINAL POLISHED)
 # ==========================================
-if st.session_state.step == 3 and st.session_state.grading_result:
+if st.session_state.step == 3 and (st.session_state.grading_result or st.session_state.grading_pending):
     
     # --- 1. CSS TINH CHỈNH CUỐI CÙNG ---
     st.markdown("""
@@ -2626,9 +3034,16 @@ if st.session_state.step == 3 and st.session_state.grading_result:
         </style>
     """, unsafe_allow_html=True)
 
-    res = st.session_state.grading_result
+    pending = st.session_state.grading_pending
+    if pending:
+        # Đang chấm: dựng sẵn bố cục với bảng điểm trống, phân tích sẽ được stream vào tab 1
+        res = {"data": process_grading_response("")[1], "markdown": "", **pending}
+    else:
+        res = st.session_state.grading_result
     g_data = res["data"]
     analysis_text = res["markdown"]
+    if not pending and g_data.get("missing"):
+        st.warning(f"⚠️ Kết quả chấm bị thiếu một phần ({', '.join(g_data['missing'])}). Các phần hiển thị bên dưới vẫn hợp lệ.")
     
     # --- 2. CHIA CỘT (Không cần tiêu đề to nữa) ---
     c1, c2 = st.columns([4, 6], gap="medium")
@@ -2679,11 +3094,16 @@ if st.session_state.step == 3 and st.session_state.grading_result:
             tab1, tab2, tab3, tab4 = st.tabs(["📝 Phân tích chuyên sâu", "🔴 Lỗi Ngữ pháp và Từ vựng", "🔵 Lỗi Mạch lạc", "✍️ Bài sửa"])
             
             with tab1:
-                st.markdown(analysis_text if analysis_text and len(analysis_text) > 50 else "Chưa có dữ liệu phân tích.")
+                if pending:
+                    analysis_slot = st.empty()
+                    analysis_slot.info("⏳ Giám khảo đang đọc bài, phần phân tích sẽ hiện dần tại đây...")
+                else:
+                    st.markdown(analysis_text if analysis_text and len(analysis_text) > 50 else "Chưa có dữ liệu phân tích.")
 
             with tab2:
+                if pending: st.info("⏳ Danh sách lỗi sẽ có khi giám khảo chấm xong.")
                 micro = [e for e in g_data.get('errors', []) if e.get('category') in ['Grammar', 'Vocabulary', 'Ngữ pháp', 'Từ vựng']]
-                if not micro: st.success("✅ Tuyệt vời! Không có lỗi ngữ pháp lớn.")
+                if not micro and not pending: st.success("✅ Tuyệt vời! Không có lỗi ngữ pháp lớn.")
                 for i, err in enumerate(micro):
                     badge = "#DCFCE7" if err.get('category') in ['Grammar','Ngữ pháp'] else "#FEF9C3"
                     st.markdown(f"""
@@ -2699,7 +3119,7 @@ if st.session_state.step == 3 and st.session_state.grading_result:
             # Tab 3: Lỗi Mạch lạc (Macro)
             with tab3:
                 macro = [e for e in g_data.get('errors', []) if e.get('category') not in ['Grammar', 'Vocabulary', 'Ngữ pháp', 'Từ vựng']]
-                if not macro: 
+                if not macro and not pending: 
                     st.success("✅ Cấu trúc tốt.")
                 for err in macro:
                     # Lưu ý: Các thẻ HTML bên dưới được viết sát lề trái của chuỗi f-string
@@ -2723,12 +3143,89 @@ if st.session_state.step == 3 and st.session_state.grading_result:
             
             # Download & Reset
             d1, d2 = st.columns(2)
-            docx = create_docx(g_data, res['topic'], res['essay'], analysis_text)
-            d1.download_button("📥 Tải báo cáo (.docx)", docx, "IELTS_Report.docx", mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document")
+            if not pending:
+                docx = create_docx(g_data, res['topic'], res['essay'], analysis_text)
+                d1.download_button("📥 Tải báo cáo (.docx)", docx, "IELTS_Report.docx", mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document")
             
             if st.button("🔄 Làm bài mới (Reset)", width="stretch"):
-                for k in ["step", "guide_data", "grading_result", "saved_topic", "saved_img"]: st.session_state[k] = None
+                GATEWAY.cancel_session(st.session_state.session_id)
+                for k in ["step", "guide_data", "grading_result", "grading_pending", "saved_topic", "saved_img", "guide_job", "grading_job"]: st.session_state[k] = None
                 st.session_state.step = 1
+                finish_job("grading")
+                st.rerun()
+
+            if HEDGE_GRADING and not pending:
+                with st.expander("📈 Hedging metrics", expanded=False):
+                    st.json(get_hedge_metrics().summary())
+
+            if SHOW_LLM_METRICS and not pending:
+                with st.expander("📊 AI usage (tokens & latency)", expanded=False):
+                    st.dataframe(get_metrics_store().summary(), use_container_width=True)
+                    st.dataframe(get_metrics_store().by_model(), use_container_width=True)
+                    st.caption("Router: p95 hiện tại theo model + các quyết định gần đây")
+                    st.dataframe(get_latency_router().snapshot(), use_container_width=True)
+                    st.dataframe(get_latency_router().decisions(20), use_container_width=True)
+                    st.caption("Prefix cache: số token đầu request trùng với request trước cùng loại (≥ 1024 mới được cache ngầm)")
+                    st.dataframe(get_prefix_stats().report(), use_container_width=True)
+                    st.caption("Key ưu tiên theo loại prompt (vòng băm) + số lần phải lùi sang key khác")
+                    st.dataframe(GATEWAY.sticky_report(), use_container_width=True)
+                    st.caption("Cascade chấm bài: số lần giữ kết quả model nhẹ / lý do chuyển lên model mạnh")
+                    st.json(GATEWAY.cascades)
+                    st.caption("Hàng chờ công bằng theo session")
+                    st.json(GATEWAY.scheduler.snapshot())
+
+    # --- 3. STREAM BÀI CHẤM (JOB NỀN): Markdown hiện dần, JSON gom lại và parse 1 lần ở cuối ---
+    if pending:
+        grading_job = JOBS.get(st.session_state.grading_job)
+        if grading_job is None or grading_job.status == CANCELLED:
+            # Chưa gửi (hoặc server đã khởi động lại / job bị hủy khi trang đóng quá lâu) -> gửi mới
+            grading_job = JOBS.get(submit_job(
+                "grading", grading_request(pending, st.session_state.saved_img), stream=True,
+                essay=pending["essay"], topic=pending["topic"], image=st.session_state.saved_img,
+            ))
+        # Hỏi tiến độ định kỳ: rerun / mất kết nối chỉ dừng việc hiển thị, job vẫn chạy tiếp
+        splitter = GradingStreamSplitter()
+        seen = 0
+        tick = st.empty()
+        while True:
+            finished = grading_job.done
+            chunks = grading_job.chunks[seen:]
+            seen += len(chunks)
+            if chunks:
+                GATEWAY.heartbeat(st.session_state.session_id)
+                analysis_slot.markdown(splitter.feed("".join(chunks)))
+            else:
+                show_queue_position(tick)  # Điểm dừng cho Streamlit khi chưa có chữ mới (rời trang -> gateway hủy lệnh gọi)
+            if finished:
+                break
+            time.sleep(GRADING_POLL_SECONDS)
+        tick.empty()
+        finish_job("grading")
+
+        if grading_job.result:
+            # process_grading_response là hàm bóc tách Text và JSON bạn đã có
+            mk_text, p_data = process_grading_response(grading_job.result.text)
+            if p_data["missing"]:
+                # JSON bị cắt: chỉ xin lại các trường còn thiếu, giữ nguyên phần đã có
+                extra = request_missing_grading(pending, st.session_state.saved_img, p_data["missing"])
+                if extra:
+                    mk_text, p_data = process_grading_response(grading_job.result.text, extra)
+            st.session_state.grading_result = {
+                "data": p_data, "markdown": mk_text,
+                "essay": pending["essay"], "topic": pending["topic"]
+            }
+            st.session_state.grading_pending = None
+            st.toast(f"✅ Đã chấm xong ({grading_job.result.model})", icon="🤖")
+            st.rerun()
+        else:
+            # Thất bại: trả học sinh về Phase 2 (bài viết vẫn còn nguyên trong các ô nhập)
+            st.session_state.grading_pending = None
+            st.session_state.step = 2
+            if isinstance(grading_job.error, DeadlineExceeded):
+                analysis_slot.warning(OVERLOADED_MSG)
+            else:
+                analysis_slot.error("❌ Tất cả luồng kết nối đều thất bại. Vui lòng thử lại sau 1 phút.")
+            if st.button("⬅️ Quay lại bài viết"):
                 st.rerun()
 # ==========================================
 # FOOTER (HIỂN THỊ Ở MỌI STEP)
@@ -1,7 +1,11 @@
 import streamlit as st
+from ai_core.gateway import release_session
 
 st.set_page_config(page_title="Luyện tập 4 kỹ năng", layout="wide", page_icon="📝")
 
+# Rời trang luyện tập sang đây -> hủy lệnh gọi AI còn chạy của session (hướng dẫn / chấm bài)
+release_session(st.session_state.get("session_id"))
+
 # CSS chung
 st.markdown("""
 <style>
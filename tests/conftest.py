@@ -0,0 +1,43 @@
+import pytest
+
+# Gateway chạy trên backend giả lập (ai_core.fake_backend): không cần API key / mạng
+pytest.importorskip("google.genai")
+
+from google.genai import types
+
+from ai_core import (
+    FAKE_API_KEYS, ContextCacheManager, FakeClientPool, FakeGeminiBackend, GenerationRequest, HealthRegistry,
+    LatencyRouter, LLMGateway, MetricsStore, ModelCatalog, OfflineBatchManager, PrefixStats, RateLimiter,
+    ResponseCache,
+)
+from ai_core.hedging import HedgeMetrics
+
+MODEL = "gemini-2.5-flash"
+
+
+def make_request(text="Hello", **fields):
+    fields = {"page": "test", "step": "guide", "cache": False, "coalesce": False, **fields}
+    return GenerationRequest(
+        contents=[text], model_priority=[MODEL], build_config=lambda model: types.GenerateContentConfig(), **fields,
+    )
+
+
+@pytest.fixture
+def make_gateway(tmp_path):
+    """make_gateway(backend=None, **settings) -> LLMGateway riêng cho từng test (không dùng singleton)."""
+    def make(backend=None, **settings):
+        pool = FakeClientPool(backend or FakeGeminiBackend(seed=0))
+        return LLMGateway(
+            FAKE_API_KEYS, client_pool=pool, catalog=ModelCatalog(pool), health=HealthRegistry(),
+            hedge_metrics=HedgeMetrics(), limiter=RateLimiter(), cache=ResponseCache(directory=str(tmp_path / "cache")),
+            context_cache=ContextCacheManager(client_pool=pool), metrics=MetricsStore(str(tmp_path / "metrics.sqlite3")),
+            router=LatencyRouter(), prefix_stats=PrefixStats(), **settings,
+        )
+    return make
+
+
+@pytest.fixture
+def make_batches(tmp_path, make_gateway):
+    def make(backend=None):
+        return OfflineBatchManager(path=str(tmp_path / "batches.sqlite3"), gateway=make_gateway(backend), poll_interval=0)
+    return make
@@ -0,0 +1,129 @@
+import concurrent.futures
+import time
+
+import pytest
+
+from ai_core import DeadlineExceeded, FakeGeminiBackend
+from ai_core import gateway as gateway_module
+from ai_core.fake_backend import DEFAULT_RESPONSES
+
+from conftest import make_request
+
+
+# ---------- NGÂN SÁCH THỜI GIAN ----------
+def test_deadline_expires_during_attempts(make_gateway, monkeypatch):
+    monkeypatch.setattr(gateway_module, "MIN_ATTEMPT_SECONDS", 0.2)
+    gw = make_gateway(FakeGeminiBackend(first_token=5))
+    started = time.monotonic()
+    with pytest.raises(DeadlineExceeded):
+        gw.generate(make_request(deadline=0.8))
+    assert time.monotonic() - started < 2
+
+
+def test_deadline_includes_queue_wait(make_gateway, monkeypatch):
+    monkeypatch.setattr(gateway_module, "MIN_ATTEMPT_SECONDS", 0.2)
+    gw = make_gateway(FakeGeminiBackend(first_token=2), max_concurrency=1)
+    busy = gw.submit(make_request("first", session="A", deadline=30))
+    time.sleep(0.1)
+    started = time.monotonic()
+    # Chỉ có 1 chỗ và đang bận ~2s: chưa được cho vào kịp thì hết hạn luôn, không chờ tới lượt
+    with pytest.raises(DeadlineExceeded):
+        gw.generate(make_request("second", session="B", deadline=0.8))
+    assert time.monotonic() - started < 1.5
+    assert gw.scheduler.snapshot()["queued"] == 0
+    assert busy.result(timeout=10) is not None
+    assert gw.metrics.summary()[0]["failed"] == 1
+
+
+def test_queue_wait_is_charged_to_the_budget(make_gateway):
+    gw = make_gateway(FakeGeminiBackend(first_token=0.5), max_concurrency=1)
+    first = gw.submit(make_request("first", session="A"))
+    second = gw.submit(make_request("second", session="B", deadline=30))
+    first.result(timeout=10)
+    assert second.result(timeout=10).queue_wait >= 0.3
+
+
+# ---------- HỦY THEO SESSION ----------
+def test_cancel_session_only_cancels_that_session(make_gateway):
+    gw = make_gateway(FakeGeminiBackend(first_token=2))
+    mine = gw.submit(make_request("mine", session="A"))
+    other = gw.submit(make_request("other", session="B"))
+    time.sleep(0.1)
+    assert gw.cancel_session("A") == 1
+    with pytest.raises(concurrent.futures.CancelledError):
+        mine.result(timeout=5)
+    assert other.result(timeout=10) is not None
+
+
+def test_retain_cancels_calls_of_other_steps(make_gateway):
+    gw = make_gateway(FakeGeminiBackend(first_token=2))
+    guide = gw.submit(make_request("guide", session="A"))
+    assert gw.retain("A", "test", {"grading"}) == 1
+    assert concurrent.futures.wait([guide], timeout=5).done
+    assert guide.cancelled()
+
+
+def test_idle_session_is_reaped(make_gateway, monkeypatch):
+    monkeypatch.setattr(gateway_module, "SESSION_IDLE_SECONDS", 0.3)
+    monkeypatch.setattr(gateway_module, "REAP_INTERVAL_SECONDS", 0.1)
+    gw = make_gateway(FakeGeminiBackend(first_token=5))
+    future = gw.submit(make_request(session="gone"))
+    assert concurrent.futures.wait([future], timeout=3).done
+    assert future.cancelled()
+    assert gw.cancelled == 1
+
+
+def test_blocking_generate_heartbeats_its_session(make_gateway, monkeypatch):
+    monkeypatch.setattr(gateway_module, "SESSION_IDLE_SECONDS", 0.3)
+    monkeypatch.setattr(gateway_module, "REAP_INTERVAL_SECONDS", 0.1)
+    monkeypatch.setattr(gateway_module, "WAIT_TICK_SECONDS", 0.05)
+    gw = make_gateway(FakeGeminiBackend(first_token=1))
+    assert gw.generate(make_request(session="waiting")) is not None
+
+
+# ---------- GỘP LỆNH GỌI TRÙNG ----------
+def test_identical_calls_are_coalesced(make_gateway):
+    backend = FakeGeminiBackend(first_token=0.5)
+    gw = make_gateway(backend)
+    futures = [gw.submit(make_request("same prompt", coalesce=True)) for _ in range(3)]
+    results = [future.result(timeout=10) for future in futures]
+    assert backend.calls == 1
+    assert gw.coalesced == 2
+    assert len({result.text for result in results}) == 1
+    assert sum(result.coalesced for result in results) == 2
+
+
+def test_different_calls_are_not_coalesced(make_gateway):
+    backend = FakeGeminiBackend(first_token=0.2)
+    gw = make_gateway(backend)
+    for future in [gw.submit(make_request(text, coalesce=True)) for text in ("one", "two")]:
+        future.result(timeout=10)
+    assert backend.calls == 2
+    assert gw.coalesced == 0
+
+
+# ---------- VIẾT TIẾP KHI BỊ CẮT Ở MAX_TOKENS ----------
+class _TruncateOnce(FakeGeminiBackend):
+    """Chỉ lệnh gọi đầu tiên bị cắt ở MAX_TOKENS, các vòng viết tiếp trả đủ phần còn lại."""
+
+    def _roll(self, probability):
+        return probability > 0 and self.truncated == 0
+
+
+def test_truncated_result_is_continued_and_stitched(make_gateway):
+    backend = _TruncateOnce(truncate_rate=1.0, seed=0)
+    gw = make_gateway(backend)
+    result = gw.generate(make_request('Trả về JSON có "original_score"'))
+    assert backend.truncated == 1
+    assert backend.calls == 2
+    assert result.continuations == 1
+    assert result.text == DEFAULT_RESPONSES["grading"]
+    assert gw.continuations == 1
+
+
+def test_continuation_stops_when_complete_if_passes(make_gateway):
+    backend = _TruncateOnce(truncate_rate=1.0, seed=0)
+    gw = make_gateway(backend)
+    result = gw.generate(make_request('Trả về JSON có "original_score"', complete_if=lambda text: True))
+    assert backend.calls == 1
+    assert result.continuations == 0
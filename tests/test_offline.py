@@ -0,0 +1,77 @@
+import time
+
+import pytest
+
+from ai_core import FakeGeminiBackend
+from ai_core import offline as offline_module
+from ai_core.fake_backend import DEFAULT_RESPONSES, FakeAPIError
+
+from conftest import make_request
+
+GRADING_PROMPT = 'Chấm bài, trả về JSON có "original_score"'
+GUIDE_PROMPT = 'Hướng dẫn, trả về JSON có "intro_guide"'
+
+
+def _items(prompts):
+    return [(f"s{i}", make_request(prompt, step="overnight_grading"), {"essay": str(i)}) for i, prompt in enumerate(prompts)]
+
+
+class _FailOn(FakeGeminiBackend):
+    """Mục nào có chuỗi `marker` trong contents thì trả lỗi trong batch (các mục khác vẫn xong)."""
+
+    def __init__(self, marker, **settings):
+        super().__init__(**settings)
+        self.marker = marker
+
+    def _plan(self, api_key, model, contents, config):
+        if any(isinstance(part, str) and self.marker in part for part in contents):
+            raise FakeAPIError(500, "INTERNAL", "item failed")
+        return super()._plan(api_key, model, contents, config)
+
+
+def test_results_are_mapped_back_in_order(make_batches):
+    batches = make_batches(FakeGeminiBackend(batch_delay=0, seed=0))
+    prompts = [GRADING_PROMPT, GUIDE_PROMPT, GRADING_PROMPT]
+    [batch_id] = batches.submit("class_grading", _items(prompts), topic="T")
+    batch = batches.get(batch_id)
+    assert batch.done and batch.error is None
+    assert [item.name for item in batch.items] == ["s0", "s1", "s2"]
+    assert [item.meta["essay"] for item in batch.items] == ["0", "1", "2"]
+    assert [item.result.text for item in batch.items] == [
+        DEFAULT_RESPONSES["grading"], DEFAULT_RESPONSES["guide"], DEFAULT_RESPONSES["grading"],
+    ]
+    assert batch.progress() == {"queued": 0, "done": 3, "failed": 0, "total": 3}
+
+
+def test_failed_items_are_marked_after_polling(make_batches):
+    batches = make_batches(_FailOn("broken", batch_delay=0.2, seed=0))
+    [batch_id] = batches.submit("class_grading", _items([GRADING_PROMPT, "broken " + GRADING_PROMPT, GUIDE_PROMPT]))
+    assert not batches.get(batch_id).done
+    for _ in range(50):
+        batches.refresh(force=True)
+        if batches.get(batch_id).done:
+            break
+        time.sleep(0.05)
+    batch = batches.get(batch_id)
+    assert [item.status for item in batch.items] == ["done", "failed", "done"]
+    assert "item failed" in batch.items[1].error
+    assert batch.items[2].result.text == DEFAULT_RESPONSES["guide"]
+
+
+def test_large_batches_are_split_in_order(make_batches, monkeypatch):
+    monkeypatch.setattr(offline_module, "ITEM_OVERHEAD_BYTES", 0)
+    monkeypatch.setattr(offline_module, "MAX_INLINE_BATCH_BYTES", 2 * len(GRADING_PROMPT.encode("utf-8")))
+    batches = make_batches(FakeGeminiBackend(batch_delay=0, seed=0))
+    batch_ids = batches.submit("class_grading", _items([GRADING_PROMPT] * 5), topic="T")
+    parts = [batches.get(batch_id) for batch_id in batch_ids]
+    assert [part.meta["part"] for part in parts] == ["1/3", "2/3", "3/3"]
+    assert [item.meta["essay"] for part in parts for item in part.items] == ["0", "1", "2", "3", "4"]
+    assert all(item.status == "done" for part in parts for item in part.items)
+
+
+def test_item_over_the_limit_is_rejected(make_batches, monkeypatch):
+    monkeypatch.setattr(offline_module, "MAX_INLINE_BATCH_BYTES", 10)
+    batches = make_batches(FakeGeminiBackend(batch_delay=0, seed=0))
+    with pytest.raises(ValueError):
+        batches.submit("class_grading", _items([GRADING_PROMPT]))
+    assert batches.list() == []